@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+# Close-approach finder: samples vessel-target distance over a window (using
+# the batched ephemeris in orbit.py), brackets every local minimum, refines
+# each with Brent's method and returns them ranked, closest first.  No
+# curses or downlink here, so it runs headlessly as well as under
+# UpdateTgtCloseApproach.
+
+import math
+import matrix
+import orbit
+
+if matrix.BACKEND == 'numpy':
+    import numpy
+else:
+    numpy = None
+
+CGOLD = 0.3819660112501051 # 2 - golden ratio
+
+class Trajectory(object):
+    """Vessel (elements at dt=0) and target, both about parent body pcb.
+
+    Times are dt, seconds after the vessel elements; ut1 is the target's
+    ephemeris time at dt=0."""
+    def __init__(self, tcb, pcb, ut1, elts):
+        self.tcb = tcb
+        self.pcb = pcb
+        self.ut1 = ut1
+        self.elts = elts
+    def state(self, dt):
+        """(man, ean, r, v, tr, tv) at dt"""
+        e = self.elts
+        man = e['man'] + dt * e['mmo']
+        ean = orbit.ean_from_man(man, e['ecc'], 16)
+        r, v = self.pcb.compute_3d_vector(e['sma'], e['ecc'], ean, e['ape'], e['inc'], e['lan'])
+        tr, tv = self.tcb.vectors_at_ut(self.ut1 + dt)
+        return (man, ean, r, v, tr, tv)
+    def distance(self, dt):
+        _, _, r, _, tr, _ = self.state(dt)
+        return (tr - r).mag
+    def sample(self, window, n):
+        """(dts, distances) at n evenly spaced times over [0, window).  Lists,
+        or ndarrays with the numpy backend, in which case samples that
+        overflow (hyperbolic orbits, far out) come out NaN or inf"""
+        e = self.elts
+        if numpy is None:
+            dts = [i * window / float(n) for i in range(n)]
+            eans = orbit.eans_from_mans([e['man'] + dt * e['mmo'] for dt in dts], e['ecc'], 16)
+            rs, _ = self.pcb.compute_3d_vectors(e['sma'], e['ecc'], eans, e['ape'], e['inc'], e['lan'])
+            trs, _ = self.tcb.vectors_at_uts([self.ut1 + dt for dt in dts])
+            return (dts, (trs - rs).mag)
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            dts = numpy.arange(n) * (window / float(n))
+            eans = orbit.eans_from_mans(e['man'] + dts * e['mmo'], e['ecc'], 16)
+            rs, _ = self.pcb.compute_3d_vectors(e['sma'], e['ecc'], eans, e['ape'], e['inc'], e['lan'])
+            trs, _ = self.tcb.vectors_at_uts(self.ut1 + dts)
+            ds = (trs - rs).mag
+        return (dts, numpy.where(numpy.isnan(ds), numpy.inf, ds))
+
+def brackets(dts, ds):
+    """(lo, mid, hi) index triples about each local minimum of sampled ds.
+    A minimum at either end of the window gets lo or hi == mid"""
+    n = len(ds)
+    if numpy is not None:
+        ds = numpy.asarray(ds)
+        if n < 2:
+            return [] if n == 0 or numpy.isinf(ds[0]) else [(0, 0, 0)]
+        fin = numpy.isfinite(ds)
+        # '<' on one side, '<=' on the other, so a flat floor counts once
+        left = numpy.concatenate(([True], ds[1:] < ds[:-1]))
+        right = numpy.concatenate((ds[:-1] <= ds[1:], [True]))
+        idx = numpy.nonzero(left & right & fin)[0]
+        return [(max(i - 1, 0), i, min(i + 1, n - 1)) for i in idx.tolist()]
+    out = []
+    for i in range(n):
+        d = ds[i]
+        if d != d or d == float('inf'):
+            continue
+        if i > 0 and not d < ds[i - 1]:
+            continue
+        if i < n - 1 and not d <= ds[i + 1]:
+            continue
+        out.append((max(i - 1, 0), i, min(i + 1, n - 1)))
+    return out
+
+def brent(f, a, x, b, tol=1.0, maxiter=50):
+    """Minimise f over [a, b], starting from x (a <= x <= b).  Returns
+    (x, f(x), iterations, width, converged): width is the final bracket"""
+    v = w = x
+    fx = fv = fw = f(x)
+    d = e = 0.0
+    for it in range(1, maxiter + 1):
+        m = 0.5 * (a + b)
+        tol2 = 2.0 * tol
+        if abs(x - m) <= tol2 - 0.5 * (b - a):
+            return (x, fx, it - 1, b - a, True)
+        golden = True
+        if abs(e) > tol:
+            # try a parabola through x, w, v
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = 2.0 * (q - r)
+            if q > 0.0:
+                p = -p
+            q = abs(q)
+            etemp = e
+            e = d
+            if abs(p) < abs(0.5 * q * etemp) and q * (a - x) < p < q * (b - x):
+                d = p / q
+                u = x + d
+                if u - a < tol2 or b - u < tol2:
+                    d = math.copysign(tol, m - x)
+                golden = False
+        if golden:
+            e = (a - x) if x >= m else (b - x)
+            d = CGOLD * e
+        u = x + (d if abs(d) >= tol else math.copysign(tol, d))
+        fu = f(u)
+        if fu <= fx:
+            if u >= x:
+                a = x
+            else:
+                b = x
+            v, fv, w, fw, x, fx = w, fw, x, fx, u, fu
+        else:
+            if u < x:
+                a = u
+            else:
+                b = u
+            if fu <= fw or w == x:
+                v, fv, w, fw = w, fw, u, fu
+            elif fu <= fv or v == x or v == w:
+                v, fv = u, fu
+    return (x, fx, maxiter, b - a, False)
+
+def find_approaches(traj, window, n, tol=1.0, maxiter=50, limit=None):
+    """All local minima of distance over [0, window), closest first.
+
+    Each is a dict of 'dt', 'dist', 'iters', 'width' (final bracket; the
+    answer is good to about half this), 'converged', and 'edge' (minimum at
+    either end of the window, so maybe not a true minimum)."""
+    dts, ds = traj.sample(window, n)
+    step = window / float(n)
+    found = []
+    for lo, mid, hi in brackets(dts, ds):
+        a = float(dts[lo])
+        b = float(dts[hi]) if hi > mid else float(dts[mid]) + step
+        x, fx, iters, width, ok = brent(traj.distance, a, float(dts[mid]), b, tol, maxiter)
+        found.append({'dt': x, 'dist': fx, 'iters': iters, 'width': width,
+                      'converged': ok, 'edge': lo == mid or hi == mid})
+    found.sort(key=lambda m: m['dist'])
+    if limit is not None:
+        del found[limit:]
+    return found
+
+if __name__ == '__main__':
+    # Moon-crossing orbit, three revolutions: one minimum per pass
+    import time
+    earth = orbit.CelestialBody('Earth', 6371000, 3.986004418e14)
+    orbit.celestial_bodies['Earth'] = earth
+    moon = orbit.CelestialBody('Moon', 1737100, 4.9048695e12)
+    moon.orbit('Earth', {'sma': 384399e3, 'ecc': 0.0549, 'maae': 1.0,
+                         'inc': 0.09, 'lan': 0.2, 'ape': 0.3})
+    moon.connect_parent()
+    sma = 250000e3
+    elts = {'man': 0.1, 'sma': sma, 'ecc': 0.96, 'ape': 0.5, 'inc': 0.1,
+            'lan': 0.2, 'mmo': math.sqrt(earth.gm / sma ** 3)}
+    traj = Trajectory(moon, moon.parent_body, 5000.0, elts)
+    window = 3 * 2.0 * math.pi / elts['mmo']
+    t0 = time.perf_counter()
+    found = find_approaches(traj, window, 6000)
+    t1 = time.perf_counter()
+    print('backend %s: %d minima in %.1fms'%(matrix.BACKEND, len(found), (t1 - t0) * 1e3))
+    for i, m in enumerate(found):
+        print('%2d  T+%10.1fs  %12.1fkm  %2d iters  +-%.2fs %s%s'%(i, m['dt'], m['dist'] / 1e3, m['iters'],
+                                                                  m['width'] / 2.0,
+                                                                  '' if m['converged'] else ' UNCONVERGED',
+                                                                  ' (edge)' if m['edge'] else ''))
@@ -25,6 +25,24 @@ class AscentSim(sim.RocketSim):
                 print("(%g, %g) -> (%g, %g)"%(self.downrange, self.alt, self.hs, self.vs))
                 print("%s"%(''.join(self.data.keys()),))
 
+class AscentSimBatch(sim.RocketSimBatch):
+    orbitals = True
+    def simulate(self, booster, hs, vs, alt, throttles, pit, hdg, lat, lon, brad, bgm):
+        self.sim_setup(booster, hs, vs, alt, throttles, pit, hdg, lat, lon, brad, bgm, False)
+        self.iv_sgn = 1 if (vs >= 0) else -1
+        self.run()
+    def record(self, i):
+        d = self.data[i]
+        if self.hs[i] > self.tgt_obt_vel[i] and 'o' not in d:
+            d['o'] = self.encode(i)
+        if self.vs[i] * self.iv_sgn <= 0 and 'v' not in d:
+            d['v'] = self.encode(i)
+        if len(self.boosters[i].stages) <= self.stagecap[i] and 'b' not in d:
+            d['b'] = self.encode(i)
+    def done(self, i):
+        d = self.data[i]
+        return 'o' in d and 'v' in d and 'b' in d
+
 class AscentSim3D(sim.RocketSim3D):
     def simulate(self, booster, throttle, pit, hdg, brad, bgm, inc, lan, tan, ape, ecc, sma, reflon=None):
         ean = orbit.ean_from_tan(tan, ecc)
@@ -38,9 +56,9 @@ class AscentSim3D(sim.RocketSim3D):
                 break
             self.tgt_obt_vel = self.pbody.vcirc(self.alt)
             if self.hs > self.tgt_obt_vel and 'o' not in self.data:
-                self.data['o'] = self.encode()
+                self.data['o'] = self.encode_event(lambda: self.hs > self.pbody.vcirc(self.alt))
             if self.vs * iv_sgn <= 0 and 'v' not in self.data:
-                self.data['v'] = self.encode()
+                self.data['v'] = self.encode_event(lambda: self.vs * iv_sgn <= 0)
             if len(self.booster.stages) <= self.stagecap and 'b' not in self.data:
                 self.data['b'] = self.encode()
             if self.debug:
@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+# Headless benchmark: builds each console against recorded (--replay) or
+# synthetic telemetry, on a curses screen whose output goes nowhere, and
+# times the draw loop.  Prints JSON, for comparing runs across commits.
+
+import curses
+import json
+import math
+import optparse
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import booster
+import downlink
+import gauge
+import konrad
+import matrix
+import orbit
+import simsched
+import xfer
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jb_examples')
+
+# Stand-in solar system, for when there's no KSP config to read one from.
+# (name, radius, gm, soi, parent, elements); ids as in RSS
+BODIES = [('Sun', 696342000, 1.32712440018e20, None, None, None),
+          ('Earth', 6371000, 3.986004418e14, 9.2465e8, 'Sun',
+           {'sma': 149598261150, 'ecc': 0.01671, 'maae': 6.2590,
+            'ape': 1.7967, 'inc': 0.0, 'lan': 0.0}),
+          ('Moon', 1737100, 4.9048695e12, 6.6e7, 'Earth',
+           {'sma': 384399000, 'ecc': 0.0549, 'maae': 2.3555,
+            'ape': 5.5524, 'inc': 0.0898, 'lan': 2.1831}),
+          ('Mars', 3389500, 4.282837e13, 5.77e8, 'Sun',
+           {'sma': 227939200000, 'ecc': 0.0934, 'maae': 0.3381,
+            'ape': 5.0003, 'inc': 0.0323, 'lan': 0.8649}),
+          ]
+
+# Fixtures left out of a default run (naming them with --booster still
+# runs them), as booster.py can't load them here
+SKIP_FIXTURES = {'AtlasAgena': 'first stage has no propellant',
+                 'MercuryAtlas': 'propellant densities come from the KSP install'}
+
+# Consoles that want a --booster; the rest are run once, without
+CONSOLE_BOOSTERS = ('boost', 'retro', 'r3d', 'asc', 'a3d', 'mnv', 'esc', 'clo', 'fba')
+
+def install_bodies():
+    if orbit.celestial_bodies:
+        return
+    if orbit.epoch is None:
+        orbit.epoch = 0
+    for name, rad, gm, soi, parent, elts in BODIES:
+        cb = orbit.CelestialBody(name, rad, gm)
+        if parent is not None:
+            cb.orbit(parent, elts)
+        orbit.celestial_bodies[name] = cb
+    for cb in orbit.celestial_bodies.values():
+        cb.connect_parent()
+
+class SyntheticDownlink(downlink.FakeDownlink):
+    """Telemetry for a vessel in a low, slightly eccentric orbit of body 1,
+    with a given booster aboard.  Answers whichever keys are subscribed,
+    advancing dt seconds of mission time per update()"""
+    UT0 = 1.0e6
+    elts = {'sma': 6.671e6, 'ecc': 0.01, 'inc': 28.6, 'lan': 40.0, 'ape': 90.0}
+    def __init__(self, bstr=None, dt=0.25, body=1):
+        super(SyntheticDownlink, self).__init__()
+        self.bstr = bstr
+        self.dt = dt
+        self.body = body
+        self.subs = set()
+        self.t = 0.0
+        self.body_ids = dict((b[0], i) for i, b in enumerate(BODIES))
+    def subscribe(self, key):
+        self.subs.add(key)
+    def unsubscribe(self, key):
+        self.subs.discard(key)
+    def bodies(self):
+        d = {}
+        for i, (name, rad, gm, soi, parent, elts) in enumerate(BODIES):
+            d['b.name[%d]'%(i,)] = name
+            d['b.radius[%d]'%(i,)] = rad
+            d['b.o.gravParameter[%d]'%(i,)] = gm
+            if soi is not None:
+                d['b.soi[%d]'%(i,)] = soi
+            d['b.maxAtmosphere[%d]'%(i,)] = 0
+            if elts is None:
+                continue
+            d['b.o.sma[%d]'%(i,)] = elts['sma']
+            d['b.o.eccentricity[%d]'%(i,)] = elts['ecc']
+            d['b.o.maae[%d]'%(i,)] = elts['maae']
+            d['b.o.argumentOfPeriapsis[%d]'%(i,)] = math.degrees(elts['ape'])
+            d['b.o.inclination[%d]'%(i,)] = math.degrees(elts['inc'])
+            d['b.o.lan[%d]'%(i,)] = math.degrees(elts['lan'])
+            d['b.o.phaseAngle[%d]'%(i,)] = 45.0
+        d['b.number'] = len(BODIES)
+        return d
+    def vessel(self, t):
+        name, rad, gm = BODIES[self.body][:3]
+        e = self.elts
+        sma, ecc = e['sma'], e['ecc']
+        mmo = math.sqrt(gm / sma ** 3)
+        ean = orbit.ean_from_man(1.0 + mmo * t, ecc, 20)
+        tan = orbit.tan_from_ean(ean, ecc)
+        r = orbit.r(sma, ecc, ean)
+        v = math.sqrt(gm * (2.0 / r - 1.0 / sma))
+        p = sma * (1 - ecc ** 2)
+        vs = math.sqrt(gm / p) * ecc * math.sin(tan)
+        hs = math.sqrt(max(v ** 2 - vs ** 2, 0))
+        apa = sma * (1 + ecc) - rad
+        pea = sma * (1 - ecc) - rad
+        period = 2 * math.pi / mmo
+        man = orbit.man_from_ean(ean, ecc)
+        d = {'v.missionTime': t, 't.universalTime': self.UT0 + t,
+             'v.name': 'Bench', 'v.body': name,
+             'v.altitude': r - rad, 'v.terrainHeight': 0.0,
+             'v.surfaceSpeed': hs - 400.0, 'v.verticalSpeed': vs,
+             'v.orbitalVelocity': v, 'v.surfaceVelocity': v - 400.0,
+             'v.lat': e['inc'] * math.sin(tan + math.radians(e['ape'])),
+             'v.long': (math.degrees(tan) + e['lan'] - 0.004 * t) % 360 - 180,
+             'v.geeForce': 0.0, 'v.dynamicPressure': 0.0,
+             'v.sasValue': True, 'v.rcsValue': False, 'v.gearValue': False,
+             'v.brakeValue': False,
+             'n.pitch2': 0.0, 'n.heading2': 90.0, 'n.roll2': 0.0,
+             'f.throttle': 1.0,
+             'o.sma': sma, 'o.eccentricity': ecc, 'o.inclination': e['inc'],
+             'o.lan': e['lan'], 'o.argumentOfPeriapsis': e['ape'],
+             'o.trueAnomaly': math.degrees(tan), 'o.ApA': apa, 'o.PeA': pea,
+             'o.period': period,
+             'o.timeToAp': ((math.pi - man) % (2 * math.pi)) / mmo,
+             }
+        if self.bstr is not None:
+            for prop in self.bstr.all_props:
+                mx = self.bstr.stages[0].prop_all(prop)
+                d['r.resourceMax[%s]'%(prop,)] = mx
+                d['r.resource[%s]'%(prop,)] = mx * 0.8
+        return d
+    def update(self):
+        self.t += self.dt
+        d = self.bodies()
+        d.update(self.vessel(self.t))
+        for k in self.subs:
+            self.data[k] = d.get(k)
+        return dict((k, self.data[k]) for k in self.subs)
+
+def percentiles(samples, scale=1e3):
+    """Summary of samples (seconds, by default reported in ms)"""
+    if not samples:
+        return {}
+    s = sorted(samples)
+    def pc(p):
+        return s[min(int(len(s) * p / 100.0), len(s) - 1)] * scale
+    return {'p50': pc(50), 'p90': pc(90), 'p99': pc(99), 'max': s[-1] * scale,
+            'mean': sum(s) * scale / len(s)}
+
+def gauge_tree(group, prefix=''):
+    """(name, group, index, gauge) for every gauge under group, depth-first.
+    Names are paths of group titles and class names, made unique"""
+    seen = {}
+    for i, g in enumerate(group.gl):
+        if isinstance(g, gauge.GaugeGroup):
+            label = g.title or 'GaugeGroup'
+        else:
+            label = g.__class__.__name__
+        n = seen[label] = seen.get(label, 0) + 1
+        if n > 1:
+            label = '%s#%d'%(label, n)
+        yield (prefix + label, group, i, g)
+        if isinstance(g, gauge.GaugeGroup):
+            for t in gauge_tree(g, prefix + label + '/'):
+                yield t
+
+class Bench(object):
+    def __init__(self, scr, frames, alloc_frames):
+        self.scr = scr
+        self.frames = frames
+        self.alloc_frames = alloc_frames
+    def frame(self, console, dl):
+        if hasattr(console, 'update_bodies'):
+            # TransferConsole feeds itself; its dl is a FakeDownlink
+            console.UT += 86400
+            console.update_bodies()
+        else:
+            dl.update()
+        ml = console.draw()
+        self.scr.refresh()
+        return ml
+    def run(self, console, dl):
+        tree = list(gauge_tree(console.group))
+        times = []
+        gtimes = dict((name, []) for name, grp, i, g in tree)
+        steps = {}
+        errors = {}
+        for n in range(self.frames):
+            if getattr(dl, 'eof', False):
+                break
+            t0 = time.perf_counter()
+            ml = self.frame(console, dl)
+            times.append(time.perf_counter() - t0)
+            for name, grp, i, g in tree:
+                if i < len(grp.times):
+                    gtimes[name].append(grp.times[i])
+                ns = g.steps() if isinstance(g, gauge.BackgroundSimMixin) else None
+                if ns is not None:
+                    steps.setdefault(name, []).append(ns)
+            for m in ml or ():
+                if m.startswith(('telerr', 'dpyerr')):
+                    errors[m] = errors.get(m, 0) + 1
+        res = {'nframes': len(times),
+               'frame_ms': percentiles(times),
+               'gauge_ms': dict((k, percentiles(v)) for k, v in gtimes.items() if v),
+               'sim_steps': dict((k, sorted(v)[len(v) // 2]) for k, v in steps.items()),
+               }
+        if errors:
+            res['errors'] = errors
+        if self.alloc_frames:
+            res['alloc'] = self.allocs(console, dl)
+        return res
+    def allocs(self, console, dl):
+        # Separate pass, as tracing slows everything down
+        peaks = []
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            for n in range(self.alloc_frames):
+                if getattr(dl, 'eof', False):
+                    break
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                self.frame(console, dl)
+                cur, peak = tracemalloc.get_traced_memory()
+                peaks.append(peak - before)
+            net = tracemalloc.get_traced_memory()[0] - start
+        finally:
+            tracemalloc.stop()
+        return {'peak_kb': percentiles(peaks, 1.0 / 1024), 'net_kb': net / 1024.0}
+
+def fixtures(names):
+    if not names:
+        names = sorted(n for n in os.listdir(FIXTURE_DIR) if n not in SKIP_FIXTURES)
+    res = []
+    for name in names:
+        path = name if os.sep in name else os.path.join(FIXTURE_DIR, name)
+        res.append((os.path.basename(path), path))
+    return res
+
+def make_downlink(opts, bstr):
+    if opts.replay:
+        return downlink.ReplayDownlink(open(opts.replay, 'rb'), 0)
+    return SyntheticDownlink(bstr)
+
+def runs(opts, names):
+    """(label, factory) for each console/booster combination to run, where
+    factory(scr) returns (console, dl)"""
+    for name in names:
+        if name == 'xfer':
+            def make(scr):
+                xopts = xfer.parse_opts(['-t', 'Mars'])
+                xopts.booster = booster.FakeBooster()
+                return xfer.TransferConsole(xopts, scr, downlink.FakeDownlink()), None
+            yield (name, make)
+            continue
+        if name in CONSOLE_BOOSTERS:
+            fx = fixtures(opts.booster)
+        else:
+            fx = [(None, None)]
+        for bname, path in fx:
+            args = ['-t', '2', name]
+            if path is not None:
+                args = ['--booster', path] + args
+            def make(scr, args=args):
+                kopts, cls = konrad.parse_opts(args)
+                dl = make_downlink(opts, kopts.booster)
+                dl.subscribe('v.name')
+                return cls(kopts, scr, dl), dl
+            yield (name if bname is None else '%s/%s'%(name, bname), make)
+
+def null_stdout():
+    """Point fd 1 at /dev/null, for curses to write to.  Returns a copy of
+    the old one, for the results"""
+    sys.stdout.flush()
+    out = os.dup(1)
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 1)
+    os.close(null)
+    return os.fdopen(out, 'w')
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_opts(argv=None):
+    x = optparse.OptionParser(usage='%prog [options] [consname...]')
+    x.add_option('-N', '--frames', type='int', help='Number of frames to time per console', default=20)
+    x.add_option('--alloc-frames', type='int', help='Number of further frames to trace allocations over (0 to skip)', default=10)
+    x.add_option('--booster', action='append', help='Booster fixture (name in jb_examples, or path); default all')
+    x.add_option('--replay', type='string', help='Telemetry log to use instead of synthetic telemetry')
+    x.add_option('--background-sims', action='store_true', help='Run sims on a worker thread, as konrad does by default')
+    x.add_option('-f', '--fallover', action='store_true', help='Fall over when exceptions encountered')
+    x.add_option('-o', '--output', type='string', help='File to write results to (default stdout)')
+    opts, args = x.parse_args(argv)
+    names = sorted(konrad.consoles.keys()) + ['xfer']
+    for a in args:
+        if a not in names:
+            x.error("No such consname %s (choose from %s)"%(a, '|'.join(names)))
+    return opts, args or names
+
+if __name__ == '__main__':
+    opts, names = parse_opts()
+    gauge.fallover = opts.fallover
+    if opts.background_sims:
+        gauge.scheduler = simsched.SimScheduler()
+    install_bodies()
+    results = {'rev': git_rev(), 'python': sys.version.split()[0],
+               'matrix': matrix.BACKEND, 'frames': opts.frames,
+               'telemetry': opts.replay or 'synthetic',
+               'sims': 'background' if opts.background_sims else 'sync',
+               'runs': {}}
+    if not opts.booster:
+        results['skipped'] = SKIP_FIXTURES
+    # curses writes to fd 1 whichever way the results go
+    stdout = null_stdout()
+    if opts.output:
+        out = open(opts.output, 'w')
+    else:
+        out = stdout
+    os.environ.setdefault('TERM', 'xterm')
+    curses.initscr()
+    try:
+        gauge.initialise()
+        scr = curses.newwin(24, 80)
+        bench = Bench(scr, opts.frames, opts.alloc_frames)
+        for label, make in runs(opts, names):
+            scr.clear()
+            dl = None
+            try:
+                console, dl = make(scr)
+                results['runs'][label] = bench.run(console, dl)
+            except Exception as e:
+                # e.g. a fixture the booster code can't load; carry on
+                if opts.fallover: raise
+                results['runs'][label] = {'error': '%s: %s'%(e.__class__.__name__, e)}
+            finally:
+                if dl is not None:
+                    dl.disconnect()
+    finally:
+        try:
+            curses.endwin()
+        except curses.error:
+            pass
+    json.dump(results, out, indent=1, sort_keys=True)
+    out.write('\n')
+    out.close()
+    if out is not stdout:
+        stdout.close()
@@ -9,22 +9,14 @@ import cfg
 resid = False # Incorporate 1% propellant residuals into calculations
 
 class Propellant(object):
-    def __init__(self, name, volume, density, mainEngine, filled=None, ratio=None):
+    # Describes a propellant tank; how full it is lives in Booster.fill
+    def __init__(self, name, volume, density, mainEngine, ratio=None):
         self.name = name
         self.volume = volume
-        self.filled = volume if filled is None else filled
         self.density = density
         self.mainEngine = mainEngine
         self.ratio = ratio
-    @classmethod
-    def clone(cls, other):
-        return cls(other.name, other.volume, other.density, other.mainEngine, other.filled)
-    @property
-    def mass(self):
-        return self.filled * self.density
-    @property
-    def full_mass(self):
-        return self.volume * self.density
+        self.full_mass = volume * density
     @property
     def residuals(self): # assume 1% typical; in fact it varies between engines
         return self.full_mass * 0.01 if resid else 0.0
@@ -37,17 +29,18 @@ class Propellant(object):
             d['density'] = known_props[name]
         return cls(name, d['volume'], d['density'], d.get('mainEngine', True), ratio=d.get('ratio'))
 
-class Stage(object):
+class StageSpec(object):
+    # The fixed parts of a Stage, shared between all clones of a Booster
     def __init__(self, props, isp, dry, thrust=None, minThrottle=100.0):
-        self.props = list(props) # list of Propellant instances
+        self.props = tuple(props) # Propellant instances
         check = [p.name for p in props]
         if len(check) != len(set(check)):
             raise Exception("A propellant name was repeated within a stage, we don't like that")
         self.isp = isp # I_sp(Vac) of main engine, in seconds
         self.thrust = thrust # Thrust(Vac) of main engine, in kN.  Optional
         self.minThrottle = minThrottle # Minimum throttle, in %
-        self._dry = dry # stage dry mass, in tons
-        self._load = None
+        self.dry = dry # stage dry mass, in tons
+        self.veff = isp * 9.80665 # effective exhaust velocity, in m/s
         self.mfrac = {}
         full_m = sum(p.full_mass for p in self.props if p.mainEngine)
         full_r = sum(p.ratio * p.density for p in self.props if p.mainEngine and p.ratio is not None)
@@ -57,45 +50,114 @@ class Stage(object):
                 self.mfrac[p.name] = p.ratio * p.density / full_r
             else:
                 self.mfrac[p.name] = p.full_mass / full_m
+        # (index, Propellant, mass fraction) for main-engine propellants
+        self.main = tuple((j, p, self.mfrac[p.name]) for j, p in enumerate(self.props) if p.mainEngine)
+        self.aux = tuple((j, p) for j, p in enumerate(self.props) if not p.mainEngine)
+        self.index = dict((p.name, j) for j, p in enumerate(self.props))
+    def convert_throttle(self, throttle):
+        if throttle is None: return None
+        if throttle == 0: return 0
+        minThrottle = self.minThrottle / 100.0
+        return (throttle * (1.0 - minThrottle)) + minThrottle
     @classmethod
-    def clone(cls, other): # does not clone link to payload!
-        return cls([Propellant.clone(prop) for prop in other.props], other.isp, other._dry, other.thrust, other.minThrottle)
+    def from_dict(cls, d):
+        return cls([Propellant.from_dict(p) for p in d['props']], d['isp'], d['dry'], d.get('thrust'), d.get('minThrottle', 100.0))
+
+class Stage(object):
+    """A view of one stage of a Booster.  Reads and writes the Booster's fill
+    array; everything else comes from the (shared) StageSpec."""
+    def __init__(self, bstr, i):
+        self.booster = bstr
+        self.i = i
+        self.spec = bstr.spec[i]
+        self.base = bstr.offsets[i]
+        self.fill = bstr.fill
+        self._memo = {}
+        self._memo_key = None
+    def _memoised(self, key, fn, *args):
+        # Results only depend on the booster's fill state (and resid), so
+        # cache them until Booster.version changes
+        mkey = (self.booster.version, resid)
+        if mkey != self._memo_key:
+            self._memo = {}
+            self._memo_key = mkey
+        elif key in self._memo:
+            return self._memo[key]
+        v = self._memo[key] = fn(*args)
+        return v
+    @property
+    def props(self):
+        return self.spec.props
+    @property
+    def isp(self):
+        return self.spec.isp
+    @property
+    def thrust(self):
+        return self.spec.thrust
+    @property
+    def minThrottle(self):
+        return self.spec.minThrottle
+    @property
+    def mfrac(self):
+        return self.spec.mfrac
+    @property
+    def veff(self): # effective exhaust velocity, in m/s
+        return self.spec.veff
+    def get_filled(self, propname):
+        return self.fill[self.base + self.spec.index[propname]]
+    def set_filled(self, propname, amt):
+        k = self.base + self.spec.index[propname]
+        if self.fill[k] != amt:
+            self.fill[k] = amt
+            self.booster.version += 1
     @property
     def dry(self):
-        return self._dry + self.load + sum(p.mass for p in self.props if not p.mainEngine)
-    def add_payload(self, load):
-        self._load = load
+        return self._memoised('dry', self._dry)
+    def _dry(self):
+        fill, base = self.fill, self.base
+        return self.spec.dry + self.load + sum(fill[base + j] * p.density for j, p in self.spec.aux)
+    @property
+    def payload(self):
+        bstr = self.booster
+        if self.i + 1 >= len(bstr.spec):
+            return None
+        return bstr.view(self.i + 1)
     @property
     def load(self):
-        if self._load is None:
+        load = self.payload
+        if load is None:
             return 0
-        return self._load.wet
+        return load.wet
     @property
     def twr(self): # thrust to weight ratio, in m/s^2
         if self.thrust is None: return None
         return self.thrust / self.wet
     @property
-    def veff(self): # effective exhaust velocity, in m/s
-        return self.isp * 9.80665
-    @property
     def is_empty(self):
         if self.thrust == 0: return True # Always stage straight past this, it's dead weight
         # Engines generally won't run if <0.01 in the tank
-        return any(p.mass - p.residuals <= 0 for p in self.props if p.mainEngine)
+        fill, base = self.fill, self.base
+        return any(fill[base + j] * p.density - p.residuals <= 0 for j, p, mf in self.spec.main)
     @property
     def prop_mass(self):
-        return sum(p.mass for p in self.props if p.mainEngine)
+        fill, base = self.fill, self.base
+        return sum(fill[base + j] * p.density for j, p, mf in self.spec.main)
     @property
     def wet(self):
+        return self._memoised('wet', self._wet)
+    def _wet(self):
         return self.dry + self.prop_mass
     @property
     def deltaV(self):
+        return self._memoised('deltaV', self._deltaV)
+    def _deltaV(self):
         if self.thrust in (0, None): return 0 # dead weight
         if self.veff in (0, None): return 0 # dead weight
         bt = self.burn_time(1.0)
         mdot = self.thrust / self.veff # tons/s
-        residue = sum((p.filled - mdot * self.mfrac[p.name] * bt / p.density) * p.density
-                      for p in self.props if p.mainEngine)
+        fill, base = self.fill, self.base
+        residue = sum((fill[base + j] - mdot * mf * bt / p.density) * p.density
+                      for j, p, mf in self.spec.main)
         mr = self.wet / (residue + float(self.dry))
         lmr = math.log(mr)
         return self.veff * lmr
@@ -109,9 +171,10 @@ class Stage(object):
         return sum(prop.volume if prop.name == propname else 0 for prop in self.props)
     def prop_above(self, propname):
         """Returns volume of given propellant in all upper stages"""
-        if self._load is None:
+        load = self.payload
+        if load is None:
             return 0
-        return self._load.prop_all(propname)
+        return load.prop_all(propname)
     def prop_all(self, propname):
         """Returns total volume of given propellant in this stage and all upper stages"""
         return self.prop_here(propname) + self.prop_above(propname)
@@ -119,19 +182,66 @@ class Stage(object):
     def propnames(self):
         return [str(p) for p in self.props]
     def burn_time(self, throttle):
+        return self._memoised(('burn_time', throttle), self._burn_time, throttle)
+    def _burn_time(self, throttle):
         if self.thrust is None: return None
         if self.thrust == 0: return 0
         throttle = self.convert_throttle(throttle)
         if throttle is None: return None
         mdot = self.thrust * throttle / self.veff # tons/s
         if mdot <= 0: return None
-        return min((p.filled * p.density - p.residuals) / (mdot * self.mfrac[p.name])
-                   for p in self.props if p.mainEngine)
-    def convert_throttle(self, throttle):
+        fill, base = self.fill, self.base
+        return min((fill[base + j] * p.density - p.residuals) / (mdot * mf)
+                   for j, p, mf in self.spec.main)
+    def mdot(self, throttle):
+        """Propellant mass flow (tons/s) at given throttle"""
+        if self.thrust is None: return None
+        if self.thrust == 0: return 0
+        throttle = self.convert_throttle(throttle)
         if throttle is None: return None
-        if throttle == 0: return 0
-        minThrottle = self.minThrottle / 100.0
-        return (throttle * (1.0 - minThrottle)) + minThrottle
+        return self.thrust * throttle / self.veff
+    def thrust_accel(self, throttle, t=0):
+        """Thrust acceleration (m/s^2) t seconds into a constant-throttle burn"""
+        mdot = self.mdot(throttle)
+        if mdot is None: return None
+        if mdot == 0: return 0
+        return mdot * self.veff / (self.wet - mdot * t)
+    # Closed-form burn at constant throttle.  Within a stage, mass is linear
+    # in t and delta-V follows the rocket equation; t is clamped to the
+    # burn time, so these are exact right up to burnout.
+    def mass_at(self, throttle, t):
+        """Mass (tons) t seconds into a constant-throttle burn"""
+        mdot = self.mdot(throttle)
+        if mdot is None: return None
+        if mdot > 0:
+            t = min(t, self.burn_time(throttle))
+        return self.wet - mdot * t
+    def deltaV_at(self, throttle, t):
+        """Delta-V (m/s) gained t seconds into a constant-throttle burn"""
+        m1 = self.mass_at(throttle, t)
+        if m1 is None: return None
+        return self.veff * math.log(self.wet / m1)
+    def burn(self, throttle, t):
+        """Burn for t seconds (or until burnout, whichever is sooner) and
+        return the delta-V gained.  Unlike simulate() this leaves the
+        limiting tank exactly empty at burnout, so is_empty is reliable."""
+        mdot = self.mdot(throttle)
+        if mdot is None: return None
+        if mdot == 0: return 0
+        bt = self.burn_time(throttle)
+        if t >= bt * (1.0 - 1e-9):
+            # don't leave a few molecules in the tank due to rounding
+            t = bt
+        if t <= 0: return 0
+        m0 = self.wet
+        fill, base = self.fill, self.base
+        for j, p, mf in self.spec.main:
+            floor = p.residuals / p.density
+            fill[base + j] = max(fill[base + j] - mdot * mf * t / p.density, floor)
+        self.booster.version += 1
+        return self.veff * math.log(m0 / self.wet)
+    def convert_throttle(self, throttle):
+        return self.spec.convert_throttle(throttle)
     def simulate(self, throttle, dt):
         if self.thrust is None: return None
         if self.thrust == 0: return 0
@@ -141,41 +251,81 @@ class Stage(object):
         mtot = self.prop_mass
         if mtot <= 0:
             return 0
+        fill, base = self.fill, self.base
         max_dm = dm
-        for p in self.props:
-            if not p.mainEngine: continue
-            need = dm * self.mfrac[p.name] / p.density
-            fr = p.filled - p.residuals
-            if need > p.filled and need > 0:
+        for j, p, mf in self.spec.main:
+            need = dm * mf / p.density
+            filled = fill[base + j]
+            fr = filled - p.residuals
+            if need > filled and need > 0:
                 max_dm = min(max_dm, dm * fr / need)
-        for p in self.props:
-            if not p.mainEngine: continue
-            p.filled -= max_dm * self.mfrac[p.name] / p.density
-        mr = (mtot + self.dry) / self.wet
+        for j, p, mf in self.spec.main:
+            fill[base + j] -= max_dm * mf / p.density
+        self.booster.version += 1
+        dry = self.dry
+        mr = (mtot + dry) / (dry + self.prop_mass)
         lmr = math.log(mr)
         return self.veff * lmr
-    @classmethod
-    def from_dict(cls, d):
-        return cls([Propellant.from_dict(p) for p in d['props']], d['isp'], d['dry'], d.get('thrust'), d.get('minThrottle', 100.0))
 
 class Booster(object):
-    def __init__(self, stages):
-        self.stages = list(stages) # list of Stage instances
-        for i in range(len(self.stages) - 1, 0, -1):
-            self.stages[i - 1].add_payload(self.stages[i])
+    """A rocket, as a list of StageSpecs plus a flat 'fill' array holding
+    the amount of each propellant left; cloning only copies the latter."""
+    def __init__(self, specs, fill=None, first=0):
+        self.spec = tuple(specs)
+        offsets = []
+        n = 0
+        for s in self.spec:
+            offsets.append(n)
+            n += len(s.props)
+        self.offsets = tuple(offsets)
+        if fill is None:
+            fill = [p.volume for s in self.spec for p in s.props]
+        self.fill = list(fill)
+        self.first = first # index of the current (bottom) stage
+        # bumped whenever fill changes, to invalidate Stages' cached results
+        self.version = 0
+        self._views = [None] * len(self.spec)
+        self._stages = None
     @classmethod
     def clone(cls, other):
         if other is None:
             return cls([])
-        return cls([Stage.clone(stage) for stage in other.stages])
+        b = object.__new__(cls)
+        b.spec = other.spec
+        b.offsets = other.offsets
+        b.fill = list(other.fill)
+        b.first = other.first
+        b.version = 0
+        b._views = [None] * len(b.spec)
+        b._stages = None
+        return b
+    def restore(self, other):
+        """Reset fill state to that of other, which must share our spec"""
+        if self.fill != other.fill:
+            self.fill[:] = other.fill
+            self.version += 1
+        self.first = other.first
+        self._stages = None
+    def view(self, i):
+        v = self._views[i]
+        if v is None:
+            v = self._views[i] = Stage(self, i)
+        return v
+    @property
+    def stages(self):
+        # Remaining stages, bottom first
+        if self._stages is None:
+            self._stages = [self.view(i) for i in range(self.first, len(self.spec))]
+        return self._stages
     @property
     def twr(self): # thrust to weight ratio, in m/s^2
         return self.stages[0].twr if self.stages else 0
     def convert_throttle(self, throttle):
         return self.stages[0].convert_throttle(throttle) if self.stages else throttle
     def stage(self):
-        if self.stages:
-            del self.stages[0]
+        if self.first < len(self.spec):
+            self.first += 1
+            self._stages = None
     @property
     def all_props(self):
         # All propellants, sorted by which stage they appear in first
@@ -197,9 +347,34 @@ class Booster(object):
         if self.stages[0].is_empty:
             self.stage()
         return dv
+    def thrust_accel(self, throttle, t=0, stagecap=0):
+        if len(self.stages) <= stagecap or not self.stages: return 0
+        return self.stages[0].thrust_accel(throttle, t)
+    def burnout_time(self, throttle, stagecap=0):
+        """Time until the current stage burns out, or None if it won't"""
+        if len(self.stages) <= stagecap or not self.stages: return None
+        return self.stages[0].burn_time(throttle)
+    def mass_at(self, throttle, t, stagecap=0):
+        """Mass t seconds into the current stage's burn"""
+        if len(self.stages) <= stagecap or not self.stages: return self.wet
+        return self.stages[0].mass_at(throttle, t)
+    def deltaV_at(self, throttle, t, stagecap=0):
+        """Delta-V gained t seconds into the current stage's burn"""
+        if len(self.stages) <= stagecap or not self.stages: return 0
+        return self.stages[0].deltaV_at(throttle, t)
+    def burn(self, throttle, t, stagecap=0):
+        """Closed-form version of simulate(): burns the current stage for t
+        seconds, or up to its burnout_time(), and stages if it burns out.
+        Doesn't carry on into the next stage; callers wanting to should
+        step to burnout_time() and call again."""
+        if len(self.stages) <= stagecap: return 0
+        dv = self.stages[0].burn(throttle, t)
+        if self.stages[0].is_empty:
+            self.stage()
+        return dv
     @classmethod
     def from_dict(cls, d):
-        return cls([Stage.from_dict(s) for s in d])
+        return cls([StageSpec.from_dict(s) for s in d])
     @classmethod
     def from_json(cls, j):
         d = json.loads(j)
@@ -218,6 +393,8 @@ class FakeBooster(object):
         return []
     def stage(self):
         return
+    def restore(self, other):
+        return
     def convert_throttle(self, throttle):
         return throttle
     @property
@@ -225,6 +402,16 @@ class FakeBooster(object):
         return 10000
     def simulate(self, throttle, dt, stagecap=0):
         return dt * 10
+    def thrust_accel(self, throttle, t=0, stagecap=0):
+        return 10
+    def burnout_time(self, throttle, stagecap=0):
+        return None
+    def mass_at(self, throttle, t, stagecap=0):
+        return None
+    def deltaV_at(self, throttle, t, stagecap=0):
+        return t * 10
+    def burn(self, throttle, t, stagecap=0):
+        return t * 10
 
 known_props = {}
 config = cfg.get_default_config()
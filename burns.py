@@ -11,6 +11,7 @@ class ManeuverSim(sim.RocketSim3D):
     burnUT = 0
     burn_dur = -1
     burn_end = -1
+    analytic_arcs = 16 # per stage, for INTEGRATOR_ANALYTIC
     def simulate(self, booster, throttle, pit, hdg, brad, bgm, inc, lan, tan, ape, ecc, sma, reflon=None):
         burnT = self.burnUT - self.UT
         burn_dur = self.burn_dur
@@ -26,9 +27,20 @@ class ManeuverSim(sim.RocketSim3D):
         self.t = burnT
         self.data = {'0': self.encode()}
         self.dt = 0.2 # Use shorter time step for higher accuracy
+        if burn_dur >= 0:
+            self.t_limit = burnT + burn_dur
         if burn_dur == 0:
             self.data['b'] = self.encode()
             return
+        if (self.integrator == self.INTEGRATOR_ANALYTIC and
+            self.act_mode in (self.MODE_INERTIAL, self.MODE_LIVE_INERTIAL)):
+            t_end = burnT + (burn_dur if burn_dur >= 0 else 1200)
+            if self.burn_analytic(t_end):
+                return
+            burnout = len(self.booster.stages) <= self.stagecap
+            if burnout or burn_dur >= 0:
+                self.data['b'] = self.encode()
+            return
         while not ('b' in self.data or self.t > 1200 + burnT):
             if self.step():
                 return
@@ -40,3 +52,92 @@ class ManeuverSim(sim.RocketSim3D):
                 print("time %d"%(self.t,))
                 print("(%g, %g) -> (%g, %g)"%(self.downrange, self.alt, self.hs, self.vs))
                 print("%s"%(''.join(self.data.keys()),))
+    def burn_analytic(self, t_end):
+        # Closed-form burn at fixed inertial attitude, so cost doesn't depend
+        # on burn duration.  Each stage's burn is cut into analytic_arcs arcs,
+        # and each arc is replaced by its rocket-equation impulse, applied at
+        # the time which reproduces the displacement due to thrust (so it's
+        # exact in a uniform field), with Kepler coasts either side.
+        # Returns True if the booster can't be simulated, like step().
+        while self.t < t_end:
+            bt = self.booster.burnout_time(self.throttle, stagecap=self.stagecap)
+            if bt is not None and bt <= 0:
+                self.booster.stage()
+                continue
+            a0 = self.booster.thrust_accel(self.throttle, stagecap=self.stagecap)
+            if a0 is None:
+                return True
+            if a0 == 0:
+                # burnout, which ends the burn here as in step(); or throttle
+                # is zero, so coast out the rest of it
+                if len(self.booster.stages) > self.stagecap:
+                    self.rvec, self.vvec = self.pbody.propagate(self.rvec, self.vvec, t_end - self.t)
+                    self.t = t_end
+                return
+            # end on t1 exactly, or float error can leave us a hair short
+            # of t_end, with arcs too small to advance self.t
+            t1 = t_end
+            if bt is not None and bt < t_end - self.t:
+                t1 = self.t + bt
+            arc = (t1 - self.t) / self.analytic_arcs
+            for i in range(self.analytic_arcs):
+                a0 = self.booster.thrust_accel(self.throttle, stagecap=self.stagecap)
+                a1 = self.booster.thrust_accel(self.throttle, arc, stagecap=self.stagecap)
+                dv = self.booster.burn(self.throttle, arc, stagecap=self.stagecap)
+                if None in (a0, a1, dv):
+                    return True
+                # displacement due to thrust, D = integral of dv(t) over arc.
+                # With m(t) = m0(1 - kt), u = m1/m0 = a0/a1 and k = (1 - u)/arc,
+                # D = a0 arc^2 (u ln u + 1 - u) / (1 - u)^2
+                u = a0 / a1 if a1 else 1.0
+                if 1.0 - u < 1e-6:
+                    disp = a0 * arc * arc / 2.0
+                else:
+                    disp = a0 * arc * arc * (u * math.log(u) + 1.0 - u) / (1.0 - u) ** 2
+                tau = arc - disp / dv if dv > 0 else arc
+                self.rvec, self.vvec = self.pbody.propagate(self.rvec, self.vvec, tau)
+                self.vvec += dv * self.pvec
+                self.rvec, self.vvec = self.pbody.propagate(self.rvec, self.vvec, arc - tau)
+                self.t = t1 if i == self.analytic_arcs - 1 else self.t + arc
+                self.total_dv += dv
+                self.nsteps += 1
+
+if __name__ == '__main__':
+    # Regression tests for burn_analytic: an unlimited burn must stop at
+    # the 1200s timeout (rather than spin forever a rounding error short of
+    # it), and a finite one should end at the same time and place as with
+    # RK45 (to within a few metres), at full or zero throttle.
+    import os
+    import sys
+    import booster
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jb_examples', 'Lander')
+    with open(fn) as f:
+        bj = f.read()
+    # Lander in a 15km circular orbit of the Moon, burning prograde
+    args = (1.0, 0.0, math.pi / 2, 1737100.0, 4.9048695e12, 0.3, 0.2, 0.1, 0.4, 0.0, 1752100.0)
+    failed = 0
+    for burnUT in (0, 100, 123.456, 1e6 + 0.1):
+        s = ManeuverSim(mode=ManeuverSim.MODE_INERTIAL, integrator=ManeuverSim.INTEGRATOR_ANALYTIC)
+        s.burnUT = burnUT
+        s.simulate(booster.Booster.from_json(bj), *args)
+        ok = s.t == burnUT + 1200
+        failed += not ok
+        print("unlimited, burnUT %-10g t %-12.10g %3d arcs%s"%(burnUT, s.t, s.nsteps, '' if ok else '  FAIL'))
+    for throttle in (1.0, 0.0):
+        end = {}
+        for integ in (ManeuverSim.INTEGRATOR_RK45, ManeuverSim.INTEGRATOR_ANALYTIC):
+            s = ManeuverSim(mode=ManeuverSim.MODE_INERTIAL, integrator=integ)
+            s.burnUT = 100
+            s.burn_dur = 300
+            s.simulate(booster.Booster.from_json(bj), throttle, *args[1:])
+            end[integ] = s.data['b']
+        rk, an = end[ManeuverSim.INTEGRATOR_RK45], end[ManeuverSim.INTEGRATOR_ANALYTIC]
+        err = (rk['rvec'] - an['rvec']).mag
+        ok = err < 10.0 and abs(rk['time'] - an['time']) < 1e-6
+        failed += not ok
+        print("300s burn at throttle %g, analytic vs RK45: %.3gm, %.3gs%s"%(throttle, err, an['time'] - rk['time'],
+                                                                           '' if ok else '  FAIL'))
+    if failed:
+        print("%d FAILED"%(failed,))
+        sys.exit(1)
+    print("All OK")
@@ -1,5 +1,9 @@
 #!/usr/bin/python3
+import hashlib
+import marshal
+import mmap
 import os
+import re
 
 def parse(f):
     top = {}
@@ -30,6 +34,63 @@ def parse(f):
         last = line
     return(top)
 
+# A line which is just a brace (and maybe a comment), for skipping subtrees
+# (lastindex is 1 for an open brace, None for a close brace)
+_brace_re = re.compile(rb'\n[ \t\r\f\v]*(?:(\{)|\})[ \t\r\f\v]*(?=\n|//|\Z)')
+
+def parse_selective(buf, want=None):
+    """Like parse(), but on a bytes-like buf (e.g. an mmap), and only keeping
+    the nodes and keys in want (see WANTED for the format).  Unwanted
+    subtrees are skipped by brace-matching, without building anything."""
+    top = {}
+    current = top
+    stack = []
+    last = None
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        nl = buf.find(b'\n', pos)
+        if nl < 0:
+            nl = end
+        line = buf[pos:nl]
+        pos = nl + 1
+        line, _, _ = line.partition(b'//')
+        line = line.strip()
+        if not line: continue
+        if b'=' in line:
+            k, _, v = line.partition(b'=')
+            k = k.strip().decode('utf8', 'replace')
+            if want is None or k in want:
+                current[k] = v.strip().decode('utf8', 'replace')
+            continue
+        if line == b'{':
+            if want is not None and last not in want:
+                depth = 1
+                for m in _brace_re.finditer(buf, pos - 1):
+                    depth += 1 if m.lastindex else -1
+                    if not depth:
+                        pos = buf.find(b'\n', m.end()) + 1 or end
+                        break
+                else:
+                    pos = end
+                last = None
+                continue
+            new = {}
+            if isinstance(current.get(last), str): # same tag used as both foo=bar and foo{}
+                del current[last]
+            current.setdefault(last, []).append(new)
+            stack.append((current, want))
+            current = new
+            if want is not None:
+                want = want[last]
+            continue
+        if line == b'}':
+            current, want = stack.pop()
+            last = None
+            continue
+        last = line.decode('utf8', 'replace')
+    return(top)
+
 _config_cache = {}
 def get_config(fn):
     if fn not in _config_cache:
@@ -40,12 +101,105 @@ def get_config(fn):
             return
     return _config_cache[fn]
 
-def get_default_config():
+# The parts of the ConfigCache that KONRAD actually looks at.  A dict maps
+# node names to the spec for their children; None means keep it all.
+WANTED = {'UrlConfig': {'Kopernicus': {'Epoch': None,
+                                       'Body': {'name': None,
+                                                'cbNameLater': None,
+                                                'Orbit': None,
+                                                'Properties': {'gravParameter': None,
+                                                               'mass': None,
+                                                               'radius': None,
+                                                               },
+                                                },
+                                       },
+                        'RESOURCE_DEFINITION': {'name': None,
+                                                'density': None,
+                                                },
+                        },
+          }
+
+def extract(node, want=WANTED):
+    """Prune a parsed config down to the keys in want"""
+    res = {}
+    for k, sub in want.items():
+        if k not in node:
+            continue
+        v = node[k]
+        if sub is None or isinstance(v, str):
+            res[k] = v
+            continue
+        kids = [extract(c, sub) for c in v]
+        kids = [c for c in kids if c]
+        if kids:
+            res[k] = kids
+    return res
+
+# Bump this if WANTED or the cache layout changes
+CACHE_VERSION = 1
+
+def cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'konrad')
+
+def cache_path(fn):
+    h = hashlib.sha1(os.path.abspath(fn).encode('utf8')).hexdigest()[:16]
+    return os.path.join(cache_dir(), 'cfg-%s.marshal'%(h,))
+
+def get_extract(fn):
+    """Like get_config(fn), but only the parts in WANTED.  These are kept in
+    an on-disk cache keyed on fn's path, mtime and size, so we only have to
+    parse the (potentially huge) file when it changes."""
+    key = ('extract', fn)
+    if key in _config_cache:
+        return _config_cache[key]
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return
+    stamp = (CACHE_VERSION, os.path.abspath(fn), st.st_mtime_ns, st.st_size)
+    cfn = cache_path(fn)
+    try:
+        with open(cfn, 'rb') as f:
+            cstamp, data = marshal.load(f)
+        if cstamp == stamp:
+            _config_cache[key] = data
+            return data
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    try:
+        with open(fn, 'rb') as f:
+            if st.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    data = extract(parse_selective(buf, WANTED))
+            else:
+                data = {}
+    except (IOError, ValueError):
+        return
+    _config_cache[key] = data
+    try:
+        os.makedirs(os.path.dirname(cfn), exist_ok=True)
+        tmp = '%s.%d'%(cfn, os.getpid())
+        with open(tmp, 'wb') as f:
+            marshal.dump((stamp, data), f)
+        os.replace(tmp, cfn)
+    except (IOError, OSError):
+        # Not being able to cache is no reason to stop
+        pass
+    return data
+
+def default_path():
     ksppath = os.environ.get('KSPPATH')
     if ksppath is None:
         return
-    path = os.path.join(ksppath, 'GameData', 'ModuleManager.ConfigCache')
-    return get_config(path)
+    return os.path.join(ksppath, 'GameData', 'ModuleManager.ConfigCache')
+
+def get_default_config():
+    """The WANTED parts of KSP's ModuleManager.ConfigCache, or None"""
+    path = default_path()
+    if path is None:
+        return
+    return get_extract(path)
 
 def fetchall(node, key):
     res = []
@@ -1,8 +1,14 @@
 #!/usr/bin/python3
 
 import websockets.sync.client
+import websockets.asyncio.client
+import asyncio
+import io
 import json
+import re
+import threading
 import time
+import tlog
 
 DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 8085
@@ -13,6 +19,9 @@ class Downlink(object):
         self.uri = "ws://%s:%d/datalink"%(addr, port)
         self.rate = rate
         self.subscriptions = {}
+        # Changes not yet sent to the server, key => True (+) or False (-).
+        # Sent as one message by flush(), just before we next wait for data
+        self.pending = {}
         self.data = {}
         self.logf = logf
         self.reconnect()
@@ -30,7 +39,6 @@ class Downlink(object):
             self.ws = None
             self.data = {}
             return
-        self.set_rate()
         self.resubscribe()
     def disconnect(self):
         if self.ws is not None:
@@ -39,13 +47,16 @@ class Downlink(object):
         self.data = {}
     def log(self, s):
         if not self.logf: return
-        if 'v.missionTime' in self.data:
-            now = self.data['v.missionTime']
-            nowstr = 'T%.3f'%(now,)
+        now = self.data.get('v.missionTime')
+        if now is not None:
+            kind = 'T'
         else:
-            now = time.time()
-            nowstr = 'U%.3f'%(now,)
-        self.logf.write('%s%s\n'%(nowstr, s))
+            kind, now = 'U', time.time()
+        if hasattr(self.logf, 'record'):
+            # binary log (tlog.Writer)
+            self.logf.record(kind, now, s[0], s[2:])
+        else:
+            self.logf.write('%s%.3f%s\n'%(kind, now, s))
     def send_msg(self, d):
         s = json.dumps(d)
         self.log('> ' + s)
@@ -54,8 +65,23 @@ class Downlink(object):
     def set_rate(self):
         self.send_msg({'rate': self.rate})
     def resubscribe(self):
-        for key in self.subscriptions:
-            self._subscribe(key)
+        # Fresh connection; set rate and restore everything in one go
+        msg = {'rate': self.rate}
+        if self.subscriptions:
+            msg['+'] = list(self.subscriptions)
+        self.send_msg(msg)
+    def flush(self):
+        if not self.pending:
+            return
+        msg = {}
+        plus = [k for k, v in self.pending.items() if v]
+        minus = [k for k, v in self.pending.items() if not v]
+        if plus:
+            msg['+'] = plus
+        if minus:
+            msg['-'] = minus
+        self.pending = {}
+        self.send_msg(msg)
     def listen(self):
         msg = '{}'
         for i in range(3):
@@ -79,6 +105,7 @@ class Downlink(object):
         except ValueError: # unparseable JSON, did the link break?
             return {}
     def update(self):
+        self.flush()
         d = self.listen()
         if not d: # Loss of Signal
             self.data = {}
@@ -109,25 +136,217 @@ class Downlink(object):
         self.subscriptions[key] = self.subscriptions.get(key, 0) + 1
         self._subscribe(key)
     def _subscribe(self, key):
-        self.send_msg({'+':[key]})
+        self.pending[key] = True
     def unsubscribe(self, key):
         if self.subscriptions.get(key, 0) > 1:
             self.subscriptions[key] -= 1
         else:
             self.subscriptions.pop(key, None)
             self.data.pop(key, None)
-            self.send_msg({'-':[key]})
+            self.pending[key] = False
     def __del__(self):
         # Make sure we disconnect cleanly, or telemachus gets unhappy
         if getattr(self, 'ws', None) is not None:
             self.disconnect()
 
+class AsyncDownlink(Downlink):
+    """Downlink whose receive loop is an asyncio task, on its own thread.
+
+    Frames are queued as they arrive.  update() doesn't wait on the network,
+    only for the next frame time (so the console still redraws at the
+    requested rate), then applies everything received since the last call;
+    so self.data only changes inside update(), and the console sees a
+    consistent snapshot.  send_msg() hands the message to the loop and
+    returns at once."""
+    def __init__(self, addr, port, rate, logf=None):
+        self.lock = threading.Lock()
+        self.frames = []
+        self.last_frame = None
+        self.last_update = time.time()
+        self.ws = None
+        self.task = None
+        self.closing = False
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='downlink')
+        self.thread.daemon = True
+        self.thread.start()
+        super(AsyncDownlink, self).__init__(addr, port, rate, logf)
+    def reconnect(self):
+        # receive() looks after (re)connecting
+        if self.task is None:
+            self.task = asyncio.run_coroutine_threadsafe(self.receive(), self.loop)
+            # once it's finished, so is the loop
+            self.task.add_done_callback(lambda f: self.loop.call_soon_threadsafe(self.loop.stop))
+    async def receive(self):
+        while not self.closing:
+            try:
+                async with websockets.asyncio.client.connect(self.uri) as ws:
+                    self.ws = ws
+                    self.resubscribe()
+                    async for msg in ws:
+                        self.log('< ' + msg)
+                        try:
+                            d = json.loads(msg)
+                        except ValueError:
+                            continue
+                        with self.lock:
+                            self.frames.append(d)
+                            self.last_frame = time.time()
+            except (OSError, websockets.exceptions.WebSocketException):
+                pass
+            self.ws = None
+            await asyncio.sleep(self.rate / 2000.0)
+    def log(self, s):
+        # Both threads log; tlog.Writer has its own queue, but a text logf
+        # doesn't, so serialise writes
+        with self.lock:
+            super(AsyncDownlink, self).log(s)
+    def subscribe(self, key):
+        with self.lock:
+            super(AsyncDownlink, self).subscribe(key)
+    def unsubscribe(self, key):
+        with self.lock:
+            super(AsyncDownlink, self).unsubscribe(key)
+    def resubscribe(self):
+        # Called on the loop's thread, while the console may be subscribing
+        with self.lock:
+            keys = list(self.subscriptions)
+        msg = {'rate': self.rate}
+        if keys:
+            msg['+'] = keys
+        self.send_msg(msg)
+    async def _send(self, ws, s):
+        try:
+            await ws.send(s)
+        except websockets.exceptions.ConnectionClosed:
+            # we'll resubscribe on reconnect
+            pass
+    def send_msg(self, d):
+        s = json.dumps(d)
+        self.log('> ' + s)
+        ws = self.ws
+        if ws is not None:
+            asyncio.run_coroutine_threadsafe(self._send(ws, s), self.loop)
+    def update(self):
+        self.flush()
+        delay = self.last_update + self.rate / 1000.0 - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.time()
+        self.last_update = now
+        with self.lock:
+            frames, self.frames = self.frames, []
+            last = self.last_frame
+        if last is None or now - last > self.timeout: # Loss of Signal
+            self.data = {}
+        for d in frames:
+            if not d:
+                self.data = {}
+            self.data.update(d)
+        self.update_bodies()
+        return self.data
+    def disconnect(self):
+        self.closing = True
+        ws = self.ws
+        if ws is not None:
+            # Close cleanly, or telemachus gets unhappy
+            try:
+                asyncio.run_coroutine_threadsafe(ws.close(), self.loop).result(timeout=1.0)
+            except Exception:
+                pass
+        if self.task is not None:
+            try:
+                self.task.result(timeout=1.0)
+            except Exception:
+                self.task.cancel()
+            self.task = None
+        self.ws = None
+        self.data = {}
+
 def connect_default(**kwargs):
     return Downlink(kwargs.pop('host', DEFAULT_HOST),
                     kwargs.pop('port', DEFAULT_PORT),
                     kwargs.pop('rate', DEFAULT_RATE),
                     **kwargs)
 
+def connect_async(**kwargs):
+    return AsyncDownlink(kwargs.pop('host', DEFAULT_HOST),
+                         kwargs.pop('port', DEFAULT_PORT),
+                         kwargs.pop('rate', DEFAULT_RATE),
+                         **kwargs)
+
+class ReplayDownlink(Downlink):
+    """Plays back a log written by a Downlink's logf (konrad --log-to),
+    either text or binary (tlog.py); f should be opened in binary mode.
+
+    speed is relative to the recording, e.g. 1.0 for real time, 10.0 for ten
+    times faster; 0 means as fast as possible.  If start is given, playback
+    begins at that mission time.  Frames are paced by their
+    timestamps, which are mission time once that's known (wall-clock before
+    then); gaps are capped at max_gap seconds, so a paused game doesn't
+    stall the replay.  Subscriptions and commands are ignored: you get what
+    was recorded.  At the end of the log, eof is set and we lose signal."""
+    line_re = re.compile(r'([TU])(-?[0-9.]+)([<>]) (.*)$')
+    max_gap = 10.0
+    def __init__(self, f, speed=1.0, rate=DEFAULT_RATE, start=None):
+        self.f = f
+        self.speed = speed
+        self.start = start
+        self.eof = False
+        self.nframes = 0
+        self.last = None # (kind, stamp) of the previous frame
+        self.due = None # wall-clock time the next frame is due
+        self.it = self.frames()
+        super(ReplayDownlink, self).__init__('replay', 0, rate)
+    def reconnect(self):
+        self.ws = None
+    def send_msg(self, d):
+        pass
+    def frames(self):
+        if tlog.is_binary(self.f):
+            for direction, kind, stamp, d in tlog.Reader(self.f).records(self.start):
+                if direction == '<':
+                    yield (kind, stamp, d)
+            return
+        for line in io.TextIOWrapper(self.f):
+            m = self.line_re.match(line.rstrip('\n'))
+            if m is None or m.group(3) != '<':
+                continue
+            kind, stamp = m.group(1), float(m.group(2))
+            if self.start is not None and (kind != 'T' or stamp < self.start):
+                continue
+            try:
+                d = json.loads(m.group(4))
+            except ValueError:
+                d = {}
+            yield (kind, stamp, d)
+    def pace(self, kind, stamp):
+        if self.last is not None and self.last[0] == kind:
+            gap = min(max(stamp - self.last[1], 0), self.max_gap)
+        else:
+            gap = self.rate / 1000.0
+        self.last = (kind, stamp)
+        if not self.speed:
+            return
+        now = time.time()
+        if self.due is None or now - self.due > 1.0:
+            # first frame, or we've fallen well behind; don't try to catch up
+            self.due = now
+        else:
+            self.due += gap / self.speed
+        if self.due > now:
+            time.sleep(self.due - now)
+    def listen(self):
+        if not self.eof:
+            for kind, stamp, d in self.it:
+                self.pace(kind, stamp)
+                self.nframes += 1
+                return d
+            self.eof = True
+        if self.speed:
+            time.sleep(self.rate / 1000.0)
+        return {}
+
 class FakeDownlink(object):
     """A hollow shell that implements the Downlink interface.  Useful for
     testing things without having a Telemachus server to connect to."""
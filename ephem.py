@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+# Precomputed ephemerides: piecewise Chebyshev fits of each body's position
+# relative to its parent, over a span of time.  Once installed, a body's
+# vectors_at_ut() within the span is a few dozen multiply-adds instead of a
+# Kepler solve.  Velocity comes from the derivative of the position fit;
+# heliocentric vectors are the sum down the parent chain.
+#
+# Tables are built by running this file, and saved under the konrad cache
+# directory keyed on a hash of the body set; konrad and xfer pick up the one
+# matching the current ConfigCache, if any.
+#
+# File format (little-endian):
+#   MAGIC key:20s t0:d t1:d nbodies:H
+#   per body: len:H name len:H parent h:d vscale:d nseg:I degree:H
+#             coefficients:d[nseg][3][degree + 1]
+
+import array
+import hashlib
+import math
+import optparse
+import os
+import struct
+import sys
+import cfg
+import matrix
+import orbit
+
+MAGIC = b'KEPHEM1\0'
+_HEAD = struct.Struct('<20sddH')
+_H = struct.Struct('<H')
+_SEG = struct.Struct('<ddIH')
+
+DEGREE = 7
+SEGS_PER_ORBIT = 4
+TOLERANCE = 1.0 # metres
+MAX_SEGS = 1 << 20
+
+def _clenshaw3(c, off, n, x):
+    # sum of c[off+k*n+j] T_j(x) for j < n, for each of k = 0, 1, 2
+    x2 = 2.0 * x
+    a1 = a2 = b1 = b2 = c1 = c2 = 0.0
+    n2 = 2 * n
+    for j in range(off + n - 1, off, -1):
+        a1, a2 = c[j] + x2 * a1 - a2, a1
+        b1, b2 = c[j + n] + x2 * b1 - b2, b1
+        c1, c2 = c[j + n2] + x2 * c1 - c2, c1
+    return (c[off] + x * a1 - a2, c[off + n] + x * b1 - b2, c[off + n2] + x * c1 - c2)
+
+class Table(object):
+    """One body's fit.  Segment i covers [t0 + i*h, t0 + (i+1)*h].
+
+    vscale: orbit.py takes mean motion from the parent's GM alone, but
+    velocity from G(M+m), so its v is the derivative of its r scaled by
+    sqrt((M+m)/M).  We do likewise, to give the same answers"""
+    def __init__(self, name, parent, t0, h, nseg, degree, vscale, coeffs):
+        self.name = name
+        self.parent = parent
+        self.t0 = t0
+        self.h = h
+        self.nseg = nseg
+        self.degree = degree
+        self.vscale = vscale
+        self.coeffs = coeffs
+        self.dcoeffs = self.derivative()
+        self.ekey = None # CelestialBody.ekey the fit is good for; see install()
+    def derivative(self):
+        n = self.degree + 1
+        scale = 2.0 * self.vscale / self.h
+        out = array.array('d', bytes(len(self.coeffs) * 8))
+        for off in range(0, len(self.coeffs), n):
+            c = self.coeffs
+            d1 = d2 = 0.0 # d[j+1], d[j+2]
+            for j in range(n - 1, 0, -1):
+                d = d2 + 2.0 * j * c[off + j]
+                out[off + j - 1] = d * scale
+                d1, d2 = d, d1
+            out[off] *= 0.5
+        return out
+    def vectors_at_ut(self, ut):
+        """(r, v) relative to parent, or None if ut is outside the table"""
+        i = int(math.floor((ut - self.t0) / self.h))
+        if i == self.nseg and ut <= self.t0 + self.nseg * self.h:
+            i -= 1
+        if not 0 <= i < self.nseg:
+            return None
+        x = 2.0 * (ut - self.t0 - i * self.h) / self.h - 1.0
+        n = self.degree + 1
+        off = i * 3 * n
+        return (matrix.Vector3(_clenshaw3(self.coeffs, off, n, x)),
+                matrix.Vector3(_clenshaw3(self.dcoeffs, off, n, x)))
+
+def fit(cb, t0, t1, nseg, degree):
+    """Table for cb over [t0, t1] in nseg segments"""
+    n = degree + 1
+    h = (t1 - t0) / float(nseg)
+    nodes = [math.cos(math.pi * (k + 0.5) / n) for k in range(n)]
+    uts = [t0 + i * h + (x + 1.0) * 0.5 * h for i in range(nseg) for x in nodes]
+    rs, _ = cb.vectors_at_uts(uts)
+    cols = [rs.x, rs.y, rs.z]
+    # cos(pi j (k + 1/2) / n), as T_j(nodes[k])
+    basis = [[2.0 / n * math.cos(math.pi * j * (k + 0.5) / n) for k in range(n)] for j in range(n)]
+    coeffs = array.array('d')
+    for i in range(nseg):
+        for col in cols:
+            f = [float(col[i * n + k]) for k in range(n)]
+            for j in range(n):
+                coeffs.append(sum(b * fk for b, fk in zip(basis[j], f)))
+            coeffs[-n] *= 0.5
+    vscale = math.sqrt((cb.gm + cb.pb.gm) / cb.pb.gm)
+    return Table(cb.name, cb.parent, t0, h, nseg, degree, vscale, coeffs)
+
+def max_error(table, cb, checks=8):
+    """Worst position error (metres) at points between the nodes.  Velocity
+    is not checked; it's good to about the same relative accuracy"""
+    worst = 0.0
+    for i in range(table.nseg):
+        for k in range(checks):
+            ut = table.t0 + (i + (k + 0.5) / checks) * table.h
+            r, _ = table.vectors_at_ut(ut)
+            tr, _ = cb.vectors_at_ut(ut)
+            worst = max(worst, (r - tr).mag)
+    return worst
+
+def fit_body(cb, t0, t1, degree=DEGREE, tol=TOLERANCE):
+    """Fits cb, halving the segments until within tol.  Returns (table,
+    max error)"""
+    period = 2.0 * math.pi / cb.elts['mmo']
+    nseg = max(int(math.ceil((t1 - t0) / period * SEGS_PER_ORBIT)), 1)
+    while True:
+        table = fit(cb, t0, t1, nseg, degree)
+        err = max_error(table, cb)
+        if err <= tol or nseg * 2 > MAX_SEGS:
+            return (table, err)
+        nseg *= 2
+
+class Ephemeris(object):
+    def __init__(self, key, t0, t1, tables):
+        self.key = key
+        self.t0 = t0
+        self.t1 = t1
+        self.tables = tables # name -> Table
+    def vectors_at_ut(self, name, ut):
+        """(r, v) of body name relative to its parent, or None"""
+        table = self.tables.get(name)
+        if table is None:
+            return None
+        return table.vectors_at_ut(ut)
+    def helio_at_ut(self, name, ut):
+        """(r, v) of body name relative to the root body (e.g. Sun), or None"""
+        r = v = matrix.Vector3((0, 0, 0))
+        table = self.tables.get(name)
+        if table is None:
+            return None
+        while table is not None:
+            rv = table.vectors_at_ut(ut)
+            if rv is None:
+                return None
+            r += rv[0]
+            v += rv[1]
+            table = self.tables.get(table.parent)
+        return (r, v)
+    def save(self, fn):
+        with open(fn, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEAD.pack(self.key, self.t0, self.t1, len(self.tables)))
+            for table in self.tables.values():
+                for s in (table.name, table.parent):
+                    b = s.encode('utf8')
+                    f.write(_H.pack(len(b)) + b)
+                f.write(_SEG.pack(table.h, table.vscale, table.nseg, table.degree))
+                coeffs = table.coeffs
+                if sys.byteorder != 'little':
+                    coeffs = array.array('d', coeffs)
+                    coeffs.byteswap()
+                f.write(coeffs.tobytes())
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'rb') as f:
+            buf = f.read()
+        if buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not an ephemeris file"%(fn,))
+        pos = len(MAGIC)
+        key, t0, t1, nbodies = _HEAD.unpack_from(buf, pos)
+        pos += _HEAD.size
+        tables = {}
+        for i in range(nbodies):
+            names = []
+            for j in range(2):
+                n = _H.unpack_from(buf, pos)[0]
+                names.append(buf[pos + 2:pos + 2 + n].decode('utf8'))
+                pos += 2 + n
+            h, vscale, nseg, degree = _SEG.unpack_from(buf, pos)
+            pos += _SEG.size
+            size = nseg * 3 * (degree + 1) * 8
+            coeffs = array.array('d', buf[pos:pos + size])
+            pos += size
+            if sys.byteorder != 'little':
+                coeffs.byteswap()
+            tables[names[0]] = Table(names[0], names[1], t0, h, nseg, degree, vscale, coeffs)
+        return cls(key, t0, t1, tables)
+
+def bodies_key(bodies=None):
+    """sha1 of the body set's names, parents, sizes and elements"""
+    if bodies is None:
+        bodies = orbit.celestial_bodies
+    desc = []
+    for name in sorted(bodies):
+        cb = bodies[name]
+        elts = getattr(cb, 'elts', {}) if cb.parent else {}
+        desc.append((name, cb.parent, cb.rad, cb.gm, sorted(elts.items())))
+    return hashlib.sha1(repr(desc).encode('utf8')).digest()
+
+def build(t0, t1, degree=DEGREE, tol=TOLERANCE, bodies=None, report=None):
+    """Fits every body that orbits something.  report(name, table, err) is
+    called as each is done"""
+    if bodies is None:
+        bodies = orbit.celestial_bodies
+    tables = {}
+    for name in sorted(bodies):
+        cb = bodies[name]
+        if cb.pb is None:
+            continue
+        table, err = fit_body(cb, t0, t1, degree, tol)
+        tables[name] = table
+        if report is not None:
+            report(name, table, err)
+    return Ephemeris(bodies_key(bodies), t0, t1, tables)
+
+def install(eph, bodies=None):
+    """Have bodies' vectors_at_ut() use eph's tables (within its span)"""
+    if bodies is None:
+        bodies = orbit.celestial_bodies
+    for name, table in eph.tables.items():
+        cb = bodies.get(name)
+        if cb is None or cb.pb is None:
+            continue
+        with cb.lock:
+            cb.frame()
+            table.ekey = cb.ekey
+            cb.cheb = table
+
+def default_path(key=None):
+    if key is None:
+        key = bodies_key()
+    return os.path.join(cfg.cache_dir(), 'ephem-%s.bin'%(key.hex()[:16],))
+
+def install_default():
+    """Installs the saved tables for the current ConfigCache, if there are
+    any.  Returns the Ephemeris, or None"""
+    if not orbit.celestial_bodies:
+        return None
+    key = bodies_key()
+    try:
+        eph = Ephemeris.load(default_path(key))
+    except (IOError, ValueError, struct.error):
+        return None
+    if eph.key != key:
+        return None
+    install(eph)
+    return eph
+
+def parse_opts():
+    x = optparse.OptionParser()
+    x.add_option('--start', type='float', help='Start of span, in seconds after the Kopernicus epoch', default=0)
+    x.add_option('--span', type='float', help='Length of span in days', default=365.25)
+    x.add_option('--degree', type='int', help='Degree of the Chebyshev polynomials', default=DEGREE)
+    x.add_option('--tol', type='float', help='Maximum position error in metres', default=TOLERANCE)
+    x.add_option('-o', '--output', type='string', help='File to write (default: in the cache directory, where konrad looks)')
+    opts, args = x.parse_args()
+    return opts
+
+if __name__ == '__main__':
+    opts = parse_opts()
+    if not orbit.celestial_bodies:
+        sys.exit("No bodies; set KSPPATH so the ConfigCache can be found")
+    def report(name, table, err):
+        print("%-12s %7d segments  max error %.3gm"%(name, table.nseg, err))
+    t1 = opts.start + opts.span * 86400.0
+    eph = build(opts.start, t1, opts.degree, opts.tol, report=report)
+    fn = opts.output or default_path(eph.key)
+    os.makedirs(os.path.dirname(os.path.abspath(fn)), exist_ok=True)
+    eph.save(fn)
+    print("Wrote %s (%d bytes)"%(fn, os.path.getsize(fn)))
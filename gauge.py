@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 
+import collections
+import copy
 import curses
 import math
 import matrix
 import booster
 import orbit
+import approach
 from sim import SimulationException
+from time import perf_counter
 
 def initialise():
     register_colours()
@@ -518,11 +522,7 @@ class DeltaHGauge(SIGauge):
         if None in (lat, lon, self.ground_map):
             ground_alt = self.ground_alt
         else:
-            mlat = int(round(lat * 2))
-            mlon = int(round(lon * 2)) % 720
-            if mlon >= 360: mlon -= 720
-            elif mlon < -360: mlon += 720
-            ground_alt = self.ground_map[mlon][mlat]
+            ground_alt = self.ground_map.height(lat, lon)
         if None in (ground_alt, th):
             dh = None
         else:
@@ -1189,7 +1189,7 @@ class UpdateBooster(Gauge):
             self.add_prop('%s_max'%(p,), 'r.resourceMax[%s]'%(p,))
     def reset(self):
         if self.booster is not None:
-            self.booster.stages = booster.Booster.clone(self.init_booster).stages
+            self.booster.restore(self.init_booster)
     def draw(self):
         # we don't actually draw anything...
         # we just do some calculations!
@@ -1209,8 +1209,9 @@ class UpdateBooster(Gauge):
             for s in reversed(self.booster.stages):
                 prop = s.this_prop(p)
                 if prop is not None:
-                    prop.filled = min(amt, prop.volume)
-                    amt -= prop.filled
+                    filled = min(amt, prop.volume)
+                    s.set_filled(p, filled)
+                    amt -= filled
         if has_staged:
             return "Booster staged (%s)"%(has_staged,)
 
@@ -1303,7 +1304,47 @@ class TWRGauge(OneLineGauge):
             prec = min(3, width - 3)
             self.addstr('%s:%+*.*f'%(self.label, width, prec, twr))
 
-class UpdateRocketSim(Gauge):
+# A simsched.SimScheduler to run sims on, or None to run them inside draw()
+scheduler = None
+
+class BackgroundSimMixin(object):
+    # For gauges which run a sim.  run_sim() runs a job (a copy of self.sim,
+    # set up with self.shadow(), and a function to run on it), then copies
+    # the results back onto self.sim with publish().  With a scheduler, the
+    # job goes to the worker, and what's published is the latest one that
+    # has finished; sim.age says how stale its telemetry is.
+    published = ('data', 'pbody', 'dt', 'UT', 'nsteps')
+    def shadow(self):
+        return copy.copy(self.sim)
+    def publish(self, sim, shadow, age):
+        for k in self.published:
+            if hasattr(shadow, k):
+                setattr(sim, k, getattr(shadow, k))
+        sim.age = age
+    def steps(self):
+        """Step count of the last sim to be published, or None"""
+        return getattr(self.sim, 'nsteps', None)
+    def run_sim(self, fn, *args):
+        shadow = self.shadow()
+        if scheduler is None:
+            self.publish(self.sim, fn(shadow, *args), 0.0)
+            return
+        scheduler.submit(self, fn, shadow, *args)
+        r = scheduler.result(self)
+        if r is None:
+            self.sim.data = {}
+            self.sim.age = None
+        else:
+            self.publish(self.sim, *r)
+
+def _simulate(sim, *args):
+    try:
+        sim.simulate(*args)
+    except SimulationException:
+        pass
+    return sim
+
+class UpdateRocketSim(Gauge, BackgroundSimMixin):
     def __init__(self, dl, cw, body, booster, use_throttle, use_orbital, sim):
         super(UpdateRocketSim, self).__init__(dl, cw)
         self.booster = booster
@@ -1335,6 +1376,12 @@ class UpdateRocketSim(Gauge):
     def draw(self):
         # we don't actually draw anything...
         # we just do some calculations!
+        args = self.sim_args()
+        if args is None:
+            self.sim.data = {}
+        else:
+            self.run_sim(_simulate, booster.Booster.clone(self.booster), *args)
+    def sim_args(self):
         vs = self.get('vs')
         if self.use_orbital:
             # Compute hs by pythagoras
@@ -1361,11 +1408,39 @@ class UpdateRocketSim(Gauge):
         brad = self.get('brad')
         bgm = self.get('bgm')
         if None in (hs, vs, alt, throttle, pit, hdg, lat, lon, brad, bgm):
-            self.sim.data = {}
-        else:
-            self.sim.simulate(self.booster, hs, vs, alt, throttle, pit, hdg, lat, lon, brad, bgm)
-
-class UpdateRocketSim3D(Gauge):
+            return None
+        return (hs, vs, alt, throttle, pit, hdg, lat, lon, brad, bgm)
+
+class UpdateRocketSimBatch(UpdateRocketSim):
+    # Drives a RocketSimBatch; throttles has one entry per scenario, with
+    # None meaning the current throttle
+    def __init__(self, dl, cw, body, booster, throttles, use_orbital, batch):
+        super(UpdateRocketSimBatch, self).__init__(dl, cw, body, booster, False, use_orbital, batch)
+        self.throttles = throttles
+        if None in throttles:
+            self.add_prop('throttle', 'f.throttle')
+    def shadow(self):
+        return self.sim.__class__([copy.copy(s) for s in self.sim.sims])
+    def publish(self, batch, shadow, age):
+        for s, ss in zip(batch.sims, shadow.sims):
+            super(UpdateRocketSimBatch, self).publish(s, ss, age)
+    def steps(self):
+        # the sims step together
+        return max(getattr(s, 'nsteps', None) or 0 for s in self.sim.sims) or None
+    def draw(self):
+        args = self.sim_args()
+        if args is None:
+            for s in self.sim.sims:
+                s.data = {}
+            return
+        (hs, vs, alt, throttle, pit, hdg, lat, lon, brad, bgm) = args
+        # a scenario with no throttle (we don't know the current one) is
+        # skipped by the batch
+        current = self.get('throttle') if None in self.throttles else None
+        throttles = [current if th is None else th for th in self.throttles]
+        self.run_sim(_simulate, booster.Booster.clone(self.booster), hs, vs, alt, throttles, pit, hdg, lat, lon, brad, bgm)
+
+class UpdateRocketSim3D(Gauge, BackgroundSimMixin):
     def __init__(self, dl, cw, body, booster, use_throttle, sim, want=None):
         super(UpdateRocketSim3D, self).__init__(dl, cw)
         self.booster = booster
@@ -1433,10 +1508,8 @@ class UpdateRocketSim3D(Gauge):
         else:
             self.sim.force_ground_alt = None
         if None not in (throttle, pit, hdg, brad, bgm, inc, lan, tan, ape, ecc, sma):
-            try:
-                self.sim.simulate(self.booster, throttle, pit, hdg, brad, bgm, inc, lan, tan, ape, ecc, sma, reflon=lon)
-            except SimulationException:
-                pass
+            bstr = self.booster.__class__.clone(self.booster)
+            self.run_sim(_simulate, bstr, throttle, pit, hdg, brad, bgm, inc, lan, tan, ape, ecc, sma, lon)
 
 class UpdateManeuverSim(UpdateRocketSim3D):
     def __init__(self, *args, **kwargs):
@@ -1677,8 +1750,8 @@ class UpdateTgtProximity(Gauge):
             if tecc is None:
                 continue
             # target eccentric anomalies
-            te0 = orbit.ean_from_man(tma0, tecc, 6)
-            te1 = orbit.ean_from_man(tma1, tecc, 6)
+            te0 = orbit.ean_from_man(tma0, tecc, 16)
+            te1 = orbit.ean_from_man(tma1, tecc, 16)
             # target true anomalies
             tr0 = orbit.tan_from_ean(te0, tecc)
             tr1 = orbit.tan_from_ean(te1, tecc)
@@ -1803,8 +1876,13 @@ class UpdateTgtRI(Gauge):
             self.sim.data[key]['ri'] = ri
 
 class UpdateTgtCloseApproach(UpdateEventXform):
-    # Finds close(st?) approach to target
-    COARSE_STEPS = 80
+    # Finds close(st?) approach to target, over SEARCH_REVS orbits of the
+    # slower body.  Every local minimum is kept in 'approaches' (see
+    # approach.py); the event itself is the closest one that isn't just an
+    # end of the window.  COARSE_STEPS is samples per orbit; the scan is one
+    # batched pass, so with numpy it can afford to be much finer.
+    SEARCH_REVS = 3
+    COARSE_STEPS = 2000 if approach.numpy is not None else 200
     FINE_ITERS = 24
     def __init__(self, dl, cw, sim, tgt, frm, to):
         super(UpdateTgtCloseApproach, self).__init__(dl, cw, sim, frm, to)
@@ -1884,90 +1962,65 @@ class UpdateTgtCloseApproach(UpdateEventXform):
         tmmo = tcb.elts['mmo']
         if None in (mmo, tmmo):
             return
-        per = 2.0 * math.pi / mmo
-        tper = 2.0 * math.pi / tmmo
-        search = max(per, tper) # search for 1 orbit of the slower body
-        man0 = self.sim_get('man')
-        sma = self.sim_get('sma')
-        ecc = self.sim_get('ecc')
-        ape = self.sim_get('ape')
-        inc = self.sim_get('inc')
-        lan = self.sim_get('lan')
-        if None in (man0, sma, ecc, ape, inc, lan):
+        elts = dict((k, self.sim_get(k)) for k in ['man', 'sma', 'ecc', 'ape', 'inc', 'lan', 'mmo'])
+        if None in elts.values():
             return
-        mind = None
-        argmind = None
-        # Let's find the rough region first
-        for i in range(self.COARSE_STEPS):
-            it = i * search / float(self.COARSE_STEPS)
-            t = time + it
-            ut = ut1 + it
-            man = man0 + it * mmo
-            ean = orbit.ean_from_man(man, ecc, 16)
-            r, v = pcb.compute_3d_vector(sma, ecc, ean, ape, inc, lan)
-            tr, tv = tcb.vectors_at_ut(ut)
-            d = (tr - r).mag
-            if mind is None or d < mind:
-                mind = d
-                argmind = it
-        if argmind is None:
+        args = (tcb, pcb, time, ut1, tmmo, elts)
+        if scheduler is None:
+            self.sim.data[self.to] = self.search(*args)
             return
-        dt = argmind
-        self.sim_set['rough'] = time + dt
-        # Now we Newton it in
-        last_step_size = None
-        for i in range(self.FINE_ITERS):
-            t = time + dt
-            ut = ut1 + dt
-            man = man0 + dt * mmo
-            ean = orbit.ean_from_man(man, ecc, 16)
-            r, v = pcb.compute_3d_vector(sma, ecc, ean, ape, inc, lan)
-            tr, tv = tcb.vectors_at_ut(ut)
-            dr = tr - r
-            dv = tv - v
-            # Solve closest approach of x = dr + w dv to 0
-            # at that point, x . dv = 0
-            # but x . dv = (dr + w dv) . dv = dr . dv + w dv . dv
-            drdv = dr.dot(dv)
-            dvdv = dv.dot(dv)
-            if dvdv == 0:
-                # we're at rest relative to the target.  Let's give up :'(
-                return
-            w = -drdv / dvdv
-            if last_step_size is not None and abs(w) > 1.2 * last_step_size:
-                # our step size just got bigger, we're probably diverging
-                # this is another of those 'give up' situations, isn't it?
-                return
-            last_step_size = abs(w)
-            dt += w
-            if abs(w) < 1.0:
-                # We got within a second.  That's probably good enough
-                break
-        self.sim_set['lss'] = last_step_size
-        self.sim_set['time'] = t
+        scheduler.submit(self, self.search, *args)
+        r = scheduler.result(self)
+        if r is not None:
+            out, age = r
+            self.sim.data[self.to] = dict(out, age=age)
+    def search(self, tcb, pcb, time, ut1, tmmo, elts):
+        # Returns the event dict for self.to; may run on the scheduler's
+        # worker, so mustn't touch self.sim
+        out = {}
+        per = 2.0 * math.pi / elts['mmo']
+        tper = 2.0 * math.pi / tmmo
+        window = self.SEARCH_REVS * max(per, tper)
+        traj = approach.Trajectory(tcb, pcb, ut1, elts)
+        found = approach.find_approaches(traj, window, self.COARSE_STEPS * self.SEARCH_REVS,
+                                         maxiter=self.FINE_ITERS)
+        out['approaches'] = found
+        if not found:
+            out['status'] = 'none'
+            return out
+        best = ([m for m in found if not m['edge']] or found)[0]
+        out['status'] = 'ok' if best['converged'] else 'unconverged'
+        out['iters'] = best['iters']
+        out['lss'] = best['width'] / 2.0
+        dt = best['dt']
+        man, ean, r, v, tr, tv = traj.state(dt)
+        ut = ut1 + dt
+        dr = tr - r
+        dv = tv - v
+        out['time'] = time + dt
         # copy orbital parameters
-        self.sim_set['man'] = man
-        self.sim_set['ean'] = ean
-        for k in ['sma', 'ecc', 'ape', 'inc', 'lan', 'mmo']:
-            self.sim_set[k] = self.sim_get(k)
+        out.update(elts)
+        out['man'] = man
+        out['ean'] = ean
         # vectors
-        self.sim_set['rvec'] = r
-        self.sim_set['vvec'] = v
-        self.sim_set['trvec'] = tr
-        self.sim_set['tvvec'] = tv
-        self.sim_set['drvec'] = dr
-        self.sim_set['dvvec'] = dv
+        out['rvec'] = r
+        out['vvec'] = v
+        out['trvec'] = tr
+        out['tvvec'] = tv
+        out['drvec'] = dr
+        out['dvvec'] = dv
         # find distance to Earth (for comms range)
         ecb = orbit.celestial_bodies.get('Earth', orbit.celestial_bodies.get('Kerbin'))
         if ecb is None:
-            return
+            return out
         if ecb.name == tcb.parent:
-            self.sim_set['edrvec'] = r
+            out['edrvec'] = r
         else:
             er, _ = ecb.vectors_at_ut(ut)
-            self.sim_set['ervec'] = er
+            out['ervec'] = er
             edr = r - er
-            self.sim_set['edrvec'] = edr
+            out['edrvec'] = edr
+        return out
 
 class UpdateSoiEntry(UpdateEventXform):
     """Patches into target SOI.  Input event should be close approach"""
@@ -2117,6 +2170,47 @@ class RSTime(OneLineGauge, TimeFormatterMixin):
                 col = 3
         self.chgat(0, self.width, curses.color_pair(col))
 
+class RSAge(OneLineGauge):
+    # How old the telemetry behind the displayed sim results is
+    stale = 2.0 # seconds
+    def __init__(self, dl, cw, sim):
+        super(RSAge, self).__init__(dl, cw)
+        self.sim = sim
+    def draw(self):
+        super(RSAge, self).draw()
+        age = getattr(self.sim, 'age', None)
+        if age is None:
+            self.addstr(self.centext('Age: ---'))
+            col = 2
+        else:
+            if age < 10:
+                self.addstr('Age:%*.1fs'%(self.olg_width - 5, age))
+            else:
+                self.addstr('Age:%*ds'%(self.olg_width - 5, age))
+            col = 1 if age > self.stale else 0
+        self.chgat(0, self.width, curses.color_pair(col))
+
+class RSApproaches(OneLineGauge):
+    # Close-approach search diagnostics: minima found, and whether the one
+    # shown converged
+    def __init__(self, dl, cw, key, sim):
+        super(RSApproaches, self).__init__(dl, cw)
+        self.sim = sim
+        self.key = key
+    def draw(self):
+        super(RSApproaches, self).draw()
+        data = self.sim.data.get(self.key, {})
+        status = data.get('status')
+        if status is None:
+            self.addstr('n' + '-' * (self.olg_width - 1))
+            col = 2
+        else:
+            text = {'ok': 'ok', 'unconverged': 'UNCONV', 'none': 'NONE'}.get(status, status)
+            n = len(data.get('approaches', ()))
+            self.addstr('n:%-3d%*s'%(n, self.olg_width - 5, text))
+            col = 3 if status == 'ok' else 1
+        self.chgat(0, self.width, curses.color_pair(col))
+
 class RSAlt(SIGauge):
     unit = 'm'
     label = 'Y'
@@ -2406,11 +2500,92 @@ class RSLongitude(RSLatitude):
 
 global fallover
 
+class Profiler(object):
+    """Rolling draw() + post_draw() times per gauge class, over the last
+    window frames.  GaugeGroups report to it while gauge.profiler is set;
+    the console marks the frames."""
+    window = 50
+    def __init__(self):
+        self.work = collections.deque(maxlen=self.window) # drawing, per frame
+        self.period = collections.deque(maxlen=self.window) # frame to frame
+        self.stats = {} # class name => deque of per-frame totals
+        self.steps = {} # class name => last sim step count
+        self.seen = {} # class name => last frame it drew in
+        self.frame = 0
+        self.current = {}
+        self.t0 = None
+    def start_frame(self):
+        t = perf_counter()
+        if self.t0 is not None:
+            self.period.append(t - self.t0)
+        self.t0 = t
+        self.current = {}
+    def end_frame(self):
+        if self.t0 is None:
+            return
+        self.work.append(perf_counter() - self.t0)
+        self.frame += 1
+        for name, dt in self.current.items():
+            if name not in self.stats:
+                self.stats[name] = collections.deque(maxlen=self.window)
+            self.stats[name].append(dt)
+            self.seen[name] = self.frame
+        # forget classes that have gone away, e.g. with a console switch
+        for name in [k for k, f in self.seen.items() if self.frame - f >= self.window]:
+            del self.seen[name]
+            self.stats.pop(name, None)
+            self.steps.pop(name, None)
+    def add(self, g, dt):
+        if isinstance(g, GaugeGroup):
+            return # its gauges are counted themselves
+        name = g.__class__.__name__
+        self.current[name] = self.current.get(name, 0) + dt
+        if isinstance(g, BackgroundSimMixin):
+            self.steps[name] = g.steps()
+    @classmethod
+    def mean(cls, samples):
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+    def slowest(self, n):
+        """[(mean seconds, class name)], slowest first"""
+        means = [(self.mean(v), k) for k, v in self.stats.items()]
+        return sorted(means, reverse=True)[:n]
+
+# A Profiler to report draw times to, or None
+profiler = None
+
+class ProfileGauge(Gauge):
+    """Frame profiler overlay: frame time, then the slowest gauge classes
+    (with sim step counts where they run a sim)"""
+    def draw(self):
+        super(ProfileGauge, self).draw()
+        self.cw.addstr(0, 1, 'Profile'[:self.width - 2])
+        if profiler is None:
+            return
+        w = self.width - 2
+        work = profiler.mean(profiler.work)
+        period = profiler.mean(profiler.period)
+        if work is not None:
+            line = 'Frame %6.1fms max %6.1f'%(work * 1e3, max(profiler.work) * 1e3)
+            self.cw.addnstr(1, 1, line, w)
+        if period is not None:
+            self.cw.addnstr(2, 1, 'Period%6.1fms (%.1f/s)'%(period * 1e3, 1.0 / period), w)
+        self.cw.addnstr(3, 1, '%-*s%7s%6s'%(w - 13, 'Gauge', 'ms', 'steps'), w, curses.A_BOLD)
+        for i, (t, name) in enumerate(profiler.slowest(self.height - 5)):
+            steps = profiler.steps.get(name)
+            line = '%-*.*s%7.2f'%(w - 13, w - 13, name, t * 1e3)
+            if steps is not None:
+                line += '%6d'%(steps,)
+            self.cw.addnstr(4 + i, 1, line, w)
+
 class GaugeGroup(object):
     def __init__(self, cw, gl, title):
         self.cw = cw
         self.gl = gl
         self.title = title
+        # how long each of gl took to draw, last time (in seconds)
+        self.times = [0.0] * len(gl)
     def changeopt(self, cls, **kwargs):
         for g in self.gl:
             g.changeopt(cls, **kwargs)
@@ -2423,7 +2598,9 @@ class GaugeGroup(object):
             mid = (width - len(title)) // 2
             self.cw.addstr(0, mid, title)
         messages = []
+        times = []
         for g in self.gl:
+            t0 = perf_counter()
             try:
                 m = g.draw()
                 if m is not None:
@@ -2439,10 +2616,20 @@ class GaugeGroup(object):
             except Exception as e:
                 messages.append("telerr in " + g.__class__.__name__)
                 if fallover: raise
+            finally:
+                times.append(perf_counter() - t0)
+                if profiler is not None:
+                    profiler.add(g, times[-1])
+        self.times = times
         return messages
     def post_draw(self):
         for g in self.gl:
+            if profiler is None:
+                g.post_draw()
+                continue
+            t0 = perf_counter()
             g.post_draw()
+            profiler.add(g, perf_counter() - t0)
         self.cw.noutrefresh()
 
 if __name__ == '__main__':
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+# Terrain height maps, from SCANsat CSV exports
+
+import array
+import csv
+import math
+import mmap
+import os
+import struct
+import sys
+import matrix
+
+if matrix.BACKEND == 'numpy':
+    import numpy
+else:
+    numpy = None
+
+class GroundMap(object):
+    """Terrain heights on a regular lat/long grid, res cells per degree.
+
+    Cell indices are as in the SCANsat export, i.e. lat * res and
+    long * res.  Heights are held in a flat float array, long-major;
+    cells missing from the export are NaN.
+
+    height() interpolates bilinearly between cells.  ceiling() gives an
+    upper bound on height() over a block of cells, from a table of block
+    maxima, so callers well above the terrain can skip the exact lookup.
+    The table is built when a map is loaded, and kept in the .gmap file."""
+    MAGIC = b'KGMAP2' + (b'LE' if sys.byteorder == 'little' else b'BE')
+    HEADER = struct.Struct('=8sII') # magic, res, ceiling_level
+    def __init__(self, res, data=None):
+        self.res = res
+        # indices run from -180*res to +180*res inclusive, and likewise lat
+        self.nlon = 360 * res + 1
+        self.nlat = 180 * res + 1
+        if data is None:
+            data = array.array('f', [float('nan')]) * (self.nlon * self.nlat)
+        self.data = data
+        self._ceiling = None # see _build_ceiling()
+    # size of the blocks used by ceiling(), as log2(cells)
+    ceiling_level = 3
+    def _index(self, mlon, mlat):
+        return (mlon + 180 * self.res) * self.nlat + mlat + 90 * self.res
+    def cell(self, mlon, mlat):
+        h = self.data[self._index(mlon, mlat)]
+        if h != h: # NaN, no data
+            raise KeyError((mlon, mlat))
+        return h
+    def set_cell(self, mlon, mlat, h):
+        self.data[self._index(mlon, mlat)] = h
+    def _locate(self, lat, lon):
+        # Cell (X, Y) in array co-ordinates, i.e. offset so they start at 0,
+        # and fractions (fx, fy) of the way towards (X + 1, Y + 1).  Long
+        # wraps around; lat clamps to the last row of SCANsat data (which
+        # stops half a cell short of the north pole).
+        res = self.res
+        x = (lon + 180) * res % (360 * res)
+        X = int(x)
+        fx = x - X
+        X %= 360 * res # in case of rounding
+        y = (min(max(lat, -90), 90 - 1.0 / res) + 90) * res
+        Y = int(y)
+        if Y > 180 * res - 2:
+            Y = 180 * res - 2
+        return (X, Y, fx, y - Y)
+    def height(self, lat, lon):
+        """Terrain height at lat, lon (in degrees), bilinearly interpolated"""
+        X, Y, fx, fy = self._locate(lat, lon)
+        data = self.data
+        nlat = self.nlat
+        i0 = X * nlat + Y
+        i1 = ((X + 1) % (360 * self.res)) * nlat + Y
+        a, b, c, d = data[i0], data[i1], data[i0 + 1], data[i1 + 1]
+        h = (a * (1 - fx) + b * fx) * (1 - fy) + (c * (1 - fx) + d * fx) * fy
+        if h == h:
+            return h
+        # Some cells are missing; use the ones we have
+        ws = ((a, (1 - fx) * (1 - fy)), (b, fx * (1 - fy)),
+              (c, (1 - fx) * fy), (d, fx * fy))
+        ws = [(v, w) for v, w in ws if v == v]
+        wt = sum(w for v, w in ws)
+        if not ws or not wt:
+            raise KeyError((lat, lon))
+        return sum(v * w for v, w in ws) / wt
+    def heights(self, lats, lons):
+        """height() for sequences of points.  Vectorised if the numpy backend
+        is in use (see matrix.py).  Points with no data in any of their four
+        cells, where height() raises KeyError, give NaN (i.e. no ground)"""
+        if numpy is None:
+            out = []
+            for lat, lon in zip(lats, lons):
+                try:
+                    out.append(self.height(lat, lon))
+                except KeyError:
+                    out.append(float('nan'))
+            return out
+        res = self.res
+        data = numpy.frombuffer(self.data, dtype=numpy.float32)
+        y = numpy.clip(numpy.asarray(lats, dtype=float) * res, -90 * res, 90 * res - 1)
+        y0 = numpy.minimum(numpy.floor(y), 90 * res - 2)
+        fy = y - y0
+        x = numpy.asarray(lons, dtype=float) * res
+        x0 = numpy.floor(x)
+        fx = x - x0
+        X = ((x0 + 180 * res) % (360 * res)).astype(int)
+        Y = (y0 + 90 * res).astype(int)
+        i0 = X * self.nlat + Y
+        i1 = ((X + 1) % (360 * res)) * self.nlat + Y
+        a, b, c, d = (data[i].astype(float) for i in (i0, i1, i0 + 1, i1 + 1))
+        h = (a * (1 - fx) + b * fx) * (1 - fy) + (c * (1 - fx) + d * fx) * fy
+        miss = numpy.isnan(h)
+        if miss.any():
+            # as height(): weight by whichever corners we have
+            vs = numpy.array((a[miss], b[miss], c[miss], d[miss]))
+            fx, fy = fx[miss], fy[miss]
+            ws = numpy.array(((1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy))
+            have = ~numpy.isnan(vs)
+            wt = numpy.where(have, ws, 0).sum(axis=0)
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                h[miss] = numpy.where(have, vs * ws, 0).sum(axis=0) / numpy.where(wt > 0, wt, numpy.nan)
+        return h
+    def _ceiling_shape(self):
+        B = 1 << self.ceiling_level
+        return ((360 * self.res + B - 1) // B, (self.nlat - 2) // B + 1)
+    def _build_ceiling(self):
+        # For each block of 2^ceiling_level cells square, the max of every
+        # cell height() might interpolate between from within it, i.e. one
+        # more each way (with long wrapping).  Missing cells count as -inf.
+        # Flat float array, block (bx, by) at bx * nby + by.
+        B = 1 << self.ceiling_level
+        nx = 360 * self.res
+        nlat = self.nlat
+        nbx, nby = self._ceiling_shape()
+        ninf = float('-inf')
+        if numpy is not None:
+            d = numpy.frombuffer(self.data, dtype=numpy.float32)[:nx * nlat].reshape(nx, nlat)
+            d = numpy.where(numpy.isnan(d), ninf, d)
+            # max over X..X+1 and Y..Y+1, then over blocks
+            d = numpy.maximum(d, numpy.roll(d, -1, axis=0))
+            d = numpy.maximum(d[:, :-1], d[:, 1:])
+            pad = numpy.full((nbx * B, nby * B), ninf, dtype=numpy.float32)
+            pad[:nx, :nlat - 1] = d
+            blocks = pad.reshape(nbx, B, nby, B).max(axis=(1, 3))
+            self._ceiling = array.array('f', blocks.tobytes())
+            self._ceiling_nby = nby
+            return
+        cols = []
+        for X in range(nx):
+            col = self.data[X * nlat:(X + 1) * nlat]
+            if any(map(math.isnan, col)):
+                col = [v if v == v else ninf for v in col]
+            # rows Y..Y+B, for each block's Y
+            cols.append([max(col[Y:Y + B + 1]) for Y in range(0, nlat - 1, B)])
+        out = array.array('f')
+        for bx in range(nbx):
+            # B columns of the block, and the first of the next
+            out.extend(map(max, *[cols[X % nx] for X in range(bx * B, bx * B + B + 1)]))
+        self._ceiling = out
+        self._ceiling_nby = nby
+    def ceiling(self, lat, lon):
+        """An upper bound for height() near lat, lon: the highest terrain in
+        the block (of 2^ceiling_level cells square) containing that point"""
+        if self._ceiling is None:
+            self._build_ceiling()
+        res = self.res
+        X = int((lon + 180) * res % (360 * res)) % (360 * res)
+        Y = min(int((min(max(lat, -90), 90) + 90) * res), 180 * res - 2)
+        L = self.ceiling_level
+        return self._ceiling[(X >> L) * self._ceiling_nby + (Y >> L)]
+    @classmethod
+    def detect_res(cls, rows):
+        # Cells per degree, from the smallest step in longitude
+        lons = sorted(set(r[1] for r in rows[:100000]))
+        step = min((b - a for a, b in zip(lons, lons[1:]) if b > a), default=0.5)
+        return max(1, int(round(1.0 / step)))
+    @classmethod
+    def from_csv(cls, f, res=None):
+        """Load a SCANsat CSV export.  If res isn't given, it's worked out
+        from the spacing of the data"""
+        rows = []
+        map_csv = csv.reader(f)
+        for i,row in enumerate(map_csv):
+            if not i:
+                assert row == ['Row','Column','Lat','Long','Height'], row
+                continue
+            rows.append((float(row[2]), float(row[3]), float(row[4])))
+        if res is None:
+            res = cls.detect_res(rows)
+        gm = cls(res)
+        for lat, lon, alt in rows:
+            gm.set_cell(int(round(lon * res)), int(round(lat * res)), alt)
+        gm._build_ceiling()
+        return gm
+    def save(self, fn):
+        tmp = '%s.%d'%(fn, os.getpid())
+        with open(tmp, 'wb') as f:
+            if self._ceiling is None:
+                self._build_ceiling()
+            f.write(self.HEADER.pack(self.MAGIC, self.res, self.ceiling_level))
+            f.write(array.array('f', self.data).tobytes())
+            f.write(self._ceiling.tobytes())
+        os.replace(tmp, fn)
+    @classmethod
+    def load(cls, fn):
+        """Memory-map a .gmap file written by save()"""
+        with open(fn, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        hlen = cls.HEADER.size
+        magic, res, level = cls.HEADER.unpack(mm[:hlen])
+        if magic != cls.MAGIC:
+            raise ValueError("Not a .gmap file (or wrong version or byte order)", fn)
+        floats = memoryview(mm)[hlen:].cast('f')
+        gm = cls(res, floats[:(360 * res + 1) * (180 * res + 1)])
+        gm.ceiling_level = level
+        gm._ceiling = floats[len(gm.data):]
+        nbx, gm._ceiling_nby = gm._ceiling_shape()
+        if len(gm.data) != gm.nlon * gm.nlat or len(gm._ceiling) != nbx * gm._ceiling_nby:
+            raise ValueError("Truncated .gmap file", fn)
+        return gm
+    @classmethod
+    def open(cls, fn):
+        """Load a SCANsat CSV, via a .gmap cache alongside it if possible"""
+        gfn = os.path.splitext(fn)[0] + '.gmap'
+        try:
+            if os.path.getmtime(gfn) >= os.path.getmtime(fn):
+                return cls.load(gfn)
+        except (OSError, ValueError):
+            pass
+        with open(fn, 'r') as f:
+            gm = cls.from_csv(f)
+        try:
+            gm.save(gfn)
+        except (IOError, OSError):
+            # read-only directory or similar; never mind
+            pass
+        return gm
+
+def _selftest():
+    # heights() against height(), and ceiling() above it, on a synthetic map
+    # with holes in it: single missing cells, and a block where some points
+    # have no data at all
+    import random
+    gm = GroundMap(2)
+    for mlon in range(-360, 361):
+        for mlat in range(-180, 181):
+            gm.set_cell(mlon, mlat, 1000 * math.sin(mlon * 0.05) * math.cos(mlat * 0.07))
+    rng = random.Random(1)
+    for i in range(2000):
+        gm.set_cell(rng.randrange(-360, 361), rng.randrange(-180, 181), float('nan'))
+    for mlon in range(20, 26):
+        for mlat in range(30, 36):
+            gm.set_cell(mlon, mlat, float('nan'))
+    pts = [(rng.uniform(-95, 95), rng.uniform(-400, 400)) for i in range(20000)]
+    pts += [(rng.uniform(14.5, 18), rng.uniform(9.5, 13)) for i in range(2000)]
+    hts = gm.heights([p[0] for p in pts], [p[1] for p in pts])
+    worst = 0.0
+    nodata = 0
+    for (lat, lon), h in zip(pts, hts):
+        try:
+            ref = gm.height(lat, lon)
+        except KeyError:
+            nodata += 1
+            if h == h:
+                print("%g, %g: expected NaN, got %g  FAIL"%(lat, lon, h))
+                return False
+            continue
+        err = abs(h - ref)
+        if not err < 1e-6: # NaN too
+            print("%g, %g: expected %g, got %g  FAIL"%(lat, lon, ref, h))
+            return False
+        if gm.ceiling(lat, lon) < ref - 1e-6:
+            print("%g, %g: ceiling %g below height %g  FAIL"%(lat, lon, gm.ceiling(lat, lon), ref))
+            return False
+        worst = max(worst, err)
+    print("backend %s: %d points, %d with no data, worst difference %.3gm"%(matrix.BACKEND, len(pts), nodata, worst))
+    return nodata > 0
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        # No map given; check heights() and ceiling() against height()
+        if not _selftest():
+            print("FAILED")
+            sys.exit(1)
+        print("All OK")
+        sys.exit(0)
+    # Convert a CSV to .gmap
+    gm = GroundMap.open(sys.argv[1])
+    print("%dx%d cells, %d per degree"%(gm.nlon, gm.nlat, gm.res))
+    if len(sys.argv) > 3:
+        lat, lon = float(sys.argv[2]), float(sys.argv[3])
+        print("Height at %g, %g: %.1fm (ceiling %.1fm)"%(lat, lon, gm.height(lat, lon), gm.ceiling(lat, lon)))
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+# Telemetry hub: holds one connection to Telemachus and re-serves it to any
+# number of konrad consoles, so a full mission control doesn't load the game
+# with a connection per console.  Speaks the same datalink protocol, so
+# consoles just point --server/--port at the hub.
+
+import asyncio
+import json
+import optparse
+import queue
+import threading
+import websockets.asyncio.server
+import downlink
+import tlog
+
+DEFAULT_PORT = 8086
+
+class Hub(object):
+    """Fans out one upstream downlink to local websocket clients.
+
+    Upstream subscriptions are the union of the clients' (the downlink's
+    refcounting does the work); each client gets frames of just its own
+    keys, at its own rate.  'run' commands are forwarded upstream.  The
+    upstream downlink is only touched from the pump thread; client handlers
+    pass it requests through a queue."""
+    def __init__(self, up):
+        self.up = up
+        self.requests = queue.Queue()
+        self.data = {} # latest frame; replaced, never modified
+        self.nclients = 0
+    def pump(self):
+        while True:
+            while True:
+                try:
+                    fn, args = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                fn(*args)
+            self.data = dict(self.up.update())
+    def request(self, fn, *args):
+        self.requests.put((fn, args))
+    async def sender(self, ws, client):
+        while True:
+            await asyncio.sleep(client['rate'] / 1000.0)
+            data = self.data
+            if data:
+                frame = dict((k, data[k]) for k in client['subs'] if k in data)
+            else:
+                frame = {} # Loss of Signal
+            await ws.send(json.dumps(frame))
+    async def serve(self, ws):
+        client = {'rate': downlink.DEFAULT_RATE, 'subs': set()}
+        self.nclients += 1
+        self.status("Console connected")
+        task = asyncio.create_task(self.sender(ws, client))
+        try:
+            async for msg in ws:
+                try:
+                    d = json.loads(msg)
+                except ValueError:
+                    continue
+                if 'rate' in d:
+                    client['rate'] = max(d['rate'], 10)
+                for k in d.get('+', []):
+                    if k not in client['subs']:
+                        client['subs'].add(k)
+                        self.request(self.up.subscribe, k)
+                for k in d.get('-', []):
+                    if k in client['subs']:
+                        client['subs'].remove(k)
+                        self.request(self.up.unsubscribe, k)
+                if 'run' in d:
+                    self.request(self.up.send_msg, {'run': d['run']})
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            task.cancel()
+            for k in client['subs']:
+                self.request(self.up.unsubscribe, k)
+            self.nclients -= 1
+            self.status("Console disconnected")
+    def status(self, what):
+        print("%s; %d connected"%(what, self.nclients), flush=True)
+    async def listen(self, host, port):
+        async with websockets.asyncio.server.serve(self.serve, host, port):
+            await asyncio.Future() # forever
+
+def parse_opts():
+    x = optparse.OptionParser()
+    x.add_option('--server', type='string', help='Hostname or IP address of Telemachus server', default=downlink.DEFAULT_HOST)
+    x.add_option('--port', type='int', help='Port number of Telemachus server', default=downlink.DEFAULT_PORT)
+    x.add_option('--listen', type='string', help='Address to serve consoles on', default='localhost')
+    x.add_option('--listen-port', type='int', help='Port to serve consoles on', default=DEFAULT_PORT)
+    x.add_option('--refresh-rate', type='float', help='Upstream refresh interval in ms (should be no slower than the fastest console)', default=100)
+    x.add_option('-L', '--log-to', type='string', help="File path to write (upstream) telemetry logs to")
+    opts, args = x.parse_args()
+    return opts
+
+if __name__ == '__main__':
+    opts = parse_opts()
+    logf = tlog.Writer(opts.log_to) if opts.log_to else None
+    up = downlink.connect_async(host=opts.server, port=opts.port, rate=opts.refresh_rate, logf=logf)
+    hub = Hub(up)
+    pump = threading.Thread(target=hub.pump, name='hub-pump')
+    pump.daemon = True
+    pump.start()
+    print("Serving ws://%s:%d/datalink"%(opts.listen, opts.listen_port))
+    try:
+        asyncio.run(hub.listen(opts.listen, opts.listen_port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        up.disconnect()
+        if logf is not None:
+            logf.close()
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# Kepler's equation: eccentric (or hyperbolic) anomaly from mean anomaly.
+# Danby's starters and Halley's method, iterated until the step is below
+# tol rather than a fixed number of times; from a good start that's
+# usually two or three iterations.  Run this file for the round-trip tests.
+
+import math
+import matrix
+
+if matrix.BACKEND == 'numpy':
+    import numpy
+else:
+    numpy = None
+
+TOL = 1e-12
+MAXITER = 50
+
+def _solve(man, ecc, tol, maxiter):
+    # Returns (ean, iterations)
+    if ecc > 1.0:
+        # e sinh H - H = M
+        if man == 0.0:
+            return (0.0, 0)
+        ean = math.copysign(math.log(2.0 * abs(man) / ecc + 1.8), man)
+        i = 0
+        for i in range(1, maxiter + 1):
+            s = ecc * math.sinh(ean)
+            f = s - ean - man
+            fp = ecc * math.cosh(ean) - 1.0
+            d = f / (fp - 0.5 * f * s / fp)
+            ean -= d
+            if abs(d) <= tol * max(1.0, abs(ean)):
+                break
+        return (ean, i)
+    if ecc == 1.0:
+        # XXX This is probably bogus.  But parabolae never happen anyway...
+        return (man, 0)
+    # E - e sin E = M
+    man = math.fmod(man, 2.0 * math.pi)
+    ean = man + math.copysign(0.85 * ecc, math.sin(man)) if man else man
+    i = 0
+    for i in range(1, maxiter + 1):
+        s = ecc * math.sin(ean)
+        f = ean - s - man
+        fp = 1.0 - ecc * math.cos(ean)
+        d = f / (fp - 0.5 * f * s / fp)
+        ean -= d
+        if abs(d) <= tol:
+            break
+    return (ean, i)
+
+def ean_from_man(man, ecc, tol=TOL, maxiter=MAXITER):
+    """Eccentric anomaly (hyperbolic anomaly if ecc > 1) for mean anomaly
+    man.  For ecc < 1, man is first reduced with fmod(man, 2pi), and the
+    result is in the same revolution"""
+    return _solve(man, ecc, tol, maxiter)[0]
+
+def eans_from_mans(mans, ecc, tol=TOL, maxiter=MAXITER):
+    """ean_from_man() for a sequence: a list, or an ndarray with the numpy
+    backend.  Vectorised, iterating until every element has converged"""
+    if numpy is None:
+        return [_solve(man, ecc, tol, maxiter)[0] for man in mans]
+    man = numpy.array(mans, dtype=float)
+    if ecc == 1.0:
+        return man
+    if ecc > 1.0:
+        ean = numpy.sign(man) * numpy.log(2.0 * numpy.abs(man) / ecc + 1.8)
+        for i in range(maxiter):
+            s = ecc * numpy.sinh(ean)
+            f = s - ean - man
+            fp = ecc * numpy.cosh(ean) - 1.0
+            d = f / (fp - 0.5 * f * s / fp)
+            ean -= d
+            if not (numpy.abs(d) > tol * numpy.maximum(1.0, numpy.abs(ean))).any():
+                break
+        return ean
+    man = numpy.fmod(man, 2.0 * math.pi)
+    ean = man + 0.85 * ecc * numpy.sign(numpy.sin(man))
+    for i in range(maxiter):
+        s = ecc * numpy.sin(ean)
+        f = ean - s - man
+        fp = 1.0 - ecc * numpy.cos(ean)
+        d = f / (fp - 0.5 * f * s / fp)
+        ean -= d
+        if not (numpy.abs(d) > tol).any():
+            break
+    return ean
+
+def man_from_ean(ean, ecc):
+    if ecc > 1.0:
+        return ecc * math.sinh(ean) - ean
+    if ecc == 1.0:
+        return ean
+    return ean - ecc * math.sin(ean)
+
+if __name__ == '__main__':
+    # Round-trip tests: M -> E -> M, over a grid of eccentricities and mean
+    # anomalies, and the batch solver against the scalar one
+    import sys
+    failed = 0
+    print("backend: %s"%(matrix.BACKEND,))
+    print("%10s %8s %10s %6s %6s"%('ecc', 'cases', 'max err', 'iters', 'worst'))
+    eccs = [0.0, 0.01, 0.1, 0.3, 0.5, 0.7, 0.8, 0.9, 0.95, 0.99, 0.999, 0.999999,
+            1.000001, 1.001, 1.01, 1.1, 1.5, 2.0, 5.0, 50.0, 1000.0]
+    ell = [i * 2.0 * math.pi / 720 for i in range(-1440, 1441)] + [1e-9, -1e-9, 1e-5, 100.0, -1000.0]
+    hyp = [0.0] + [s * 10 ** (p / 4.0) for p in range(-36, 25) for s in (1, -1)]
+    for ecc in eccs:
+        mans = hyp if ecc > 1.0 else ell
+        worst = 0.0
+        iters = []
+        for man in mans:
+            ean, n = _solve(man, ecc, TOL, MAXITER)
+            iters.append(n)
+            # relative to the size of the terms, as the subtraction in
+            # man_from_ean loses what's below that
+            ref = man if ecc > 1.0 else math.fmod(man, 2.0 * math.pi)
+            err = abs(man_from_ean(ean, ecc) - ref) / max(1.0, abs(ean), abs(man))
+            worst = max(worst, err)
+        ok = worst < 1e-12 and max(iters) < MAXITER
+        failed += not ok
+        print("%10.7g %8d %10.2g %6.2f %6d%s"%(ecc, len(mans), worst, sum(iters) / float(len(iters)),
+                                             max(iters), '' if ok else '  FAIL'))
+        batch = eans_from_mans(mans, ecc)
+        diff = max(abs(float(b) - ean_from_man(m, ecc)) / max(1.0, abs(float(b)))
+                   for b, m in zip(batch, mans))
+        if diff > 1e-12:
+            print("%10.7g batch disagrees with scalar by %g  FAIL"%(ecc, diff))
+            failed += 1
+    if failed:
+        print("%d FAILED"%(failed,))
+        sys.exit(1)
+    print("All OK")
@@ -5,11 +5,14 @@ import gauge
 import curses, curses.ascii
 import optparse
 import math
-import csv
+import groundmap
 import booster
 import retro
 import ascent
 import burns
+import simsched
+import tlog
+import ephem
 from copy import copy
 
 class Console(object):
@@ -18,6 +21,19 @@ class Console(object):
         self.dl = dl
         self.dl.subscribe('b.number')
         self.status = gauge.StatusReadout(dl, scr.derwin(1, 78, 22, 1), 'status:')
+        self.profile = gauge.ProfileGauge(dl, scr.derwin(13, 40, 5, 20))
+    def draw(self):
+        """Draw a frame; returns status messages"""
+        profiler = gauge.profiler
+        if profiler is not None:
+            profiler.start_frame()
+        ml = self.group.draw()
+        self.group.post_draw()
+        if profiler is not None:
+            profiler.end_frame()
+            self.profile.draw()
+            self.profile.post_draw()
+        return ml
     def input(self, key):
         if key == ord('('): # prev body
             if opts.body > 0:
@@ -29,6 +45,9 @@ class Console(object):
                 opts.body += 1
                 self.group.changeopt(gauge.Gauge, body=opts.body)
             return
+        if key == ord(curses.ascii.ctrl('P')): # toggle profiler
+            gauge.profiler = None if gauge.profiler else gauge.Profiler()
+            return
         if key == ord(curses.ascii.ctrl('X')):
             return True # exit
     @classmethod
@@ -317,14 +336,14 @@ class RetroConsole(Console):
         self.vars = {}
         mode = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 25), self.vars, 'mode', centered=True)
         scap = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 40), self.vars, 'stagecap', centered=True)
-        sim_blocks = []
-        self.rs = [None, None]
+        self.rs = [retro.RetroSim(ground_map=opts.ground_map, ground_alt=opts.ground_alt, mode=self.mode)
+                   for i in range(2)]
+        # Current throttle and 100%, simulated together
+        sim_blocks = [gauge.UpdateRocketSimBatch(dl, scr, opts.body, opts.booster, (None, 1.0), False,
+                                                 retro.RetroSimBatch(self.rs))]
         for i in range(2):
             y = i * 6
-            use_throttle = not i
-            rs = retro.RetroSim(ground_map=opts.ground_map, ground_alt=opts.ground_alt, mode=self.mode)
-            self.rs[i] = rs
-            sim = gauge.UpdateRocketSim(dl, scr, opts.body, opts.booster, use_throttle, False, rs)
+            rs = self.rs[i]
             wtext = "At 100% throttle" if i else "At current throttle"
             wt = gauge.FixedLabel(dl, scr.derwin(1, 32, 7 + y, 1), wtext, centered=True)
             hwin = scr.derwin(5, 16, 8 + y, 1)
@@ -353,16 +372,17 @@ class RetroConsole(Console):
             t = gauge.GaugeGroup(twin, [gauge.RSLatitude(dl, twin.derwin(1, 12, 1, 1), 'sh', rs),
                                         gauge.RSLongitude(dl, twin.derwin(1, 12, 2, 1), 'sh', rs)],
                                  "Touchdown")
-            sim_blocks.extend([sim, wt, h, v, s, b, t])
+            sim_blocks.extend([wt, h, v, s, b, t])
         alt = gauge.TerrainAltitudeGauge(dl, scr.derwin(3, 22, 19, 8))
         dh = gauge.DeltaHGauge(dl, scr.derwin(3, 22, 19, 30), opts.ground_map, opts.ground_alt)
         vs = gauge.VSpeedGauge(dl, scr.derwin(3, 21, 19, 52))
+        age = gauge.RSAge(dl, scr.derwin(3, 15, 4, 10), self.rs[0])
         body = gauge.BodyGauge(dl, scr.derwin(3, 12, 0, 0), opts.body)
         time = gauge.TimeGauge(dl, scr.derwin(3, 12, 0, 68))
         self.group = gauge.GaugeGroup(scr,
                                       [self.update, deltav, throttle, twr, mode, scap, alt, dh, vs] +
                                       sim_blocks +
-                                      [self.status, body, time],
+                                      [age, self.status, body, time],
                                       "KONRAD: Retro")
         self.update_vars()
     def update_vars(self):
@@ -430,7 +450,7 @@ class RetroConsole3D(Console):
         for i in range(2):
             y = i * 6
             use_throttle = not i
-            rs = retro.RetroSim3D(ground_map=opts.ground_map, ground_alt=opts.ground_alt, mode=self.mode)
+            rs = retro.RetroSim3D(ground_map=opts.ground_map, ground_alt=opts.ground_alt, mode=self.mode, integrator=opts.integrator)
             rs.radar = self.radar
             self.rs[i] = rs
             sim = gauge.UpdateRocketSim3D(dl, scr, opts.body, opts.booster, use_throttle, rs)
@@ -466,12 +486,13 @@ class RetroConsole3D(Console):
         alt = gauge.TerrainAltitudeGauge(dl, scr.derwin(3, 22, 19, 8))
         dh = gauge.DeltaHGauge(dl, scr.derwin(3, 22, 19, 30), opts.ground_map, opts.ground_alt)
         vs = gauge.VSpeedGauge(dl, scr.derwin(3, 21, 19, 52))
+        age = gauge.RSAge(dl, scr.derwin(3, 15, 4, 10), self.rs[0])
         body = gauge.BodyGauge(dl, scr.derwin(3, 12, 0, 0), opts.body)
         time = gauge.TimeGauge(dl, scr.derwin(3, 12, 0, 68))
         self.group = gauge.GaugeGroup(scr,
                                       [self.update, deltav, throttle, twr, mode, scap, dhm, alt, dh, vs] +
                                       sim_blocks +
-                                      [self.status, body, time],
+                                      [age, self.status, body, time],
                                       "KONRAD: Retro")
         self.update_vars()
     def update_vars(self):
@@ -538,14 +559,13 @@ class AscentConsole(Console):
         self.vars = {}
         mode = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 49), self.vars, 'mode', centered=True)
         scap = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 64), self.vars, 'stagecap', centered=True)
-        sim_blocks = []
-        self.rs = [None, None]
+        self.rs = [ascent.AscentSim(mode=self.mode) for i in range(2)]
+        # Current throttle and 100%, simulated together
+        sim_blocks = [gauge.UpdateRocketSimBatch(dl, scr, opts.body, opts.booster, (None, 1.0), True,
+                                                 ascent.AscentSimBatch(self.rs))]
         for i in range(2):
             y = i * 7
-            use_throttle = not i
-            rs = ascent.AscentSim(mode=self.mode)
-            self.rs[i] = rs
-            sim = gauge.UpdateRocketSim(dl, scr, opts.body, opts.booster, use_throttle, True, rs)
+            rs = self.rs[i]
             elts = gauge.UpdateSimElements(dl, scr, rs, 'ovb')
             wtext = "At 100% throttle" if i else "At current throttle"
             wt = gauge.FixedLabel(dl, scr.derwin(1, 32, 5 + y, 1), wtext, centered=True)
@@ -568,7 +588,7 @@ class AscentConsole(Console):
                                         gauge.RSApoapsis(dl, bwin.derwin(1, 14, 4, 1), 'b', rs),
                                         gauge.RSPeriapsis(dl, bwin.derwin(1, 14, 5, 1), 'b', rs)],
                                  "Burnout")
-            sim_blocks.extend([sim, elts, wt, o, v, b])
+            sim_blocks.extend([elts, wt, o, v, b])
         stages = scr.derwin(12, 30, 7, 49)
         stagesgroup = gauge.GaugeGroup(stages, [
             gauge.StagesGauge(dl, stages.derwin(10, 28, 1, 1), opts.booster),
@@ -645,7 +665,7 @@ class AscentConsole3D(Console):
         mode = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 49), self.vars, 'mode', centered=True)
         scap = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 64), self.vars, 'stagecap', centered=True)
         self.rs = None
-        self.rs = ascent.AscentSim3D(mode=self.mode)
+        self.rs = ascent.AscentSim3D(mode=self.mode, integrator=opts.integrator)
         sim = gauge.UpdateRocketSim3D(dl, scr, opts.body, opts.booster, False, self.rs)
         elts = gauge.UpdateSimElements(dl, scr, self.rs, '0ovb')
         ris = gauge.UpdateTgtRI(dl, scr, self.rs, '0ovb', opts.target_body, opts.target_inc, opts.target_lan)
@@ -785,7 +805,7 @@ class BaseAstroConsole(Console):
         mode = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 25), self.vars, 'mode', centered=True)
         scap = gauge.VariableLabel(dl, scr.derwin(3, 15, 4, 40), self.vars, 'stagecap', centered=True)
         throttle = gauge.ThrottleGauge(dl, scr.derwin(3, 15, 4, 55))
-        self.ms = burns.ManeuverSim(mode=self.mode)
+        self.ms = burns.ManeuverSim(mode=self.mode, integrator=opts.integrator)
         sim = gauge.UpdateManeuverSim(dl, scr, opts.body, opts.booster, False, self.ms, want=self.vars)
         oriwant = scr.derwin(3, 26, 19, 1)
         owgroup = gauge.GaugeGroup(oriwant, [
@@ -794,12 +814,13 @@ class BaseAstroConsole(Console):
             gauge.HeadingGauge(dl, oriwant.derwin(1, 12, 1, 13), want=self.vars),
             gauge.VariableLabel(dl, oriwant.derwin(1, 6, 0, 19), self.vars, 'fineness', centered=True),
             ], 'Orient')
+        age = gauge.RSAge(dl, scr.derwin(3, 10, 4, 0), self.ms)
         body = gauge.BodyGauge(dl, scr.derwin(3, 12, 0, 0), opts.body)
         time = gauge.TimeGauge(dl, scr.derwin(3, 12, 0, 68))
         self.group = gauge.GaugeGroup(scr,
                                       [self.update, twr, deltav, maxtwr, full, mode, scap, throttle, sim] +
                                       self.outputs(opts, scr, dl) +
-                                      [owgroup, self.status, body, time],
+                                      [owgroup, age, self.status, body, time],
                                       "KONRAD: %s"%(self.title,))
         self.update_vars()
         self.setfine(1)
@@ -1107,13 +1128,14 @@ class ApproachConsole(BaseAstroConsole):
                                     gauge.RSAngleParam(dl, xwin.derwin(1, 14, 5, 1), 'x', self.ms, 'ri', 'i'),
                                     ],
                              "SOI Exit")
-        ewin = scr.derwin(8, 16, 7, 47)
+        ewin = scr.derwin(9, 16, 7, 47)
         e = gauge.GaugeGroup(ewin, [gauge.RSTime(dl, ewin.derwin(1, 14, 1, 1), 'e', self.ms),
                                     gauge.RSSIParam(dl, ewin.derwin(1, 14, 2, 1), 'e', self.ms, 'edrvec', 'Re', 'm'),
                                     gauge.RSSIParam(dl, ewin.derwin(1, 14, 3, 1), 'e', self.ms, 'drvec', 'd', 'm'),
                                     gauge.RSSIParam(dl, ewin.derwin(1, 14, 4, 1), 'e', self.ms, 'dvvec', 'v', 'm/s'),
                                     gauge.RSAngleParam(dl, ewin.derwin(1, 14, 5, 1), 'e', self.ms, 'ri', 'i'),
                                     gauge.RSTimeParam(dl, ewin.derwin(1, 14, 6, 1), 'e', self.ms, 'lss', 'w'),
+                                    gauge.RSApproaches(dl, ewin.derwin(1, 14, 7, 1), 'e', self.ms),
                                     ],
                              "Approach")
         swin = scr.derwin(9, 16, 7, 63)
@@ -1173,7 +1195,7 @@ class Option(optparse.Option):
     TYPE_CHECKER = copy(optparse.Option.TYPE_CHECKER)
     TYPE_CHECKER["si"] = parse_si
 
-def parse_opts():
+def parse_opts(argv=None):
     x = optparse.OptionParser(usage='%prog consname', option_class=Option)
     x.add_option('--server', type='string', help='Hostname or IP address of Telemachus server', default=downlink.DEFAULT_HOST)
     x.add_option('--port', type='int', help='Port number of Telemachus server', default=downlink.DEFAULT_PORT)
@@ -1197,13 +1219,22 @@ def parse_opts():
     x.add_option('--kodiak', action='store_true', help="Set --init-{lat,long} to Kodiak, Alaska")
     x.add_option('-n', '--dry-run', action='store_true', help="Don't connect to telemetry, just show layout") # for testing
     x.add_option('-L', '--log-to', type='string', help="File path to write telemetry logs to")
+    x.add_option('--log-text', action='store_true', help="Write the telemetry log as text (one JSON message per line), not binary")
+    x.add_option('--replay', type='string', help="Play back a telemetry log (from --log-to) instead of connecting")
+    x.add_option('--replay-speed', type='float', help="Replay speed, relative to real time (0 for as fast as possible)", default=1.0)
+    x.add_option('--replay-from', type='float', help="Mission time (s) to start replay from")
     x.add_option('--booster', type='string', help="Path to JSON Booster spec file")
     x.add_option('--mj', action='store_true', help='Enable control via MechJeb (Trajectory console)')
     x.add_option('--ground-map', type='string', help="Path to ground map CSV (in SCANsat format)")
     x.add_option('--ground-alt', type='si', help="Constant value to use for ground altitude")
     x.add_option('--list-bodies', action='store_true', help="Display the IDs of known celestial bodies, then exit")
     x.add_option('-e', '--residuals', action='store_true', help='Attempt to allow for propellant residuals in booster calcs')
-    opts, args = x.parse_args()
+    x.add_option('--rk45', action='store_true', help='Use adaptive-step (RK45) integrator in 3D sims (r3d, a3d, astrogation)')
+    x.add_option('--analytic', action='store_true', help='Use closed-form burns for Inert/LiveI astrogation (implies --rk45)')
+    x.add_option('--async-link', action='store_true', help="Receive telemetry on a background asyncio loop")
+    x.add_option('--sync-sims', action='store_true', help="Run sims in the draw loop, rather than on a worker thread")
+    x.add_option('--profile', action='store_true', help="Start with the frame profiler shown (toggle with Ctrl-P)")
+    opts, args = x.parse_args(argv)
     if opts.list_bodies:
         return (opts, None)
     if len(args) != 1:
@@ -1218,6 +1249,12 @@ def parse_opts():
         if not opts.propellant:
             opts.propellant = opts.booster.all_props
     booster.resid = opts.residuals
+    if opts.analytic:
+        opts.integrator = retro.RetroSim3D.INTEGRATOR_ANALYTIC
+    elif opts.rk45:
+        opts.integrator = retro.RetroSim3D.INTEGRATOR_RK45
+    else:
+        opts.integrator = retro.RetroSim3D.INTEGRATOR_EULER
     consumable = ['ElectricCharge']
     if not opts.unmanned:
         consumable += ['Food', 'Water', 'Oxygen']
@@ -1245,17 +1282,7 @@ def parse_opts():
         opts.init_lat = 57.435
         opts.init_long = -152.33
     if opts.ground_map:
-        with open(opts.ground_map, "r") as f:
-            map_csv = csv.reader(f)
-            opts.ground_map = {}
-            for i,row in enumerate(map_csv):
-                if not i:
-                    assert row == ['Row','Column','Lat','Long','Height'], row
-                    continue
-                lat = int(float(row[2]) * 2)
-                lon = int(float(row[3]) * 2)
-                alt = float(row[4])
-                opts.ground_map.setdefault(lon, {})[lat] = alt
+        opts.ground_map = groundmap.GroundMap.open(opts.ground_map)
     return (opts, console)
 
 def list_bodies(dl):
@@ -1272,12 +1299,22 @@ def list_bodies(dl):
 if __name__ == '__main__':
     opts, console = parse_opts()
     gauge.fallover = opts.fallover
+    if not opts.sync_sims:
+        gauge.scheduler = simsched.SimScheduler()
+    if opts.profile:
+        gauge.profiler = gauge.Profiler()
+    ephem.install_default()
     if opts.log_to:
-        logf = open(opts.log_to, "wb")
+        if opts.log_text:
+            logf = open(opts.log_to, "w")
+        else:
+            logf = tlog.Writer(opts.log_to)
     else:
         logf = None
     if opts.dry_run:
         dl = downlink.FakeDownlink()
+    elif opts.replay:
+        dl = downlink.ReplayDownlink(open(opts.replay, 'rb'), opts.replay_speed, start=opts.replay_from)
     else:
         connect_opts = {'host': opts.server, 'port': opts.port, 'logf': logf}
         if console is not None:
@@ -1286,7 +1323,10 @@ if __name__ == '__main__':
             connect_opts['rate'] = 100
         if opts.refresh_rate:
             connect_opts['rate'] = opts.refresh_rate
-        dl = downlink.connect_default(**connect_opts)
+        if opts.async_link:
+            dl = downlink.connect_async(**connect_opts)
+        else:
+            dl = downlink.connect_default(**connect_opts)
     if opts.list_bodies:
         import sys
         list_bodies(dl)
@@ -1318,8 +1358,7 @@ if __name__ == '__main__':
             if dl.get('body_id', opts.body) not in [opts.body, None]:
                 opts.body = dl.get('body_id')
                 console.group.changeopt(gauge.Gauge, body=opts.body)
-            ml = console.group.draw()
-            console.group.post_draw()
+            ml = console.draw()
             if ml is not None:
                 for m in ml:
                     console.status.push(m)
@@ -1327,3 +1366,6 @@ if __name__ == '__main__':
     finally:
         dl.disconnect()
         curses.endwin()
+        # after endwin, as this raises if the log couldn't be written
+        if logf is not None:
+            logf.close()
@@ -2,36 +2,86 @@
 
 # Why don't we just use numpy?  Well, it's an extra dependency, and we don't
 # need very much or very fast linear algebra.  So we'll roll our own...
+# The sims do lots of little vector ops, though, so these are written out
+# longhand rather than with generators, and avoid allocating where possible.
+# If you do want numpy (e.g. for batches of vectors), set KONRAD_MATRIX=numpy
+# and the classes below are replaced by the ones in npmatrix.py.
 
 import math
+import os
 
 class Vector3(object):
+    # x, y, z are plain attributes for speed, but treat them as read-only;
+    # use iadd() and friends to modify a vector in place (they know to
+    # invalidate the cached magnitude)
+    __slots__ = ('x', 'y', 'z', '_mag')
     def __init__(self, tup):
         (x, y, z) = tup
-        self.data = tuple(float(r) for r in (x, y, z))
+        self.x = float(x)
+        self.y = float(y)
+        self.z = float(z)
+        self._mag = None
+    @classmethod
+    def _make(cls, x, y, z):
+        # fast constructor; caller promises x, y, z are floats
+        v = object.__new__(cls)
+        v.x = x
+        v.y = y
+        v.z = z
+        v._mag = None
+        return v
+    @property
+    def data(self):
+        return (self.x, self.y, self.z)
     def __add__(self, other):
-        return Vector3((a + b for a,b in zip(self.data, other.data)))
+        return self._make(self.x + other.x, self.y + other.y, self.z + other.z)
     def __sub__(self, other):
-        return Vector3((a - b for a,b in zip(self.data, other.data)))
+        return self._make(self.x - other.x, self.y - other.y, self.z - other.z)
     def __rmul__(self, other):
         # scalar multiple
-        return Vector3((a * other for a in self.data))
+        return self._make(self.x * other, self.y * other, self.z * other)
+    def __neg__(self):
+        return self._make(-self.x, -self.y, -self.z)
+    # In-place variants.  These are deliberately not __iadd__ etc., because
+    # callers rely on 'a += b' rebinding a rather than mutating it (state
+    # vectors get stashed in sim.data and must not change under us).
+    def iadd(self, other):
+        self.x += other.x
+        self.y += other.y
+        self.z += other.z
+        self._mag = None
+        return self
+    def isub(self, other):
+        self.x -= other.x
+        self.y -= other.y
+        self.z -= other.z
+        self._mag = None
+        return self
+    def iscale(self, k):
+        self.x *= k
+        self.y *= k
+        self.z *= k
+        if self._mag is not None:
+            self._mag *= abs(k)
+        return self
+    def scale_add(self, k, other):
+        # self += k * other
+        self.x += k * other.x
+        self.y += k * other.y
+        self.z += k * other.z
+        self._mag = None
+        return self
+    def copy(self):
+        v = self._make(self.x, self.y, self.z)
+        v._mag = self._mag
+        return v
     def dot(self, other):
         # dot product
-        return sum(a * b for a,b in zip(self.data, other.data))
+        return self.x * other.x + self.y * other.y + self.z * other.z
     def cross(self, other):
-        return Vector3((self.data[1] * other.data[2] - self.data[2] * other.data[1],
-                        self.data[2] * other.data[0] - self.data[0] * other.data[2],
-                        self.data[0] * other.data[1] - self.data[1] * other.data[0]))
-    @property
-    def x(self):
-        return self.data[0]
-    @property
-    def y(self):
-        return self.data[1]
-    @property
-    def z(self):
-        return self.data[2]
+        return self._make(self.y * other.z - self.z * other.y,
+                          self.z * other.x - self.x * other.z,
+                          self.x * other.y - self.y * other.x)
     @classmethod
     def ex(cls):
         return cls((1, 0, 0))
@@ -43,30 +93,158 @@ class Vector3(object):
         return cls((0, 0, 1))
     @property
     def mag(self):
-        return math.sqrt(sum(a*a for a in self.data))
+        if self._mag is None:
+            self._mag = math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+        return self._mag
     @property
     def hat(self):
-        return (1.0 / self.mag) * self
+        m = self.mag
+        k = 1.0 / m
+        v = self._make(self.x * k, self.y * k, self.z * k)
+        v._mag = 1.0
+        return v
     def __str__(self):
-        return '(%f, %f, %f)'%self.data
+        return '(%f, %f, %f)'%(self.x, self.y, self.z)
 
 class Matrix3(object):
+    __slots__ = ('xx', 'xy', 'xz', 'yx', 'yy', 'yz', 'zx', 'zy', 'zz')
     def __init__(self, by_row):
-        self.by_row = tuple(tuple(map(float, r)) for r in by_row)
+        ((self.xx, self.xy, self.xz),
+         (self.yx, self.yy, self.yz),
+         (self.zx, self.zy, self.zz)) = (tuple(map(float, r)) for r in by_row)
+    @classmethod
+    def _make(cls, xx, xy, xz, yx, yy, yz, zx, zy, zz):
+        m = object.__new__(cls)
+        m.xx, m.xy, m.xz = xx, xy, xz
+        m.yx, m.yy, m.yz = yx, yy, yz
+        m.zx, m.zy, m.zz = zx, zy, zz
+        return m
+    @property
+    def by_row(self):
+        return ((self.xx, self.xy, self.xz),
+                (self.yx, self.yy, self.yz),
+                (self.zx, self.zy, self.zz))
     def __mul__(self, other):
         if isinstance(other, Vector3):
-            return Vector3((sum(self.by_row[i][j] * other.data[j] for j in range(3)) for i in range(3)))
+            x, y, z = other.x, other.y, other.z
+            return Vector3._make(self.xx * x + self.xy * y + self.xz * z,
+                                 self.yx * x + self.yy * y + self.yz * z,
+                                 self.zx * x + self.zy * y + self.zz * z)
+        if isinstance(other, Vector3Batch):
+            return Vector3Batch([self * v for v in other])
         if isinstance(other, Matrix3):
-            return Matrix3(((sum(self.by_row[i][j] * other.by_row[j][k] for j in range(3)) for k in range(3)) for i in range(3)))
+            a, b = self, other
+            return Matrix3._make(a.xx * b.xx + a.xy * b.yx + a.xz * b.zx,
+                                 a.xx * b.xy + a.xy * b.yy + a.xz * b.zy,
+                                 a.xx * b.xz + a.xy * b.yz + a.xz * b.zz,
+                                 a.yx * b.xx + a.yy * b.yx + a.yz * b.zx,
+                                 a.yx * b.xy + a.yy * b.yy + a.yz * b.zy,
+                                 a.yx * b.xz + a.yy * b.yz + a.yz * b.zz,
+                                 a.zx * b.xx + a.zy * b.yx + a.zz * b.zx,
+                                 a.zx * b.xy + a.zy * b.yy + a.zz * b.zy,
+                                 a.zx * b.xz + a.zy * b.yz + a.zz * b.zz)
         return NotImplemented
 
+class Vector3Batch(object):
+    # N vectors, for code that wants to work on many at once.  Arithmetic
+    # with a single Vector3 broadcasts it across the batch; scalar multiplies
+    # take either one scalar or a sequence of N.  Reductions (dot, mag, x...)
+    # give lists here, ndarrays with the numpy backend.
+    __slots__ = ('vecs',)
+    def __init__(self, rows):
+        self.vecs = [v.copy() if isinstance(v, Vector3) else Vector3(v)
+                     for v in rows]
+    @classmethod
+    def _wrap(cls, vecs):
+        b = object.__new__(cls)
+        b.vecs = vecs
+        return b
+    @classmethod
+    def from_columns(cls, xs, ys, zs):
+        return cls._wrap([Vector3._make(float(x), float(y), float(z))
+                          for x, y, z in zip(xs, ys, zs)])
+    def _others(self, other):
+        if isinstance(other, Vector3Batch):
+            return other.vecs
+        return [other] * len(self.vecs)
+    @property
+    def x(self):
+        return [v.x for v in self.vecs]
+    @property
+    def y(self):
+        return [v.y for v in self.vecs]
+    @property
+    def z(self):
+        return [v.z for v in self.vecs]
+    def __len__(self):
+        return len(self.vecs)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._wrap(self.vecs[i])
+        return self.vecs[i]
+    def __iter__(self):
+        return iter(self.vecs)
+    def __add__(self, other):
+        return self._wrap([v + o for v, o in zip(self.vecs, self._others(other))])
+    def __sub__(self, other):
+        return self._wrap([v - o for v, o in zip(self.vecs, self._others(other))])
+    def __rmul__(self, other):
+        if isinstance(other, (int, float)):
+            return self._wrap([other * v for v in self.vecs])
+        return self._wrap([k * v for k, v in zip(other, self.vecs)])
+    def __neg__(self):
+        return self._wrap([-v for v in self.vecs])
+    def dot(self, other):
+        return [v.dot(o) for v, o in zip(self.vecs, self._others(other))]
+    def cross(self, other):
+        return self._wrap([v.cross(o) for v, o in zip(self.vecs, self._others(other))])
+    @property
+    def mag(self):
+        return [v.mag for v in self.vecs]
+    @property
+    def hat(self):
+        return self._wrap([v.hat for v in self.vecs])
+
 def RotationMatrix(axis, angle):
     c = math.cos(angle)
     s = math.sin(angle)
     if axis == 0:
-        return Matrix3(((1, 0, 0), (0, c, -s), (0, s, c)))
+        return Matrix3._make(1.0, 0.0, 0.0, 0.0, c, -s, 0.0, s, c)
     if axis == 1:
-        return Matrix3(((c, 0, s), (0, 1, 0), (-s, 0, c)))
+        return Matrix3._make(c, 0.0, s, 0.0, 1.0, 0.0, -s, 0.0, c)
     if axis == 2:
-        return Matrix3(((c, -s, 0), (s, c, 0), (0, 0, 1)))
+        return Matrix3._make(c, -s, 0.0, s, c, 0.0, 0.0, 0.0, 1.0)
     raise ValueError(axis)
+
+BACKEND = 'python'
+if os.environ.get('KONRAD_MATRIX') == 'numpy':
+    # Quietly stay pure-Python if numpy isn't installed
+    try:
+        from npmatrix import Vector3, Vector3Batch, Matrix3, RotationMatrix
+        BACKEND = 'numpy'
+    except ImportError:
+        pass
+
+if __name__ == '__main__':
+    # Micro-benchmark: ops/sec for the operations the sims lean on
+    import timeit
+    print('backend: %s'%(BACKEND,))
+    a = Vector3((1.5, -2.0, 3.25))
+    b = Vector3((0.5, 4.0, -1.0))
+    m = RotationMatrix(2, 0.3) * RotationMatrix(1, -0.7)
+    cases = [('v + v', lambda: a + b),
+             ('v - v', lambda: a - b),
+             ('k * v', lambda: 2.5 * a),
+             ('v.dot(v)', lambda: a.dot(b)),
+             ('v.cross(v)', lambda: a.cross(b)),
+             ('v.mag', lambda: a.mag),
+             ('v.hat', lambda: a.hat),
+             ('M * v', lambda: m * a),
+             ('M * M', lambda: m * m),
+             ('RotationMatrix', lambda: RotationMatrix(2, 0.3)),
+             ('v.scale_add', lambda: a.copy().scale_add(2.5, b)),
+             ]
+    for name, fn in cases:
+        n = 100000
+        t = min(timeit.repeat(fn, number=n, repeat=3))
+        print('%-16s %12.0f ops/s'%(name, n / t))
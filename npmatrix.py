@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# NumPy backend for matrix.py.  Don't import this directly; set
+# KONRAD_MATRIX=numpy in the environment and matrix.py will pick it up.
+# Same interface as the pure-Python classes, just wrapping ndarrays.
+
+import math
+import numpy
+
+class Vector3(object):
+    __slots__ = ('a',)
+    # stop numpy scalars from trying to broadcast over us in k * v
+    __array_ufunc__ = None
+    def __init__(self, tup):
+        self.a = numpy.array(tup, dtype=float).reshape(3)
+    @classmethod
+    def _make(cls, x, y, z):
+        return cls._wrap(numpy.array((x, y, z), dtype=float))
+    @classmethod
+    def _wrap(cls, a):
+        v = object.__new__(cls)
+        v.a = a
+        return v
+    @property
+    def x(self):
+        return float(self.a[0])
+    @property
+    def y(self):
+        return float(self.a[1])
+    @property
+    def z(self):
+        return float(self.a[2])
+    @property
+    def data(self):
+        return tuple(self.a.tolist())
+    def __add__(self, other):
+        return self._wrap(self.a + other.a)
+    def __sub__(self, other):
+        return self._wrap(self.a - other.a)
+    def __rmul__(self, other):
+        return self._wrap(self.a * float(other))
+    def __neg__(self):
+        return self._wrap(-self.a)
+    def iadd(self, other):
+        self.a += other.a
+        return self
+    def isub(self, other):
+        self.a -= other.a
+        return self
+    def iscale(self, k):
+        self.a *= k
+        return self
+    def scale_add(self, k, other):
+        self.a += k * other.a
+        return self
+    def copy(self):
+        return self._wrap(self.a.copy())
+    def dot(self, other):
+        return float(self.a.dot(other.a))
+    def cross(self, other):
+        return self._wrap(numpy.cross(self.a, other.a))
+    @classmethod
+    def ex(cls):
+        return cls((1, 0, 0))
+    @classmethod
+    def ey(cls):
+        return cls((0, 1, 0))
+    @classmethod
+    def ez(cls):
+        return cls((0, 0, 1))
+    @property
+    def mag(self):
+        return math.sqrt(self.a.dot(self.a))
+    @property
+    def hat(self):
+        return self._wrap(self.a / self.mag)
+    def __str__(self):
+        return '(%f, %f, %f)'%self.data
+
+class Vector3Batch(object):
+    # N vectors as an (N, 3) array.  Arithmetic with a single Vector3
+    # broadcasts it across the batch.
+    __slots__ = ('a',)
+    __array_ufunc__ = None
+    def __init__(self, rows):
+        if isinstance(rows, Vector3Batch):
+            self.a = rows.a.copy()
+        else:
+            rows = [r.a if isinstance(r, Vector3) else r for r in rows]
+            self.a = numpy.array(rows, dtype=float).reshape(-1, 3)
+    @classmethod
+    def _wrap(cls, a):
+        b = object.__new__(cls)
+        b.a = a
+        return b
+    @classmethod
+    def from_columns(cls, xs, ys, zs):
+        return cls._wrap(numpy.column_stack((xs, ys, zs)).astype(float))
+    @property
+    def x(self):
+        return self.a[:,0]
+    @property
+    def y(self):
+        return self.a[:,1]
+    @property
+    def z(self):
+        return self.a[:,2]
+    def __len__(self):
+        return len(self.a)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._wrap(self.a[i])
+        return Vector3._wrap(self.a[i].copy())
+    def __iter__(self):
+        for row in self.a:
+            yield Vector3._wrap(row.copy())
+    def __add__(self, other):
+        return self._wrap(self.a + other.a)
+    def __sub__(self, other):
+        return self._wrap(self.a - other.a)
+    def __rmul__(self, other):
+        k = numpy.asarray(other, dtype=float)
+        if k.ndim:
+            k = k[:,None]
+        return self._wrap(self.a * k)
+    def __neg__(self):
+        return self._wrap(-self.a)
+    def dot(self, other):
+        return (self.a * other.a).sum(axis=1)
+    def cross(self, other):
+        return self._wrap(numpy.cross(self.a, other.a))
+    @property
+    def mag(self):
+        return numpy.sqrt((self.a * self.a).sum(axis=1))
+    @property
+    def hat(self):
+        return self._wrap(self.a / self.mag[:,None])
+
+class Matrix3(object):
+    __slots__ = ('m',)
+    __array_ufunc__ = None
+    def __init__(self, by_row):
+        self.m = numpy.array(by_row, dtype=float).reshape(3, 3)
+    @classmethod
+    def _make(cls, xx, xy, xz, yx, yy, yz, zx, zy, zz):
+        return cls._wrap(numpy.array(((xx, xy, xz),
+                                      (yx, yy, yz),
+                                      (zx, zy, zz)), dtype=float))
+    @classmethod
+    def _wrap(cls, m):
+        o = object.__new__(cls)
+        o.m = m
+        return o
+    @property
+    def by_row(self):
+        return tuple(tuple(r) for r in self.m.tolist())
+    def __mul__(self, other):
+        if isinstance(other, Vector3):
+            return Vector3._wrap(self.m.dot(other.a))
+        if isinstance(other, Matrix3):
+            return Matrix3._wrap(self.m.dot(other.m))
+        if isinstance(other, Vector3Batch):
+            return Vector3Batch._wrap(other.a.dot(self.m.T))
+        return NotImplemented
+
+def RotationMatrix(axis, angle):
+    c = math.cos(angle)
+    s = math.sin(angle)
+    if axis == 0:
+        return Matrix3._make(1.0, 0.0, 0.0, 0.0, c, -s, 0.0, s, c)
+    if axis == 1:
+        return Matrix3._make(c, 0.0, s, 0.0, 1.0, 0.0, -s, 0.0, c)
+    if axis == 2:
+        return Matrix3._make(c, -s, 0.0, s, c, 0.0, 0.0, 0.0, 1.0)
+    raise ValueError(axis)
@@ -1,9 +1,17 @@
 #!/usr/bin/python3
 # Calculations for target orbits
 
+import collections
 import math
+import threading
 import matrix
 import cfg
+import kepler
+
+if matrix.BACKEND == 'numpy':
+    import numpy
+else:
+    numpy = None
 
 # Value of big-G used by Kopernicus
 # XXX Warning! this is for KSP 1.2.x; in 1.1.3, G = 6.674e-11
@@ -12,12 +20,24 @@ G = 6.67408e-11
 renames = {}
 
 class CelestialBody(object):
+    # Ephemerides are cached per body: the orientation matrix and
+    # ParentBody for the current elements, and the last EPHEM_CACHE results
+    # of vectors_at_ut().  Elements may be changed in place (or replaced) at
+    # any time; the cache notices and starts over.  Shared between the draw
+    # loop and the sim scheduler's worker, hence the lock.  If Chebyshev
+    # tables for these elements are installed (see ephem.py), they're used
+    # instead within their span.
+    EPHEM_CACHE = 64
     def __init__(self, name, rad, gm):
         self.name = name
         self.rad = rad
         self.gm = gm
         self.parent = None
         self.pb = None
+        self.lock = threading.Lock()
+        self.ekey = None
+        self.ephem = collections.OrderedDict() # ut -> (r, v), oldest first
+        self.cheb = None
     def orbit(self, parent, elts):
         self.parent = parent
         self.elts = elts
@@ -38,18 +58,59 @@ class CelestialBody(object):
             return None
         gm = self.gm + self.pb.gm
         return ParentBody(self.pb.rad, gm)
+    def frame(self):
+        """(ParentBody, orientation matrix) for the current elements.
+        Caller must hold self.lock"""
+        elts = self.elts
+        key = (elts['sma'], elts['ecc'], elts['maae'], elts['mmo'], elts['ape'],
+               elts['inc'], elts['lan'], self.gm, self.pb.gm, self.pb.rad)
+        if key != self.ekey:
+            self.ekey = key
+            self.ephem.clear()
+            self.pbody = self.parent_body
+            self.xform = oxform(elts['ape'], elts['inc'], elts['lan'])
+        return (self.pbody, self.xform)
     def vectors_at_ut(self, ut):
         """Returns (x,v) relative to parent body, at given time since epoch"""
         if not self.parent:
             return None
-        man = self.elts['maae'] + ut * self.elts['mmo']
-        ean = ean_from_man(man, self.elts['ecc'], 16)
-        return self.parent_body.compute_3d_vector(self.elts['sma'],
-                                                  self.elts['ecc'],
-                                                  ean,
-                                                  self.elts['ape'],
-                                                  self.elts['inc'],
-                                                  self.elts['lan'])
+        elts = self.elts
+        with self.lock:
+            pbody, xform = self.frame()
+            cheb = self.cheb
+            if cheb is not None and cheb.ekey == self.ekey:
+                rv = cheb.vectors_at_ut(ut)
+                if rv is not None:
+                    return rv
+            rv = self.ephem.get(ut)
+            if rv is not None:
+                self.ephem.move_to_end(ut)
+                return rv
+        man = elts['maae'] + ut * elts['mmo']
+        ean = ean_from_man(man, elts['ecc'], 16)
+        rv = pbody.compute_3d_vector(elts['sma'], elts['ecc'], ean, elts['ape'],
+                                     elts['inc'], elts['lan'], xform=xform)
+        with self.lock:
+            if pbody is self.pbody: # elements didn't change meanwhile
+                self.ephem[ut] = rv
+                if len(self.ephem) > self.EPHEM_CACHE:
+                    self.ephem.popitem(last=False)
+        return rv
+    def vectors_at_uts(self, uts):
+        """vectors_at_ut() for many times at once; returns Vector3Batches.
+        Not cached, beyond the orientation matrix"""
+        if not self.parent:
+            return None
+        elts = self.elts
+        with self.lock:
+            pbody, xform = self.frame()
+        if numpy is None:
+            mans = [elts['maae'] + ut * elts['mmo'] for ut in uts]
+        else:
+            mans = elts['maae'] + numpy.asarray(uts, dtype=float) * elts['mmo']
+        eans = eans_from_mans(mans, elts['ecc'], 16)
+        return pbody.compute_3d_vectors(elts['sma'], elts['ecc'], eans,
+                                        elts['ape'], elts['inc'], elts['lan'], xform=xform)
     def tan_at_ut(self, ut):
         man = self.elts['maae'] + ut * self.elts['mmo']
         ean = ean_from_man(man, self.elts['ecc'], 16)
@@ -59,7 +120,11 @@ class CelestialBody(object):
         """Returns orbit normal vector"""
         if not self.parent:
             return None
-        xform = oxform(self.elts['ape'], self.elts['inc'], self.elts['lan'])
+        if self.pb is None:
+            xform = oxform(self.elts['ape'], self.elts['inc'], self.elts['lan'])
+        else:
+            with self.lock:
+                _, xform = self.frame()
         return xform * matrix.Vector3.ez()
 
 celestial_bodies = {}
@@ -279,42 +344,123 @@ class ParentBody(object):
                 ttp = mtp / mmo
                 data['pet'] = ttp
         return data
-    def compute_3d_vector(self, sma, ecc, ean, ape, inc, lan):
+    def compute_3d_vector(self, sma, ecc, ean, ape, inc, lan, xform=None):
         o = ovec(sma, ecc, ean)
         od = odot(self.gm, sma, ecc, ean)
-        xform = oxform(ape, inc, lan)
+        if xform is None:
+            xform = oxform(ape, inc, lan)
         r = xform * o
         v = xform * od
         return (r, v)
+    def compute_3d_vectors(self, sma, ecc, eans, ape, inc, lan, xform=None):
+        """compute_3d_vector() for a sequence of eccentric anomalies, as
+        Vector3Batches.  Vectorised with the numpy backend (see matrix.py)"""
+        if xform is None:
+            xform = oxform(ape, inc, lan)
+        if ecc > 1.0:
+            # sma < 0, so these have the right signs
+            sf = math.sqrt(-self.gm * sma)
+            efac = math.sqrt(ecc ** 2 - 1.0)
+            ch, sh = 'cosh', 'sinh'
+        else:
+            sf = math.sqrt(self.gm * sma)
+            efac = math.sqrt(1.0 - ecc ** 2)
+            ch, sh = 'cos', 'sin'
+        if numpy is not None:
+            eans = numpy.asarray(eans, dtype=float)
+            c = getattr(numpy, ch)(eans)
+            s = getattr(numpy, sh)(eans)
+            rad = sma * (1.0 - ecc * c)
+            zero = numpy.zeros_like(eans)
+            if ecc > 1.0:
+                o = matrix.Vector3Batch.from_columns(sma * (c - ecc), -sma * efac * s, zero)
+                od = matrix.Vector3Batch.from_columns(-sf * s / rad, sf * efac * c / rad, zero)
+            else:
+                o = matrix.Vector3Batch.from_columns(sma * (c - ecc), sma * efac * s, zero)
+                od = matrix.Vector3Batch.from_columns(-sf * s / rad, sf * efac * c / rad, zero)
+            return (xform * o, xform * od)
+        ((xx, xy, xz), (yx, yy, yz), (zx, zy, zz)) = xform.by_row
+        cf, sf_ = getattr(math, ch), getattr(math, sh)
+        ysgn = -1.0 if ecc > 1.0 else 1.0
+        rx, ry, rz, vx, vy, vz = [], [], [], [], [], []
+        for ean in eans:
+            c = cf(ean)
+            s = sf_(ean)
+            # perifocal position and velocity
+            px = sma * (c - ecc)
+            py = ysgn * sma * efac * s
+            k = sf / (sma * (1.0 - ecc * c))
+            qx = -k * s
+            qy = k * efac * c
+            rx.append(xx * px + xy * py)
+            ry.append(yx * px + yy * py)
+            rz.append(zx * px + zy * py)
+            vx.append(xx * qx + xy * qy)
+            vy.append(yx * qx + yy * qy)
+            vz.append(zx * qx + zy * qy)
+        return (matrix.Vector3Batch.from_columns(rx, ry, rz),
+                matrix.Vector3Batch.from_columns(vx, vy, vz))
+    def propagate(self, rvec, vvec, dt, tol=1e-10, k=50):
+        """Kepler-propagate state vector (rvec, vvec) by dt seconds
+
+        Uses universal variables, so works for any conic and doesn't go
+        through the elements (which are degenerate for circular or
+        equatorial orbits)."""
+        if dt == 0:
+            return (rvec, vvec)
+        ### eqns from Curtis, Orbital Mechanics for Engineering Students, s3.7
+        smu = math.sqrt(self.gm)
+        r0 = rvec.mag
+        vr0 = rvec.dot(vvec) / r0
+        alpha = 2.0 / r0 - vvec.dot(vvec) / self.gm # 1/a
+        # universal anomaly, by Newton's method
+        chi = smu * abs(alpha) * dt
+        for i in range(k):
+            z = alpha * chi * chi
+            c, s = stumpff(z)
+            f = (r0 * vr0 / smu * chi * chi * c + (1.0 - alpha * r0) * chi ** 3 * s +
+                 r0 * chi - smu * dt)
+            df = (r0 * vr0 / smu * chi * (1.0 - z * s) + (1.0 - alpha * r0) * chi * chi * c +
+                  r0)
+            step = f / df
+            chi -= step
+            if abs(step) <= tol * abs(chi):
+                break
+        z = alpha * chi * chi
+        c, s = stumpff(z)
+        # Lagrange coefficients
+        lf = 1.0 - chi * chi / r0 * c
+        lg = dt - chi ** 3 / smu * s
+        r = lf * rvec + lg * vvec
+        rmag = r.mag
+        lfd = smu / (rmag * r0) * (z * s - 1.0) * chi
+        lgd = 1.0 - chi * chi / rmag * c
+        v = lfd * rvec + lgd * vvec
+        return (r, v)
 
 def man_from_ean(ean, ecc):
-    if ecc > 1.0:
-        return ecc * math.sinh(ean) - ean
-    if ecc == 1.0:
-        # XXX This is probably bogus.  But parabolae never happen anyway...
-        return ean
-    return ean - ecc * math.sin(ean)
+    return kepler.man_from_ean(ean, ecc)
 
 def ean_from_man(man, ecc, k):
-    # Iterated approximation; k is number of iterations
-    if ecc > 1.0:
-        ### Uses Newton's method on hyperbolic eqn, from http://control.asu.edu/Classes/MAE462/462Lecture05.pdf
-        ean = man
-        for i in range(k):
-            ean += (man - ecc * math.sinh(ean) + ean) / (ecc * math.cosh(ean) - 1.0)
-        return ean
-    if ecc == 1.0:
-        # XXX This is probably bogus.  But parabolae never happen anyway...
-        return man
-    man = math.fmod(man, 2.0 * math.pi)
-    ### Uses Newton's method, from https://en.wikipedia.org/wiki/Kepler%27s_equation
-    if ecc > 0.8:
-        ean = math.pi
-    else:
-        ean = man
-    for i in range(k):
-        ean -= (ean - ecc * math.sin(ean) - man) / (1.0 - ecc * math.cos(ean))
-    return ean
+    # k is the most iterations to allow; see kepler.py
+    return kepler.ean_from_man(man, ecc, maxiter=k)
+
+def eans_from_mans(mans, ecc, k):
+    """ean_from_man() for a sequence of mean anomalies: a list, or an
+    ndarray with the numpy backend"""
+    return kepler.eans_from_mans(mans, ecc, maxiter=k)
+
+def stumpff(z):
+    """Returns Stumpff functions (C(z), S(z)) for universal variables"""
+    if abs(z) < 1e-3:
+        # series, to avoid cancellation near z = 0
+        return (0.5 - z / 24.0 + z * z / 720.0,
+                1.0 / 6.0 - z / 120.0 + z * z / 5040.0)
+    if z > 0:
+        sz = math.sqrt(z)
+        return ((1.0 - math.cos(sz)) / z, (sz - math.sin(sz)) / sz ** 3)
+    sz = math.sqrt(-z)
+    return ((math.cosh(sz) - 1.0) / -z, (math.sinh(sz) - sz) / sz ** 3)
 
 def ean_from_tan(tan, ecc):
     if ecc > 1.0:
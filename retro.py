@@ -33,6 +33,25 @@ class RetroSim(sim.RocketSim):
                 print("(%g, %g) -> (%g, %g)"%(self.downrange, self.alt, self.hs, self.vs))
                 print("%s"%(''.join(self.data.keys()),))
 
+class RetroSimBatch(sim.RocketSimBatch):
+    surface = True
+    def simulate(self, booster, hs, vs, alt, throttles, pit, hdg, lat, lon, brad, bgm):
+        self.sim_setup(booster, hs, vs, alt, throttles, pit, hdg, lat, lon, brad, bgm, True)
+        self.run()
+    def record(self, i):
+        d = self.data[i]
+        if self.hs[i] <= 0 and 'h' not in d:
+            d['h'] = self.encode(i)
+        if self.vs[i] >= 0 and 'v' not in d:
+            d['v'] = self.encode(i)
+        if self.alt[i] <= self.local_ground_alt[i] and 's' not in d:
+            d['s'] = self.encode(i)
+        if len(self.boosters[i].stages) <= self.stagecap[i] and 'b' not in d:
+            d['b'] = self.encode(i)
+    def done(self, i):
+        d = self.data[i]
+        return 'h' in d and 'v' in d and 's' in d and 'b' in d
+
 class RetroSim3D(sim.RocketSim3D):
     def simulate(self, booster, throttle, pit, hdg, brad, bgm, inc, lan, tan, ape, ecc, sma, reflon=None):
         ean = orbit.ean_from_tan(tan, ecc)
@@ -52,11 +71,11 @@ class RetroSim3D(sim.RocketSim3D):
             if self.step():
                 break
             if self.hv.dot(hv0) <= 0 and 'h' not in self.data:
-                self.data['h'] = self.encode()
+                self.data['h'] = self.encode_event(lambda: self.hv.dot(hv0) <= 0)
             if self.vs >= 0 and 'v' not in self.data:
-                self.data['v'] = self.encode()
-            if self.alt <= self.local_ground_alt and 's' not in self.data:
-                self.data['s'] = self.encode()
+                self.data['v'] = self.encode_event(lambda: self.vs >= 0)
+            if 's' not in self.data and self.below_ground():
+                self.data['s'] = self.encode_event(self.below_ground)
             if len(self.booster.stages) <= self.stagecap and 'b' not in self.data:
                 self.data['b'] = self.encode()
             if self.debug:
@@ -8,6 +8,76 @@ import orbit
 
 class SimulationException(Exception): pass
 
+def _step_2d(mode, bstr, dv, dt, hs, vs, alt, lat, lon, cx, cy, clat, clong, brad, bgm):
+    # One step of RocketSim physics, shared with RocketSimBatch: steer for
+    # mode, apply dv (already burned from bstr) and gravity, and move over
+    # the curved surface.  Returns (hs, vs, alt, mhs, lat, lon, cx, cy, clat,
+    # clong, mode), where mhs is the distance travelled downrange
+    hs0 = hs
+    vs0 = vs
+    if mode == RocketSim.MODE_FIXED:
+        pass
+    elif mode == RocketSim.MODE_PROGRADE:
+        vel = math.hypot(hs, vs)
+        if vel > 0:
+            cx = hs / vel
+            cy = vs / vel
+    elif mode == RocketSim.MODE_RETROGRADE:
+        vel = math.hypot(hs, vs)
+        if vel > 0:
+            cx = -hs / vel
+            cy = -vs / vel
+    elif mode == RocketSim.MODE_VL:
+        # Pitch for vertical descent
+        twr = bstr.twr
+        if twr > abs(hs):
+            cx = -hs / twr
+            cy = math.sqrt(1 - cx*cx)
+        else:
+            cx = 0
+            cy = 1
+    else:
+        raise Exception("Unhandled mode", mode)
+    hs += dv * cx
+    # local gravity
+    if None in (alt, brad, bgm):
+        g = 0
+    else:
+        g = bgm / (alt + brad)**2
+    vs += dv * cy - (g * dt)
+    alt += (vs + vs0) / 2.0
+    mhs = (hs + hs0) / 2.0
+    if brad is not None:
+        # update lat & long
+        lat += mhs * clat / (brad + alt)
+        if abs(lat) > (math.pi / 2):
+            if lat > 0:
+                # crossed north pole
+                lat = math.pi - lat
+            else:
+                # crossed south pole
+                lat = -math.pi - lat
+            lon += math.pi
+            # heading switches around too
+            clat = -clat
+            clong = -clong
+        lon += mhs * clong / ((brad + alt) * math.cos(lat))
+        lon %= (math.pi * 2)
+        # transform our velocity - planet is curving away beneath us
+        rot = mhs / (brad + alt)
+        c, s = math.cos(rot), math.sin(rot)
+        hs, vs = hs * c - vs * s, hs * s + vs * c
+    if hs <= 0 and mode == RocketSim.MODE_RETROGRADE:
+        mode = RocketSim.MODE_VL
+    return (hs, vs, alt, mhs, lat, lon, cx, cy, clat, clong, mode)
+
+def _local_ground_alt(ground_map, ground_alt, lat, lon):
+    if ground_map is not None:
+        return ground_map.height(math.degrees(lat), math.degrees(lon))
+    if ground_alt is not None:
+        return ground_alt
+    return 0
+
 class RocketSim(object):
     MODE_FIXED = 0
     MODE_PROGRADE = 1
@@ -60,6 +130,7 @@ class RocketSim(object):
         self.act_mode = self.mode
         # time step, in seconds
         self.dt = 1.0
+        self.nsteps = 0
     def encode(self):
         d = {'time': self.t, 'alt': self.alt, 'downrange': self.downrange,
              'hs': self.hs, 'vs': self.vs,
@@ -69,86 +140,23 @@ class RocketSim(object):
                 d['height'] = self.alt - self.local_ground_alt
         return d
     def step(self):
-        hs0 = self.hs
-        vs0 = self.vs
-        alt0 = self.alt
         self.t += self.dt
+        self.nsteps += 1
         dv = self.booster.simulate(self.throttle, self.dt, stagecap=self.stagecap)
         if dv is None:
             return True
-        if self.act_mode == self.MODE_FIXED:
-            pass
-        elif self.act_mode == self.MODE_PROGRADE:
-            vel = math.hypot(self.hs, self.vs)
-            if vel > 0:
-                self.cx = self.hs / vel
-                self.cy = self.vs / vel
-        elif self.act_mode == self.MODE_RETROGRADE:
-            vel = math.hypot(self.hs, self.vs)
-            if vel > 0:
-                self.cx = -self.hs / vel
-                self.cy = -self.vs / vel
-        elif self.act_mode == self.MODE_VL:
-            # Pitch for vertical descent
-            twr = self.booster.twr
-            if twr > abs(self.hs):
-                self.cx = -self.hs / twr
-                self.cy = math.sqrt(1 - self.cx*self.cx)
-            else:
-                self.cx = 0
-                self.cy = 1
-        else:
-            raise Exception("Unhandled mode", self.mode)
-        dhs = dv * self.cx
-        dvs = dv * self.cy
-        self.hs += dhs
-        # local gravity
-        if None in (self.alt, self.brad, self.bgm):
-            g = 0
-        else:
-            g = self.bgm / (self.alt + self.brad)**2
-        self.vs += dvs - (g * self.dt)
-        self.alt += (self.vs + vs0) / 2.0
-        mhs = (self.hs + hs0) / 2.0
+        (self.hs, self.vs, self.alt, mhs, self.lat, self.lon, self.cx, self.cy,
+         self.clat, self.clong, self.act_mode) = _step_2d(
+            self.act_mode, self.booster, dv, self.dt, self.hs, self.vs, self.alt,
+            self.lat, self.lon, self.cx, self.cy, self.clat, self.clong,
+            self.brad, self.bgm)
         self.downrange += mhs
-        if self.brad is not None:
-            # update lat & long
-            self.lat += mhs * self.clat / (self.brad + self.alt)
-            if abs(self.lat) > (math.pi / 2):
-                if self.lat > 0:
-                    # crossed north pole
-                    self.lat = math.pi - self.lat
-                else:
-                    # crossed south pole
-                    self.lat = -math.pi - self.lat
-                self.lon += math.pi
-                # heading switches around too
-                self.clat = -self.clat
-                self.clong = -self.clong
-            self.lon += mhs * self.clong / ((self.brad + self.alt) * math.cos(self.lat))
-            self.lon %= (math.pi * 2)
-            # transform our velocity - planet is curving away beneath us
-            rot = mhs / (self.brad + self.alt)
-            nhs = self.hs * math.cos(rot) - self.vs * math.sin(rot)
-            nvs = self.hs * math.sin(rot) + self.vs * math.cos(rot)
-            self.hs, self.vs = nhs, nvs
-            if self.orbitals:
-                # Vcirc at current altitude
-                self.tgt_obt_vel = self.pbody.vcirc(self.alt)
+        if self.orbitals and self.brad is not None:
+            # Vcirc at current altitude
+            self.tgt_obt_vel = self.pbody.vcirc(self.alt)
         if self.surface:
-            if self.ground_map is not None:
-                mlat = int(round(math.degrees(self.lat) * 2))
-                mlon = int(round(math.degrees(self.lon) * 2)) % 720
-                mlat = min(mlat, 179)
-                if mlon >= 360: mlon -= 720
-                elif mlon < -360: mlon += 720
-                self.local_ground_alt = self.ground_map[mlon][mlat]
-            elif self.ground_alt is not None:
-                self.local_ground_alt = self.ground_alt
-            else:
-                self.local_ground_alt = 0
-        if self.hs <= 0 and self.act_mode == self.MODE_RETROGRADE:
-            self.act_mode = self.MODE_VL
+            self.local_ground_alt = _local_ground_alt(self.ground_map, self.ground_alt,
+                                                      self.lat, self.lon)
     def compute_elements(self, key):
         if key in self.data:
             sv = self.data[key]
@@ -156,6 +164,145 @@ class RocketSim(object):
                 elts = self.pbody.compute_elements(sv['alt'], sv['vs'], sv['hs'])
                 self.data[key].update(elts)
 
+class RocketSimBatch(object):
+    # Runs several RocketSims in lock-step, e.g. the same vehicle at a few
+    # different throttle settings.  State is held as one list per variable
+    # rather than one object per scenario; each member sim supplies its own
+    # mode, stagecap and ground, and gets its own events in sim.data.
+    surface = False
+    orbitals = False
+    t_max = 1200
+    def __init__(self, sims):
+        self.sims = list(sims)
+        self.data = [{} for s in self.sims]
+    def sim_setup(self, bstr, hs, vs, alt, throttles, pit, hdg, lat, lon, brad, bgm, retro):
+        n = len(self.sims)
+        # None throttle means "don't simulate this one"
+        self.live = [th is not None for th in throttles]
+        self.boosters = [booster.Booster.clone(bstr) if l else None for l in self.live]
+        self.throttle = list(throttles)
+        self.mode = [s.mode for s in self.sims]
+        self.act_mode = list(self.mode)
+        self.stagecap = [s.stagecap for s in self.sims]
+        self.ground_alt = [s.ground_alt for s in self.sims]
+        self.ground_map = [s.ground_map for s in self.sims]
+        pitch = math.radians(pit)
+        heading = math.radians(hdg)
+        sgn = -1 if retro else 1
+        self.cx = [sgn * math.cos(pitch)] * n
+        self.cy = [math.sin(pitch)] * n
+        self.clat = [sgn * math.cos(heading)] * n
+        self.clong = [sgn * math.sin(heading)] * n
+        self.t = 0
+        self.dt = 1.0
+        self.nsteps = 0
+        self.hs = [hs] * n
+        self.vs = [vs] * n
+        self.alt = [alt] * n
+        self.downrange = [0] * n
+        self.lat = [math.radians(lat)] * n
+        self.lon = [math.radians(lon)] * n
+        self.local_ground_alt = list(self.ground_alt)
+        self.tgt_obt_vel = [None] * n
+        self.brad = brad
+        self.bgm = bgm
+        self.pbody = orbit.ParentBody(brad, bgm)
+        for s in self.sims:
+            # for compute_elements()
+            s.pbody = self.pbody
+        self.data = [{} for s in self.sims]
+    def encode(self, i):
+        d = {'time': self.t, 'alt': self.alt[i], 'downrange': self.downrange[i],
+             'hs': self.hs[i], 'vs': self.vs[i],
+             'lat': math.degrees(self.lat[i]), 'lon': math.degrees(self.lon[i])}
+        if self.surface:
+            if self.local_ground_alt[i] is not None:
+                d['height'] = self.alt[i] - self.local_ground_alt[i]
+        return d
+    def step(self):
+        # RocketSim.step for every live scenario.  A scenario whose booster
+        # can't be simulated drops out.
+        dt = self.dt
+        self.t += dt
+        self.nsteps += 1
+        brad, bgm = self.brad, self.bgm
+        lookups = {}
+        for i in range(len(self.sims)):
+            if not self.live[i]:
+                continue
+            bstr = self.boosters[i]
+            dv = bstr.simulate(self.throttle[i], dt, stagecap=self.stagecap[i])
+            if dv is None:
+                self.live[i] = False
+                continue
+            (self.hs[i], self.vs[i], self.alt[i], mhs, self.lat[i], self.lon[i],
+             self.cx[i], self.cy[i], self.clat[i], self.clong[i], self.act_mode[i]) = _step_2d(
+                self.act_mode[i], bstr, dv, dt, self.hs[i], self.vs[i], self.alt[i],
+                self.lat[i], self.lon[i], self.cx[i], self.cy[i], self.clat[i], self.clong[i],
+                brad, bgm)
+            self.downrange[i] += mhs
+            if self.orbitals and brad is not None:
+                self.tgt_obt_vel[i] = self.pbody.vcirc(self.alt[i])
+            if self.surface:
+                ground_map = self.ground_map[i]
+                if ground_map is not None:
+                    # looked up below, all at once
+                    lookups.setdefault(id(ground_map), (ground_map, []))[1].append(i)
+                else:
+                    self.local_ground_alt[i] = _local_ground_alt(None, self.ground_alt[i],
+                                                                 self.lat[i], self.lon[i])
+        for ground_map, idx in lookups.values():
+            hts = ground_map.heights([math.degrees(self.lat[i]) for i in idx],
+                                     [math.degrees(self.lon[i]) for i in idx])
+            for i, h in zip(idx, hts):
+                self.local_ground_alt[i] = h
+    def record(self, i):
+        # Subclasses check for and record events for scenario i
+        raise NotImplementedError()
+    def done(self, i):
+        raise NotImplementedError()
+    def run(self):
+        while self.t <= self.t_max and any(self.live):
+            self.step()
+            for i, s in enumerate(self.sims):
+                if not self.live[i]:
+                    continue
+                self.record(i)
+                if self.done(i):
+                    self.live[i] = False
+                if s.debug:
+                    print("[%d] time %d"%(i, self.t))
+                    print("[%d] (%g, %g) -> (%g, %g)"%(i, self.downrange[i], self.alt[i], self.hs[i], self.vs[i]))
+                    print("[%d] %s"%(i, ''.join(self.data[i].keys())))
+        for s, d in zip(self.sims, self.data):
+            s.data = d
+            # for RSTime
+            s.dt = self.dt
+            s.nsteps = self.nsteps
+
+### Dormand-Prince RK5(4)7M tableau
+_DP_C = (0.0, 1.0 / 5, 3.0 / 10, 4.0 / 5, 8.0 / 9, 1.0, 1.0)
+_DP_A = ((1.0 / 5,),
+         (3.0 / 40, 9.0 / 40),
+         (44.0 / 45, -56.0 / 15, 32.0 / 9),
+         (19372.0 / 6561, -25360.0 / 2187, 64448.0 / 6561, -212.0 / 729),
+         (9017.0 / 3168, -355.0 / 33, 46732.0 / 5247, 49.0 / 176, -5103.0 / 18656),
+         (35.0 / 384, 0.0, 500.0 / 1113, 125.0 / 192, -2187.0 / 6784, 11.0 / 84))
+# difference between 5th and 4th order weights, for error estimate
+_DP_E = (71.0 / 57600, 0.0, -71.0 / 16695, 71.0 / 1920, -17253.0 / 339200,
+         22.0 / 525, -1.0 / 40)
+
+def _lincomb(base, h, coeffs, vecs):
+    # base + h * sum(coeffs[i] * vecs[i]); base may be None for a zero vector
+    if base is None:
+        acc = matrix.Vector3((0, 0, 0))
+    else:
+        acc = base.copy()
+    for c, v in zip(coeffs, vecs):
+        if c:
+            acc.scale_add(h * c, v)
+    return acc
+
 class RocketSim3D(object):
     MODE_FIXED = 0
     MODE_PROGRADE = 1
@@ -169,7 +316,18 @@ class RocketSim3D(object):
                 cls.MODE_RETROGRADE: "Retro", cls.MODE_LIVE: "LiveF",
                 cls.MODE_INERTIAL: "Inert", cls.MODE_LIVE_INERTIAL: "LiveI",
                 }.get(mode, "%r?"%(mode,))
-    def __init__(self, mode=0, debug=False, ground_alt=None, ground_map=None):
+    INTEGRATOR_EULER = 0
+    INTEGRATOR_RK45 = 1
+    INTEGRATOR_ANALYTIC = 2 # closed-form burns in ManeuverSim; RK45 elsewhere
+    # Tuning for the adaptive (RK45) integrator
+    rk_rtol = 1e-6
+    rk_atol_r = 100.0 # m
+    rk_atol_v = 1.0 # m/s
+    dt_min = 1e-3
+    dt_max = 10.0
+    event_tol = 1e-3 # s
+    hold_vmin = 5.0 # m/s; below this, Progd/Retro hold the previous attitude
+    def __init__(self, mode=0, debug=False, ground_alt=None, ground_map=None, integrator=0):
         self.data = {}
         self.ground_alt = ground_alt
         self.ground_map = ground_map
@@ -178,6 +336,7 @@ class RocketSim3D(object):
         self.debug = debug
         self.reflon = None
         self.force_ground_alt = None
+        self.integrator = integrator
     def sim_setup(self, bstr, throttle, pit, hdg, brad, bgm, inc, lan, ean, ape, ecc, sma):
         self.booster = bstr.__class__.clone(bstr)
         self.pbody = orbit.ParentBody(brad, bgm)
@@ -190,8 +349,13 @@ class RocketSim3D(object):
         self.init_rvec = self.rvec
         self.throttle = throttle
         self.act_mode = self.mode
-        # time step, in seconds
+        # time step, in seconds.  For RK45 this is just the next trial step
         self.dt = 1.0
+        # don't step past this time (RK45 only; Euler overshoots by < dt)
+        self.t_limit = None
+        self.nsteps = 0
+        self.last_step = None
+        self.hold_pvec = None
         # Total expended delta-V
         self.total_dv = 0
     def set_reflon(self, lon):
@@ -201,10 +365,15 @@ class RocketSim3D(object):
         self.reflon = lon - self.lon
     def point(self, pit, hdg):
         # pointing vector in local co-ordinates
-        pvec = matrix.Vector3((math.sin(pit),
-                               math.sin(hdg) * math.cos(pit),
-                               math.cos(hdg) * math.cos(pit)))
-        self.pvec = matrix.RotationMatrix(2, self.lon) * matrix.RotationMatrix(1, -self.lat) * pvec
+        self.lpvec = matrix.Vector3((math.sin(pit),
+                                     math.sin(hdg) * math.cos(pit),
+                                     math.cos(hdg) * math.cos(pit)))
+        self.pvec = self.local_to_inertial(self.lpvec, self.rvec)
+    def local_to_inertial(self, lvec, rvec):
+        rhat = rvec.hat
+        lon = math.atan2(rhat.y, rhat.x)
+        lat = math.asin(rhat.z)
+        return matrix.RotationMatrix(2, lon) * matrix.RotationMatrix(1, -lat) * lvec
     @property
     def alt(self):
         return self.rvec.mag - self.pbody.rad
@@ -237,15 +406,18 @@ class RocketSim3D(object):
             return self.force_ground_alt
         gl = self.ground_lon
         if self.ground_map is not None and gl is not None:
-            mlat = int(round(math.degrees(self.lat) * 2))
-            mlon = int(round(math.degrees(gl) * 2)) % 720
-            mlat = min(mlat, 179)
-            if mlon >= 360: mlon -= 720
-            elif mlon < -360: mlon += 720
-            return self.ground_map[mlon][mlat]
+            return self.ground_map.height(math.degrees(self.lat), math.degrees(gl))
         if self.ground_alt is not None:
             return self.ground_alt
         return 0
+    def below_ground(self):
+        # alt <= local_ground_alt, but cheaper when we're well above the
+        # terrain (which is most of the time)
+        gl = self.ground_lon
+        if not self.force_ground_alt and self.ground_map is not None and gl is not None:
+            if self.alt > self.ground_map.ceiling(math.degrees(self.lat), math.degrees(gl)):
+                return False
+        return self.alt <= self.local_ground_alt
     def encode(self):
         d = {'time': self.t, 'alt': self.alt, 'downrange': self.downrange,
              'hs': self.hs, 'vs': self.vs,
@@ -256,10 +428,13 @@ class RocketSim3D(object):
              }
         return dict((k,v) for k,v in d.items() if v is not None)
     def step(self):
+        if self.integrator != self.INTEGRATOR_EULER:
+            return self.step_rk45()
         self.t += self.dt
         dv = self.booster.simulate(self.throttle, self.dt, stagecap=self.stagecap)
         if dv is None:
             return True
+        self.nsteps += 1
         self.total_dv += dv
         if self.act_mode in (self.MODE_INERTIAL, self.MODE_LIVE_INERTIAL):
             pass
@@ -278,6 +453,121 @@ class RocketSim3D(object):
             g = -self.pbody.gm / self.rvec.mag ** 2
             avec += (g * self.dt) * self.rvec.hat
         self.vvec += avec
+    def pointing(self, rvec, vvec):
+        # pointing vector for state (rvec, vvec) under current act_mode
+        if self.act_mode in (self.MODE_INERTIAL, self.MODE_LIVE_INERTIAL):
+            return self.pvec
+        if self.act_mode in (self.MODE_FIXED, self.MODE_LIVE):
+            return self.local_to_inertial(self.lpvec, rvec)
+        if self.act_mode in (self.MODE_PROGRADE, self.MODE_RETROGRADE):
+            if self.hold_pvec is not None and vvec.mag < self.hold_vmin:
+                # velocity too small to steer by; hold the attitude we had
+                return self.hold_pvec
+            if self.act_mode == self.MODE_PROGRADE:
+                return vvec.hat
+            return -1.0 * vvec.hat
+        raise Exception("Unhandled mode", self.mode)
+    def accel(self, rvec, vvec, athr):
+        # total acceleration, given thrust acceleration athr
+        avec = athr * self.pointing(rvec, vvec)
+        if self.pbody.gm is not None:
+            rmag = rvec.mag
+            avec += (-self.pbody.gm / rmag ** 3) * rvec
+        return avec
+    def step_rk45(self):
+        # Dormand-Prince embedded RK5(4) step with error-controlled step size.
+        # Steps are clipped at stage burnout and t_limit, so those events land
+        # exactly on a step boundary; others are found with encode_event().
+        bt = self.booster.burnout_time(self.throttle, stagecap=self.stagecap)
+        while bt is not None and bt <= 0:
+            # dead weight, or an empty tank we didn't quite get rid of
+            self.booster.stage()
+            bt = self.booster.burnout_time(self.throttle, stagecap=self.stagecap)
+        h = min(self.dt, self.dt_max)
+        clipped = False
+        if bt is not None and bt <= h:
+            h = bt
+            clipped = True
+        if self.t_limit is not None and self.t_limit - self.t <= h:
+            h = max(self.t_limit - self.t, self.dt_min)
+            clipped = True
+        r0 = self.rvec
+        v0 = self.vvec
+        if v0.mag > 0:
+            self.hold_pvec = None
+            self.hold_pvec = self.pointing(r0, v0)
+        a0 = None
+        while True:
+            athr = [self.booster.thrust_accel(self.throttle, c * h, stagecap=self.stagecap)
+                    for c in _DP_C]
+            if None in athr:
+                return True
+            kr = [v0]
+            kv = [self.accel(r0, v0, athr[0]) if a0 is None else a0]
+            a0 = kv[0]
+            for i, row in enumerate(_DP_A):
+                ri = _lincomb(r0, h, row, kr)
+                vi = _lincomb(v0, h, row, kv)
+                kr.append(vi)
+                kv.append(self.accel(ri, vi, athr[i + 1]))
+            # last row of _DP_A is the 5th-order solution (FSAL)
+            r1, v1 = ri, vi
+            er = _lincomb(None, h, _DP_E, kr)
+            ev = _lincomb(None, h, _DP_E, kv)
+            sr = self.rk_atol_r + self.rk_rtol * max(r0.mag, r1.mag)
+            sv = self.rk_atol_v + self.rk_rtol * max(v0.mag, v1.mag)
+            err = max(er.mag / sr, ev.mag / sv)
+            # standard step-size controller, safety factor 0.9
+            fac = 5.0 if err == 0 else min(5.0, max(0.2, 0.9 * err ** -0.2))
+            if err <= 1.0 or h <= self.dt_min:
+                break
+            h = max(h * fac, self.dt_min)
+            clipped = False
+        dv = self.booster.burn(self.throttle, h, stagecap=self.stagecap)
+        if dv is None:
+            return True
+        self.last_step = (self.t, h, r0, v0, a0, r1, v1, kv[-1], self.total_dv, dv)
+        self.t += h
+        self.rvec = r1
+        self.vvec = v1
+        self.total_dv += dv
+        self.nsteps += 1
+        if not clipped:
+            self.dt = h * fac
+    def interpolate(self, s):
+        # Set state to fraction s of the way through the last RK45 step,
+        # using cubic Hermite dense output
+        t0, h, r0, v0, a0, r1, v1, a1, tdv, dv = self.last_step
+        h00 = (2 * s - 3) * s * s + 1
+        h10 = ((s - 2) * s + 1) * s
+        h01 = (3 - 2 * s) * s * s
+        h11 = (s - 1) * s * s
+        self.t = t0 + s * h
+        self.rvec = h00 * r0 + (h10 * h) * v0 + h01 * r1 + (h11 * h) * v1
+        self.vvec = h00 * v0 + (h10 * h) * a0 + h01 * v1 + (h11 * h) * a1
+        self.total_dv = tdv + s * dv
+    def encode_event(self, cond):
+        """Encode state at the point where cond() became true
+
+        cond is evaluated against the sim's current state.  With the Euler
+        integrator that's just the state at the end of the step; with RK45 we
+        bisect the last step to find the crossing."""
+        if self.integrator == self.INTEGRATOR_EULER or self.last_step is None:
+            return self.encode()
+        save = (self.t, self.rvec, self.vvec, self.total_dv)
+        h = self.last_step[1]
+        lo, hi = 0.0, 1.0
+        while (hi - lo) * h > self.event_tol:
+            mid = (lo + hi) / 2.0
+            self.interpolate(mid)
+            if cond():
+                hi = mid
+            else:
+                lo = mid
+        self.interpolate(hi)
+        d = self.encode()
+        self.t, self.rvec, self.vvec, self.total_dv = save
+        return d
     def compute_elements(self, key):
         if key in self.data:
             sv = self.data[key]
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# Runs simulations off the draw loop, so a slow sim doesn't hold up the
+# keyboard or telemetry.  Jobs are keyed (one key per sim gauge); each
+# submit() replaces any request for that key which hasn't started yet, as it
+# was made from older telemetry.  Gauges show whatever completed last.
+
+import threading
+import time
+
+class SimScheduler(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = {} # key -> (submitted, fn, args)
+        self.order = [] # keys, oldest request first
+        self.results = {} # key -> (submitted, value, exc)
+        self.running = None
+        self.dropped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='simsched')
+        self.thread.daemon = True
+        self.thread.start()
+    def submit(self, key, fn, *args):
+        """Run fn(*args) on the worker, superseding any queued request for key"""
+        with self.cond:
+            if key in self.pending:
+                # keeps its place in the queue, so one busy gauge can't
+                # starve the others
+                self.dropped += 1
+            else:
+                self.order.append(key)
+            self.pending[key] = (time.time(), fn, args)
+            self.cond.notify()
+    def result(self, key):
+        """(value, age) of the last completed job for key, or None if there
+        isn't one yet.  Age is seconds since that job was submitted, i.e.
+        how old the telemetry behind it is.  Re-raises if the job did."""
+        with self.cond:
+            r = self.results.get(key)
+        if r is None:
+            return None
+        submitted, value, exc = r
+        if exc is not None:
+            raise exc
+        return (value, time.time() - submitted)
+    def busy(self, key):
+        with self.cond:
+            return key in self.pending or self.running == key
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.order and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                key = self.order.pop(0)
+                submitted, fn, args = self.pending.pop(key)
+                self.running = key
+            value, exc = None, None
+            try:
+                value = fn(*args)
+            except Exception as e:
+                exc = e
+            with self.cond:
+                self.results[key] = (submitted, value, exc)
+                self.running = None
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+if __name__ == '__main__':
+    # Submit faster than the worker can keep up; stale requests get dropped
+    def slow(n):
+        time.sleep(0.05)
+        return n
+    s = SimScheduler()
+    for n in range(20):
+        s.submit('x', slow, n)
+        time.sleep(0.01)
+    while s.busy('x'):
+        time.sleep(0.01)
+    value, age = s.result('x')
+    print("last result %d, %.3fs old; %d stale requests dropped"%(value, age, s.dropped))
@@ -0,0 +1,406 @@
+#!/usr/bin/python3
+# Compact binary telemetry logs, as an alternative to Downlink's text logs.
+#
+# A log is a header, a sequence of records, and (if it was closed properly)
+# a trailer holding the key dictionary and a time index of blocks.  Records
+# are grouped into blocks of up to BLOCK_FRAMES frames; value deltas never
+# cross a block boundary, so a reader can start at any block.  A reader of
+# a log with no trailer (e.g. konrad crashed) rebuilds it by scanning.
+#
+# Records (all little-endian):
+#   'B'                         start of block
+#   'K' id:H len:H name         define key
+#   '<' kind stamp count:H (id:H value)*   received frame
+#   '<' kind stamp 0xffff value*            ditto, same keys as last frame
+#   '>' kind stamp len:I json              sent message
+#   'X' ...                     trailer
+# kind is 'T' (stamp is mission time) or 'U' (wall-clock time, before we
+# know mission time).  stamp and the values use the tagged encodings in
+# _encode(); in particular an unchanged value is one byte, and a float is
+# stored as a 4-byte delta from the key's previous value whenever that
+# round-trips exactly.
+
+import atexit
+import bisect
+import io
+import json
+import mmap
+import queue
+import struct
+import threading
+
+MAGIC = b'KTLOG1\0\0'
+FOOTER = struct.Struct('<Q8s')
+FOOTER_MAGIC = b'KTLOGEND'
+BLOCK_FRAMES = 128
+
+_H = struct.Struct('<H')
+_I = struct.Struct('<I')
+_b = struct.Struct('<b')
+_i = struct.Struct('<i')
+_q = struct.Struct('<q')
+_f = struct.Struct('<f')
+_d = struct.Struct('<d')
+_IX = struct.Struct('<dQ')
+
+(TAG_SAME, TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_I8, TAG_I32, TAG_I64,
+ TAG_F32, TAG_F64, TAG_DELTA, TAG_STR, TAG_JSON) = range(12)
+STAMP = -1 # slot in the 'previous value' dict used for stamps
+SAME_KEYS = 0xffff
+
+def _encode(out, v, prev):
+    # Appends the encoding of v to bytearray out.  prev is the previous value
+    # in this slot (in this block), or a unique object if none
+    if v is prev or (v == prev and type(v) is type(prev)):
+        out.append(TAG_SAME)
+    elif v is None:
+        out.append(TAG_NONE)
+    elif v is True:
+        out.append(TAG_TRUE)
+    elif v is False:
+        out.append(TAG_FALSE)
+    elif type(v) is int and -0x80 <= v < 0x80:
+        out.append(TAG_I8)
+        out += _b.pack(v)
+    elif type(v) is int and -0x80000000 <= v < 0x80000000:
+        out.append(TAG_I32)
+        out += _i.pack(v)
+    elif type(v) is int and -0x8000000000000000 <= v < 0x8000000000000000:
+        out.append(TAG_I64)
+        out += _q.pack(v)
+    elif type(v) is float:
+        if type(prev) is float and v == v and prev == prev:
+            try:
+                delta = _f.unpack(_f.pack(v - prev))[0]
+            except OverflowError:
+                delta = None
+            if delta is not None and prev + delta == v:
+                out.append(TAG_DELTA)
+                out += _f.pack(delta)
+                return
+        try:
+            f32 = _f.unpack(_f.pack(v))[0]
+        except OverflowError:
+            f32 = None
+        if f32 == v:
+            out.append(TAG_F32)
+            out += _f.pack(v)
+        else:
+            out.append(TAG_F64)
+            out += _d.pack(v)
+    elif type(v) is str and len(v.encode('utf8')) < 0x100:
+        b = v.encode('utf8')
+        out.append(TAG_STR)
+        out.append(len(b))
+        out += b
+    else:
+        b = json.dumps(v).encode('utf8')
+        out.append(TAG_JSON)
+        out += _I.pack(len(b))
+        out += b
+
+def _decode(buf, pos, prev):
+    # Returns (value, new pos)
+    tag = buf[pos]
+    pos += 1
+    if tag == TAG_SAME:
+        return prev, pos
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_I8:
+        return _b.unpack_from(buf, pos)[0], pos + 1
+    if tag == TAG_I32:
+        return _i.unpack_from(buf, pos)[0], pos + 4
+    if tag == TAG_I64:
+        return _q.unpack_from(buf, pos)[0], pos + 8
+    if tag == TAG_DELTA:
+        return prev + _f.unpack_from(buf, pos)[0], pos + 4
+    if tag == TAG_F32:
+        return _f.unpack_from(buf, pos)[0], pos + 4
+    if tag == TAG_F64:
+        return _d.unpack_from(buf, pos)[0], pos + 8
+    if tag == TAG_STR:
+        n = buf[pos]
+        return bytes(buf[pos + 1:pos + 1 + n]).decode('utf8'), pos + 1 + n
+    if tag == TAG_JSON:
+        n = _I.unpack_from(buf, pos)[0]
+        pos += 4
+        return json.loads(bytes(buf[pos:pos + n]).decode('utf8')), pos + n
+    raise ValueError("Bad value tag %d at %d"%(tag, pos - 1))
+
+class Writer(object):
+    """Writes a binary log.  Use it as a Downlink's logf: record() just
+    queues the raw message, and a background thread does the parsing,
+    encoding and (buffered) writing.  close() writes the trailer; it's also
+    called at exit.
+
+    If writing fails (disk full, say), the thread stops logging and keeps
+    the exception in self.error; record() then drops messages, and close()
+    raises IOError rather than adding a trailer to the truncated log."""
+    def __init__(self, fn):
+        self.fn = fn
+        self.error = None
+        self.f = open(fn, 'wb')
+        self.f.write(MAGIC)
+        self.pos = len(MAGIC)
+        self.keys = {} # name => id
+        self.index = [] # (time, offset) per block
+        self.nframes = 0
+        self.prev = None
+        self.ids = None # keys of the last frame, in order
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='tlog')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+    def record(self, kind, stamp, direction, msg):
+        """kind is 'T' or 'U', direction '<' (received) or '>' (sent), and
+        msg the JSON string"""
+        if self.error is None:
+            self.queue.put((kind, stamp, direction, msg))
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue # drain whatever was queued before we failed
+            try:
+                self.encode(*item)
+            except Exception as e:
+                # e.g. OSError (disk full), or struct.error (too many keys)
+                self.error = e
+    def emit(self, b):
+        self.f.write(b)
+        self.pos += len(b)
+    def key_id(self, out, name):
+        kid = self.keys.get(name)
+        if kid is None:
+            kid = self.keys[name] = len(self.keys)
+            b = name.encode('utf8')
+            out += b'K' + _H.pack(kid) + _H.pack(len(b)) + b
+        return kid
+    def encode(self, kind, stamp, direction, msg):
+        out = bytearray()
+        if direction == '<':
+            try:
+                d = json.loads(msg)
+            except ValueError:
+                d = {}
+            if not isinstance(d, dict):
+                d = {}
+            if self.prev is None or self.nframes >= BLOCK_FRAMES:
+                self.index.append([float('-inf'), self.pos])
+                out += b'B'
+                self.prev = {}
+                self.ids = None
+                self.nframes = 0
+            self.nframes += 1
+            if kind == 'T' and self.index[-1][0] == float('-inf'):
+                self.index[-1][0] = stamp
+            ids = [self.key_id(out, k) for k in d]
+            prev = self.prev
+            out += b'<' + kind.encode('ascii')
+            _encode(out, stamp, prev.get(STAMP, prev))
+            prev[STAMP] = stamp
+            if ids == self.ids:
+                out += _H.pack(SAME_KEYS)
+                for kid, v in zip(ids, d.values()):
+                    _encode(out, v, prev.get(kid, prev))
+                    prev[kid] = v
+            else:
+                out += _H.pack(len(d))
+                for kid, v in zip(ids, d.values()):
+                    out += _H.pack(kid)
+                    _encode(out, v, prev.get(kid, prev))
+                    prev[kid] = v
+                self.ids = ids
+        else:
+            if self.prev is None:
+                self.index.append([float('-inf'), self.pos])
+                out += b'B'
+                self.prev = {}
+                self.ids = None
+                self.nframes = 0
+            b = msg.encode('utf8')
+            out += b'>' + kind.encode('ascii')
+            _encode(out, stamp, self.prev.get(STAMP, self.prev))
+            self.prev[STAMP] = stamp
+            out += _I.pack(len(b)) + b
+        self.emit(bytes(out))
+    def close(self):
+        if self.f is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            f, self.f = self.f, None
+            try:
+                f.close()
+            except OSError:
+                pass
+            raise IOError("Telemetry log %s is truncated, as writing it failed: %r"%(self.fn, self.error))
+        trailer = self.pos
+        out = bytearray(b'X')
+        out += _I.pack(len(self.keys))
+        for name in sorted(self.keys, key=self.keys.get):
+            b = name.encode('utf8')
+            out += _H.pack(len(b)) + b
+        out += _I.pack(len(self.index))
+        for t, off in self.index:
+            out += _IX.pack(t, off)
+        out += FOOTER.pack(trailer, FOOTER_MAGIC)
+        self.emit(bytes(out))
+        self.f.close()
+        self.f = None
+
+class Reader(object):
+    """Reads a binary log.  records(start) yields (direction, kind, stamp,
+    payload), payload being the frame dict for '<' records and the JSON
+    string for '>' ones, from the first frame at or after mission time start
+    (found by bisecting the block index, so this assumes mission time never
+    goes backwards, e.g. by reverting the flight)."""
+    def __init__(self, f):
+        try:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            # not a real file (or an empty one)
+            self.buf = f.read()
+        if self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a binary telemetry log")
+        self.keys = []
+        self.index = []
+        if not self.read_trailer():
+            self.scan()
+        self.times = [t for t, off in self.index]
+    def read_trailer(self):
+        buf = self.buf
+        if len(buf) < len(MAGIC) + FOOTER.size:
+            return False
+        trailer, magic = FOOTER.unpack_from(buf, len(buf) - FOOTER.size)
+        if magic != FOOTER_MAGIC or buf[trailer:trailer + 1] != b'X':
+            return False
+        pos = trailer + 1
+        n = _I.unpack_from(buf, pos)[0]
+        pos += 4
+        for i in range(n):
+            ln = _H.unpack_from(buf, pos)[0]
+            self.keys.append(bytes(buf[pos + 2:pos + 2 + ln]).decode('utf8'))
+            pos += 2 + ln
+        n = _I.unpack_from(buf, pos)[0]
+        pos += 4
+        self.index = [_IX.unpack_from(buf, pos + i * _IX.size) for i in range(n)]
+        self.end = trailer
+        return True
+    def scan(self):
+        # No trailer; rebuild the keys and index the slow way
+        self.end = len(self.buf)
+        keys = {}
+        for rec in self._records(len(MAGIC), keys=keys, index=self.index):
+            pass
+        self.keys = [keys[i] for i in range(len(keys))]
+    def _records(self, pos, keys=None, index=None):
+        buf = self.buf
+        end = self.end
+        prev = {}
+        ids = []
+        while pos < end:
+            rt = buf[pos:pos + 1]
+            start = pos
+            pos += 1
+            if rt == b'B':
+                prev = {}
+                ids = []
+                if index is not None:
+                    index.append([float('-inf'), start])
+                continue
+            if rt == b'K':
+                kid, ln = _H.unpack_from(buf, pos)[0], _H.unpack_from(buf, pos + 2)[0]
+                if keys is not None:
+                    keys[kid] = bytes(buf[pos + 4:pos + 4 + ln]).decode('utf8')
+                pos += 4 + ln
+                continue
+            if rt not in (b'<', b'>'):
+                if rt == b'X':
+                    break
+                raise ValueError("Bad record type %r at %d"%(rt, start))
+            try:
+                kind = chr(buf[pos])
+                stamp, pos = _decode(buf, pos + 1, prev.get(STAMP))
+                prev[STAMP] = stamp
+                if rt == b'<':
+                    n = _H.unpack_from(buf, pos)[0]
+                    pos += 2
+                    d = {}
+                    names = self.keys if keys is None else keys
+                    if n == SAME_KEYS:
+                        for kid in ids:
+                            v, pos = _decode(buf, pos, prev.get(kid))
+                            prev[kid] = v
+                            d[names[kid]] = v
+                    else:
+                        ids = []
+                        for i in range(n):
+                            kid = _H.unpack_from(buf, pos)[0]
+                            v, pos = _decode(buf, pos + 2, prev.get(kid))
+                            prev[kid] = v
+                            d[names[kid]] = v
+                            ids.append(kid)
+                    payload = d
+                else:
+                    n = _I.unpack_from(buf, pos)[0]
+                    payload = bytes(buf[pos + 4:pos + 4 + n]).decode('utf8')
+                    pos += 4 + n
+            except (IndexError, struct.error):
+                # truncated final record
+                break
+            if index is not None and kind == 'T' and rt == b'<' and index[-1][0] == float('-inf'):
+                index[-1][0] = stamp
+            yield (rt.decode('ascii'), kind, stamp, payload)
+    def seek(self, t):
+        """Offset of the block containing mission time t"""
+        i = bisect.bisect_right(self.times, t) - 1
+        if i < 0:
+            return len(MAGIC)
+        return self.index[i][1]
+    def records(self, start=None):
+        if start is None:
+            pos = len(MAGIC)
+        else:
+            pos = self.seek(start)
+        for rec in self._records(pos):
+            if start is not None and (rec[1] != 'T' or rec[2] < start):
+                continue
+            yield rec
+
+def is_binary(f):
+    """Whether (binary, seekable) file f holds a binary log"""
+    pos = f.tell()
+    magic = f.read(len(MAGIC))
+    f.seek(pos)
+    return magic == MAGIC
+
+if __name__ == '__main__':
+    # Summarise a log, or convert a text log to binary
+    import sys
+    if len(sys.argv) > 2:
+        import downlink
+        w = Writer(sys.argv[2])
+        with open(sys.argv[1], 'r') as f:
+            for line in f:
+                m = downlink.ReplayDownlink.line_re.match(line.rstrip('\n'))
+                if m is not None:
+                    w.record(m.group(1), float(m.group(2)), m.group(3), m.group(4))
+        w.close()
+    else:
+        with open(sys.argv[1], 'rb') as f:
+            r = Reader(f)
+        n = sum(1 for rec in r.records())
+        ts = [t for t in r.times if t != float('-inf')]
+        print("%d records, %d keys, %d blocks"%(n, len(r.keys), len(r.index)))
+        if ts:
+            print("Mission time %.3f to (at least) %.3f"%(ts[0], ts[-1]))
@@ -10,6 +10,7 @@ import booster
 import burns
 import orbit
 import konrad
+import ephem
 
 class TransferConsole(konrad.Console):
     title = "Transfer Window"
@@ -59,13 +60,14 @@ class TransferConsole(konrad.Console):
                                     gauge.RSInjVel(dl, bwin.derwin(1, 14, 9, 1), 'b', self.ms, 1),
                                     ],
                              "End")
-        ewin = scr.derwin(8, 16, 7, 47)
+        ewin = scr.derwin(9, 16, 7, 47)
         e = gauge.GaugeGroup(ewin, [gauge.RSTime(dl, ewin.derwin(1, 14, 1, 1), 'e', self.ms),
                                     gauge.RSSIParam(dl, ewin.derwin(1, 14, 2, 1), 'e', self.ms, 'edrvec', 'Re', 'm'),
                                     gauge.RSSIParam(dl, ewin.derwin(1, 14, 3, 1), 'e', self.ms, 'drvec', 'd', 'm'),
                                     gauge.RSSIParam(dl, ewin.derwin(1, 14, 4, 1), 'e', self.ms, 'dvvec', 'v', 'm/s'),
                                     gauge.RSAngleParam(dl, ewin.derwin(1, 14, 5, 1), 'e', self.ms, 'ri', 'i'),
                                     gauge.RSTimeParam(dl, ewin.derwin(1, 14, 6, 1), 'e', self.ms, 'lss', 'w'),
+                                    gauge.RSApproaches(dl, ewin.derwin(1, 14, 7, 1), 'e', self.ms),
                                     ],
                              "Approach")
         swin = scr.derwin(9, 16, 7, 63)
@@ -203,13 +205,13 @@ class TransferConsole(konrad.Console):
             return
         return super(TransferConsole, self).input(key)
 
-def parse_opts():
+def parse_opts(argv=None):
     x = optparse.OptionParser()
     x.add_option('--refresh-rate', type='float', help='Refresh interval in ms', default=500)
     x.add_option('-f', '--fallover', action="store_true", help='Fall over when exceptions encountered')
     x.add_option('-b', '--body', type='string', help="Name of body to assume we're at", default='Earth')
     x.add_option('-t', '--target-body', type='string', help="Name of body we want to intercept")
-    opts, args = x.parse_args()
+    opts, args = x.parse_args(argv)
     if args:
         x.error("Excess arguments")
     return opts
@@ -218,6 +220,7 @@ if __name__ == '__main__':
     opts = parse_opts()
     gauge.fallover = opts.fallover
     opts.booster = booster.FakeBooster()
+    ephem.install_default()
     dl = downlink.FakeDownlink()
     scr = curses.initscr()
     try:
@@ -240,8 +243,7 @@ if __name__ == '__main__':
                 if console.input(key):
                     end = True
             console.update_bodies()
-            ml = console.group.draw()
-            console.group.post_draw()
+            ml = console.draw()
             if ml is not None:
                 for m in ml:
                     console.status.push(m)